@@ -0,0 +1,788 @@
+'''
+Batch ingestion of KRM .dat files
+
+make_krm_toml.py processes one .dat file and one JSON file per run. This program runs the same
+steps (krm_data -> krm_merge_data -> krm_validate -> krm_toml) for many pairs of .dat and
+metadata JSON files across a pool of worker processes.
+
+The pairs of files are given by either:
+    A directory. Each JSON file in the directory is paired with the .dat file whose name is the
+      "specimen_id" in the JSON file, e.g., "specimen_id": "aherr001" -> aherr001.dat
+      Compressed files (aherr001.dat.gz, .dat.bz2, .dat.xz) are also found.
+    A manifest. A CSV file with the columns "dat_file" and "json_file" and an optional
+      "toml_file" column. Relative paths are relative to the directory of the manifest.
+
+With --all-features every body part in the .dat file (the fish body and each swimbladder
+chamber) is written to its own toml file, named after the JSON file and the body part label,
+e.g., lavn01_swimbladder_chamber_2.toml, from one read of the .dat file.
+
+With --sidecar npz (or arrow) a binary sidecar file with the full precision shape_data arrays
+is written next to each toml file (see krm_sidecar).
+
+With --store the merged documents are also added to a packed store (see krm_store), one binary
+file and an index for the whole batch. --no-toml writes only the store.
+
+With --build-manifest only the toml files whose inputs (.dat, JSON, schema, code, options)
+changed, or whose outputs are missing or changed, are built again (see krm_manifest).
+--dry-run lists the files that would be built and why, without building them.
+
+With --instrument (and --prometheus) the time, CPU time, and counters of each stage (read,
+worms, merge, validate, toml) of each specimen are written as JSON lines (and the totals as a
+Prometheus text file), see krm_instrument.
+
+A file that can not be read, merged, or validated does not stop the run. Its result has the
+status "error" (or "invalid"), the stage that failed, and the exception. With --checkpoint each
+result is appended to a JSON lines file as soon as it finishes, and a run that was interrupted
+is resumed with the same --checkpoint without building the finished files again (--retry-errors
+also builds the files that failed again). With --quarantine the input files of the failed tasks
+are moved to a quarantine directory, with a JSON file of the error, once the run is finished.
+If a file kills its worker process (e.g., out of memory), the pool is started again for the
+other files and the files that were running are run one at a time to find it. Only that file
+fails, with the stage "worker", so it is checkpointed and quarantined like any other failure.
+
+Example:
+    python krm_batch.py --schema ../Schema/echoSMs_datastore_schema.json --workers 4 \
+                        --outdir /tmp/toml ../Example_Data
+
+jech
+'''
+
+import sys
+import os
+import re
+import io
+import csv
+import json
+import time
+import shutil
+import traceback
+import argparse
+import contextlib
+from pathlib import Path
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from krm_schema import krm_schema as ks
+from krm_worms import krm_worms as kw
+from krm_worms_cache import krm_worms_cache
+from krm_json import krm_json as kj
+from krm_data import krm_data as kd
+from krm_merge_data import krm_merge_data as km
+from krm_validate import krm_validate as kv
+from krm_toml import write_toml
+from krm_sidecar import write_sidecar, sidecar_name
+from krm_store import krm_store
+from krm_manifest import krm_manifest, code_version, options_hash
+from krm_instrument import instrument
+
+
+@dataclass
+class krm_task():
+    '''
+    One pair of .dat and JSON files and the toml file to write
+    '''
+    dat_file: str
+    json_file: str
+    toml_file: str
+
+
+@dataclass
+class krm_result():
+    '''
+    The outcome of processing one krm_task
+    status is one of "ok", "invalid" (did not validate to the schema), or "error"
+    for an error, stage is the step that failed (json, worms, read, merge, validate, write,
+    store, or worker if the worker process failed), error_type the exception, and details the
+    traceback
+    with all features, toml_files are the files written for the body parts
+    store_records are the (part, document, arrays) for the store. They are added to the store by
+    the main process and are not saved with the results
+    metrics are the instrumentation records of the task. They are added to the instrument of
+    the main process and are not saved with the results
+    '''
+    dat_file: str
+    json_file: str
+    toml_file: str
+    status: str = 'error'
+    nodes: int = 0
+    seconds: float = 0.0
+    message: str = ''
+    stage: str = ''
+    error_type: str = ''
+    details: str = ''
+    toml_files: list = field(default_factory=list)
+    store_records: list = field(default_factory=list, repr=False)
+    metrics: list = field(default_factory=list, repr=False)
+
+
+# options and the validator for each worker process. These are set once per process by
+# _init_worker so the schema is read and compiled once per worker rather than once per file
+_worker = {}
+# the fields of krm_result that are not saved with the results
+_unsaved = ('store_records', 'metrics')
+# the .dat files can be compressed
+_dat_suffixes = ['.dat', '.dat.gz', '.dat.bz2', '.dat.xz']
+
+
+def tasks_from_directory(datadir, outdir=None, recursive=False):
+    '''
+    Pair the JSON files in a directory with their .dat files
+
+    Parameters:
+    -----------
+    datadir- directory with the JSON and .dat files
+    outdir- directory for the toml files. Default is next to the JSON file
+    recursive- also search the subdirectories
+
+    Returns:
+    --------
+    list of krm_task and a list of the JSON files that do not have a .dat file
+    '''
+
+    if (not isinstance(datadir, Path)):
+        datadir = Path(datadir)
+
+    pattern = '**/*.json' if recursive else '*.json'
+    tasks = []
+    unpaired = []
+    for jsonfile in sorted(datadir.glob(pattern)):
+        try:
+            with open(jsonfile, 'r') as f:
+                specimen_id = json.load(f).get('specimen_id', '')
+        except (json.JSONDecodeError, AttributeError, UnicodeDecodeError):
+            unpaired.append(str(jsonfile))
+            continue
+        datfile = None
+        for suffix in _dat_suffixes:
+            candidate = jsonfile.parent / (str(specimen_id)+suffix)
+            if (specimen_id and candidate.is_file()):
+                datfile = candidate
+                break
+        if (datfile is None):
+            unpaired.append(str(jsonfile))
+            continue
+        tasks.append(krm_task(str(datfile), str(jsonfile),
+                              str(_toml_name(jsonfile, outdir))))
+
+    return tasks, unpaired
+
+
+def tasks_from_manifest(manifest, outdir=None):
+    '''
+    Read the pairs of .dat and JSON files from a CSV manifest
+
+    Parameters:
+    -----------
+    manifest- CSV file with the columns "dat_file", "json_file", and optional "toml_file"
+    outdir- directory for the toml files if "toml_file" is not given
+
+    Returns:
+    --------
+    list of krm_task
+    '''
+
+    if (not isinstance(manifest, Path)):
+        manifest = Path(manifest)
+
+    tasks = []
+    with open(manifest, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            datfile = manifest.parent / row['dat_file'].strip()
+            jsonfile = manifest.parent / row['json_file'].strip()
+            if (row.get('toml_file')):
+                tomlfile = manifest.parent / row['toml_file'].strip()
+            else:
+                tomlfile = _toml_name(jsonfile, outdir)
+            tasks.append(krm_task(str(datfile), str(jsonfile), str(tomlfile)))
+
+    return tasks
+
+
+def _toml_name(jsonfile, outdir):
+    '''
+    the toml file has the same name as the JSON file, as in make_krm_toml.py
+    '''
+
+    tomlfile = jsonfile.with_suffix('.toml')
+    if (outdir):
+        tomlfile = Path(outdir) / tomlfile.name
+
+    return tomlfile
+
+
+def _feature_toml_name(tomlfile, label):
+    '''
+    the toml file of one body part, e.g., lavn01.toml and "swimbladder chamber 2" ->
+    lavn01_swimbladder_chamber_2.toml
+    '''
+
+    tomlfile = Path(tomlfile)
+    slug = re.sub(r'\W+', '_', label).strip('_')
+
+    return tomlfile.with_name(f'{tomlfile.stem}_{slug}{tomlfile.suffix}')
+
+
+def _init_worker(schema_file, opts):
+    '''
+    Read the schema and build the validator once for each worker process
+    '''
+
+    _worker['opts'] = opts
+    with contextlib.redirect_stdout(io.StringIO()):
+        schema_md = ks(schema_file)
+        _worker['validator'] = kv(schema_ref=schema_md, schema_obj='schema_md', compiled=True)
+    _worker['cache'] = krm_worms_cache(opts['worms_cache']) if opts['worms_cache'] else None
+    if (opts['instrument']):
+        instrument.enable()
+
+
+def run_task(task):
+    '''
+    Read, merge, validate, and write the toml file for one pair of files. The classes print
+    their progress, so the output is captured and only returned when there is an error, unless
+    the verbose option is set
+
+    Parameters:
+    -----------
+    task- krm_task
+
+    Returns:
+    --------
+    krm_result
+    '''
+
+    opts = _worker['opts']
+    result = krm_result(task.dat_file, task.json_file, task.toml_file)
+    log = io.StringIO()
+    t0 = time.perf_counter()
+    stage = 'json'
+    try:
+        with contextlib.redirect_stdout(sys.stdout if opts['verbose'] else log), \
+             instrument.specimen(Path(task.json_file).stem):
+            json_md = kj(task.json_file)
+            worms_md = None
+            if (not opts['skip_worms']):
+                stage = 'worms'
+                worms_md = kw(task.json_file, cache=_worker['cache'], offline=opts['offline'])
+                worms_md.get_taxon_ranks_by_aphia_id()
+                worms_md.get_vernaculars_by_aphia_id(language=opts['language'])
+            stage = 'read'
+            krm_data = kd(task.dat_file, stream=True)
+            krm_data.parse()
+            result.nodes = sum(len(v['nodes']) for k, v in krm_data.data_bp.items()
+                               if k != 'header')
+            stage = 'merge'
+            krm_merge = km(data=krm_data, worms=worms_md, json=json_md, headless=True)
+            if (opts['all_features']):
+                docs = {_feature_toml_name(task.toml_file, k):
+                        (k, doc, krm_merge.shape_arrays_all.get(k))
+                        for k, doc in krm_merge.merge_all(returndict=True).items()}
+            else:
+                krm_merge.merge_dicts()
+                docs = {Path(task.toml_file): ('', krm_merge.krm_data_merged,
+                                               krm_merge.shape_arrays)}
+            result.status = 'ok' if docs else 'invalid'
+            for tomlfile, (part, doc, arrays) in docs.items():
+                stage = 'validate'
+                valid = _worker['validator'].validate(doc)
+                if (not valid):
+                    result.status = 'invalid'
+                    result.stage = stage
+                    result.message = _last_line(log)
+                if (not valid and not opts['write_invalid']):
+                    continue
+                stage = 'write'
+                if (opts['store']):
+                    # the shape_data lists are not sent back to the main process
+                    shape_data = {k: v for k, v in doc['shape_data'].items() if k not in arrays}
+                    result.store_records.append((part, doc | {'shape_data': shape_data},
+                                                 arrays))
+                if (opts['toml']):
+                    tomlfile.parent.mkdir(parents=True, exist_ok=True)
+                    with open(tomlfile, 'w') as f:
+                        write_toml(doc, f)
+                    result.toml_files.append(str(tomlfile))
+                    if (opts['sidecar']):
+                        write_sidecar(sidecar_name(tomlfile, opts['sidecar']), doc, arrays,
+                                      fmt=opts['sidecar'], dtype=opts['sidecar_dtype'])
+    except (Exception, SystemExit) as e:
+        # keep the last line the krm classes printed if the exception has no message
+        result.status = 'error'
+        result.stage = stage
+        result.error_type = type(e).__name__
+        result.message = f'{type(e).__name__}: {e}' if str(e) else _last_line(log)
+        result.details = traceback.format_exc()
+    result.seconds = time.perf_counter() - t0
+    if (opts['instrument']):
+        result.metrics = instrument.drain()
+
+    return result
+
+
+def run_batch(tasks, schema_file, workers=None, skip_worms=False, language='English',
+              worms_cache=None, offline=False, write_invalid=False, verbose=False,
+              progress=True, all_features=False, sidecar=None, sidecar_dtype='float64',
+              store=None, toml=True, instrumented=False, checkpoint=None):
+    '''
+    Process the tasks across a pool of worker processes
+
+    Parameters:
+    -----------
+    tasks- list of krm_task
+    schema_file- the echoSMs datastore schema file
+    workers- number of worker processes. Default is the number of CPUs. With one worker the
+             tasks are run in this process
+    skip_worms- do not get the taxonomic ranks and vernaculars from WoRMS
+    language- language of the vernaculars
+    worms_cache- SQLite file for the local cache of WoRMS lookups
+    offline- only use the WoRMS cache
+    write_invalid- write the toml file even if the merged data do not validate
+    verbose- show the output of the krm classes
+    progress- print a line for each file as it finishes
+    all_features- write a toml file for every body part in the .dat file
+    sidecar- also write a binary sidecar file of the shape_data: "npz" or "arrow"
+    sidecar_dtype- floating point type of the sidecar arrays: "float64" or "float32"
+    store- the binary file of a packed store (krm_store) to add the documents to
+    toml- write the toml files
+    instrumented- record the stages of each task in krm_instrument.instrument
+    checkpoint- JSON lines file the results are appended to as they finish (see resume_tasks)
+
+    Returns:
+    --------
+    list of krm_result and a dictionary with the summary
+    '''
+
+    opts = {'skip_worms': skip_worms, 'language': language,
+            'worms_cache': str(worms_cache) if worms_cache else None, 'offline': offline,
+            'write_invalid': write_invalid, 'verbose': verbose, 'all_features': all_features,
+            'sidecar': sidecar, 'sidecar_dtype': sidecar_dtype, 'store': bool(store),
+            'toml': toml, 'instrument': instrumented}
+    workers = workers or os.cpu_count() or 1
+    # the workers return the documents and only this process writes to the store
+    packed = krm_store(store, mode='a') if store else None
+    ckpt = None
+    if (checkpoint):
+        ckpt = open(checkpoint, 'a+')
+        # end a partial last line (from a run that was killed while writing it)
+        if (ckpt.tell() > 0):
+            ckpt.seek(ckpt.tell() - 1)
+            if (ckpt.read(1) != '\n'):
+                ckpt.write('\n')
+    results = []
+    t0 = time.perf_counter()
+    interrupted = False
+    try:
+        if (workers == 1 or len(tasks) <= 1):
+            _init_worker(schema_file, opts)
+            for task in tasks:
+                results.append(run_task(task))
+                _finish_result(results[-1], packed, progress, ckpt)
+        else:
+            def finish(r):
+                results.append(r)
+                _finish_result(r, packed, progress, ckpt)
+
+            pending = list(tasks)
+            while (pending):
+                broken = _run_pool(pending, workers, schema_file, opts, finish)
+                if (not broken):
+                    break
+                # a worker died and broke the pool, which fails every task without a result.
+                # The tasks are queued in order, so the one that killed its worker is among
+                # the first unfinished tasks: at most 2*workers+1 tasks are queued or running
+                started = len(pending) - len(broken) + 2*workers + 1
+                suspects = [pending[i] for i in broken if i < started]
+                pending = [pending[i] for i in broken if i >= started]
+                print(f'A worker process died. Running {len(suspects)} files one at a time '
+                      f'to find the file that killed it')
+                for task in suspects:
+                    if (_run_pool([task], 1, schema_file, opts, finish)):
+                        finish(krm_result(task.dat_file, task.json_file, task.toml_file,
+                                          stage='worker', error_type='BrokenProcessPool',
+                                          message='the worker process died running this file'))
+    except KeyboardInterrupt:
+        interrupted = True
+        print(f'Interrupted after {len(results)} of {len(tasks)} files' +
+              (f'. Resume with --checkpoint {checkpoint}' if checkpoint else ''))
+    finally:
+        if (ckpt):
+            ckpt.close()
+        if (packed):
+            packed.close()
+    elapsed = time.perf_counter() - t0
+
+    summary = summarize(results, elapsed, workers)
+    summary['interrupted'] = interrupted
+
+    return results, summary
+
+
+def _run_pool(tasks, workers, schema_file, opts, finish):
+    '''
+    Run the tasks in a new pool of worker processes and call finish(result) for each result
+
+    Returns:
+    --------
+    the sorted indices of the tasks that have no result because a worker process died and
+    broke the pool
+    '''
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(schema_file, opts))
+    broken = []
+    try:
+        futures = {pool.submit(run_task, task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+                continue
+            except OSError as e:
+                task = tasks[futures[future]]
+                result = krm_result(task.dat_file, task.json_file, task.toml_file,
+                                    stage='worker', error_type=type(e).__name__,
+                                    message=f'{type(e).__name__}: {e}')
+            finish(result)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    return sorted(broken)
+
+
+def resume_tasks(tasks, checkpoint, retry_errors=False):
+    '''
+    The tasks that are not finished in a checkpoint file
+
+    Parameters:
+    -----------
+    tasks- list of krm_task
+    checkpoint- JSON lines file of the results of an earlier run (run_batch checkpoint)
+    retry_errors- also run the tasks that failed again
+
+    Returns:
+    --------
+    list of the tasks to run and list of the krm_result of the finished tasks
+    '''
+
+    done = {}
+    if (Path(checkpoint).exists()):
+        fields = set(krm_result.__dataclass_fields__)
+        with open(checkpoint, 'r') as f:
+            for line in f:
+                try:
+                    r = krm_result(**{k: v for k, v in json.loads(line).items() if k in fields})
+                except (ValueError, TypeError):
+                    # e.g., the last line of a run that was killed while writing
+                    continue
+                done[(r.dat_file, r.json_file, r.toml_file)] = r
+
+    todo = []
+    finished = []
+    for task in tasks:
+        r = done.get((str(task.dat_file), str(task.json_file), str(task.toml_file)))
+        if (r is None or (retry_errors and r.status == 'error')):
+            todo.append(task)
+        else:
+            finished.append(r)
+
+    return todo, finished
+
+
+def quarantine(results, tasks, quarantine_dir, statuses=('error',)):
+    '''
+    Move the input files of the failed tasks to a quarantine directory. Each task has a
+    directory named after its JSON file with the .dat and JSON files and error.json, the
+    result with the error. A .dat file that is also an input of a task that did not fail (e.g.,
+    one .dat file for the body and swimbladder JSON files) is copied instead of moved
+
+    Parameters:
+    -----------
+    results- list of krm_result
+    tasks- all the krm_task of the batch
+    quarantine_dir- the quarantine directory
+    statuses- the statuses to quarantine, e.g., ('error', 'invalid')
+
+    Returns:
+    --------
+    list of the quarantine directories of the tasks
+    '''
+
+    failed = [r for r in results if r.status in statuses]
+    failed_keys = {(r.dat_file, r.json_file) for r in failed}
+    # the inputs of the tasks that did not fail stay where they are
+    keep = {str(f) for t in tasks if (str(t.dat_file), str(t.json_file)) not in failed_keys
+            for f in (t.dat_file, t.json_file)}
+
+    dirs = []
+    moved = set()
+    for r in failed:
+        qdir = Path(quarantine_dir) / Path(r.json_file).stem
+        qdir.mkdir(parents=True, exist_ok=True)
+        for f in (r.dat_file, r.json_file):
+            if (Path(f).exists()):
+                shutil.copy2(f, qdir / Path(f).name)
+                if (f not in keep):
+                    moved.add(f)
+        with open(qdir / 'error.json', 'w') as f:
+            json.dump(_result_dict(r), f, indent=4)
+        dirs.append(str(qdir))
+    for f in moved:
+        Path(f).unlink(missing_ok=True)
+
+    return dirs
+
+
+def plan_build(tasks, manifest, schema_file, options):
+    '''
+    Find the tasks whose outputs are not up to date in the build manifest
+
+    Parameters:
+    -----------
+    tasks- list of krm_task
+    manifest- krm_manifest
+    schema_file- the schema file
+    options- dictionary of the batch options that change the output
+
+    Returns:
+    --------
+    list of (krm_task, input hashes, reasons) to build and list of the tasks that are
+    up to date
+    '''
+
+    code = code_version()
+    opts = options_hash(options)
+    todo = []
+    uptodate = []
+    for task in tasks:
+        inputs = manifest.inputs(task, schema_file, code, opts)
+        reasons = manifest.reasons(task, inputs)
+        if (reasons):
+            todo.append((task, inputs, reasons))
+        else:
+            uptodate.append(task)
+
+    return todo, uptodate
+
+
+def record_build(manifest, todo, results, sidecar=None):
+    '''
+    Save the inputs and outputs of the built tasks in the build manifest. Tasks with an error
+    are removed, so they are built again
+
+    Parameters:
+    -----------
+    manifest- krm_manifest
+    todo- the tasks to build from plan_build
+    results- list of krm_result
+    sidecar- the sidecar format, if sidecar files were written
+
+    Returns:
+    --------
+    none
+    '''
+
+    inputs = {task.toml_file: (task, i) for task, i, reasons in todo}
+    for r in results:
+        task, i = inputs[r.toml_file]
+        if (r.status == 'error'):
+            manifest.forget(task)
+            continue
+        outputs = list(r.toml_files)
+        if (sidecar):
+            outputs += [sidecar_name(t, sidecar) for t in r.toml_files]
+        manifest.record(task, i, r.status, outputs)
+    manifest.save()
+
+
+def summarize(results, elapsed, workers=1):
+    '''
+    Summarize the results of a batch run
+
+    Parameters:
+    -----------
+    results- list of krm_result
+    elapsed- wall time of the run in seconds
+    workers- number of worker processes
+
+    Returns:
+    --------
+    dictionary with the counts and throughput
+    '''
+
+    nodes = sum(r.nodes for r in results)
+    summary = {'files': len(results),
+               'ok': sum(r.status == 'ok' for r in results),
+               'invalid': sum(r.status == 'invalid' for r in results),
+               'error': sum(r.status == 'error' for r in results),
+               'nodes': nodes,
+               'workers': workers,
+               'seconds': round(elapsed, 3),
+               'files_per_second': round(len(results)/elapsed, 2) if elapsed > 0 else 0.0,
+               'nodes_per_second': round(nodes/elapsed, 1) if elapsed > 0 else 0.0}
+
+    return summary
+
+
+def _last_line(log):
+    lines = log.getvalue().strip().splitlines()
+    return lines[-1] if lines else ''
+
+
+def _result_dict(r):
+    return {k: v for k, v in asdict(r).items() if k not in _unsaved}
+
+
+def _finish_result(r, packed, progress, ckpt=None):
+    '''
+    add the documents of a result to the store, append it to the checkpoint, and print it
+    '''
+
+    if (packed is not None):
+        # a store error fails this file, not the run
+        try:
+            for part, doc, arrays in r.store_records:
+                packed.add(doc, arrays, part=part)
+        except Exception as e:
+            r.status = 'error'
+            r.stage = 'store'
+            r.error_type = type(e).__name__
+            r.message = f'{type(e).__name__}: {e}'
+            r.details = traceback.format_exc()
+    r.store_records = []
+    instrument.extend(r.metrics)
+    r.metrics = []
+    if (ckpt is not None):
+        ckpt.write(json.dumps(_result_dict(r))+'\n')
+        ckpt.flush()
+    if (progress):
+        _print_result(r)
+
+
+def _print_result(r):
+    print(f'{r.status:8s} {r.nodes:8d} {r.seconds:8.3f}s  {r.dat_file} -> {r.toml_file}'
+          + (f'  ({r.stage}: {r.message})' if r.message else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert KRM .dat files to echoSMs toml files')
+    parser.add_argument('datadir', nargs='?', help='directory with the JSON and .dat files')
+    parser.add_argument('--manifest', help='CSV file with the dat_file and json_file columns')
+    parser.add_argument('--schema', required=True, help='echoSMs datastore schema JSON file')
+    parser.add_argument('--outdir', help='directory for the toml files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--skip-worms', action='store_true', help='do not query WoRMS')
+    parser.add_argument('--language', default='English', help='language of the vernaculars')
+    parser.add_argument('--worms-cache', help='SQLite file for the local cache of WoRMS lookups')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use the WoRMS cache, do not call WoRMS')
+    parser.add_argument('--write-invalid', action='store_true',
+                        help='write the toml file even if the data do not validate')
+    parser.add_argument('--all-features', action='store_true',
+                        help='write a toml file for every body part in the .dat file')
+    parser.add_argument('--sidecar', choices=['npz', 'arrow'],
+                        help='also write a binary sidecar file of the shape_data arrays')
+    parser.add_argument('--sidecar-dtype', default='float64', choices=['float64', 'float32'],
+                        help='floating point type of the sidecar arrays')
+    parser.add_argument('--store', help='binary file of a packed store to add the documents to')
+    parser.add_argument('--no-toml', action='store_true', help='do not write the toml files')
+    parser.add_argument('--build-manifest',
+                        help='JSON file of the input and output hashes, to only build the '
+                             'toml files that are out of date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='with --build-manifest, list the files to build and why')
+    parser.add_argument('--results', help='write the per-file results as JSON lines')
+    parser.add_argument('--checkpoint',
+                        help='JSON lines file of the finished files, to resume an interrupted run')
+    parser.add_argument('--retry-errors', action='store_true',
+                        help='with --checkpoint, build the files that failed again')
+    parser.add_argument('--quarantine', help='directory to move the inputs of failed files to')
+    parser.add_argument('--quarantine-invalid', action='store_true',
+                        help='also quarantine the files that do not validate')
+    parser.add_argument('--instrument',
+                        help='write the time and counters of each stage as JSON lines')
+    parser.add_argument('--prometheus', help='write the stage totals as a Prometheus text file')
+    parser.add_argument('--verbose', action='store_true', help='show the krm class output')
+    args = parser.parse_args(argv)
+
+    if (args.manifest):
+        tasks = tasks_from_manifest(args.manifest, args.outdir)
+    elif (args.datadir):
+        tasks, unpaired = tasks_from_directory(args.datadir, args.outdir, args.recursive)
+        for u in unpaired:
+            print(f'skipped  {u}: no .dat file for the specimen_id')
+    else:
+        parser.error('provide a data directory or --manifest')
+
+    if (args.dry_run and not args.build_manifest):
+        parser.error('--dry-run needs --build-manifest')
+    # all the tasks, so quarantine() keeps the .dat files of the tasks that are up to date
+    all_tasks = tasks
+    manifest = None
+    if (args.build_manifest):
+        manifest = krm_manifest(args.build_manifest)
+        options = {'skip_worms': args.skip_worms, 'language': args.language,
+                   'write_invalid': args.write_invalid, 'all_features': args.all_features,
+                   'sidecar': args.sidecar, 'sidecar_dtype': args.sidecar_dtype,
+                   'store': args.store, 'toml': not args.no_toml}
+        todo, uptodate = plan_build(tasks, manifest, args.schema, options)
+        for task in uptodate:
+            print(f'current  {task.toml_file}')
+        for task, inputs, reasons in todo:
+            print(f'build    {task.toml_file}: {", ".join(reasons)}')
+        print(f'{len(todo)} of {len(tasks)} files to build')
+        if (args.dry_run):
+            return 0
+        tasks = [task for task, inputs, reasons in todo]
+
+    if (args.retry_errors and not args.checkpoint):
+        parser.error('--retry-errors needs --checkpoint')
+    finished = []
+    if (args.checkpoint):
+        tasks, finished = resume_tasks(tasks, args.checkpoint, args.retry_errors)
+        if (finished):
+            print(f'resumed  {len(finished)} files are finished in {args.checkpoint}, '
+                  f'{len(tasks)} to build')
+
+    results, summary = run_batch(tasks, args.schema, workers=args.workers,
+                                 skip_worms=args.skip_worms, language=args.language,
+                                 worms_cache=args.worms_cache, offline=args.offline,
+                                 write_invalid=args.write_invalid, verbose=args.verbose,
+                                 all_features=args.all_features, sidecar=args.sidecar,
+                                 sidecar_dtype=args.sidecar_dtype, store=args.store,
+                                 toml=not args.no_toml,
+                                 instrumented=bool(args.instrument or args.prometheus),
+                                 checkpoint=args.checkpoint)
+
+    if (manifest):
+        record_build(manifest, todo, results, args.sidecar)
+
+    if (args.results):
+        with open(args.results, 'w') as f:
+            for r in results:
+                f.write(json.dumps(_result_dict(r))+'\n')
+
+    if (args.quarantine):
+        statuses = ('error', 'invalid') if args.quarantine_invalid else ('error',)
+        for qdir in quarantine(finished + results, all_tasks, args.quarantine, statuses):
+            print(f'quarantined {qdir}')
+
+    if (args.instrument):
+        instrument.write_jsonl(args.instrument)
+    if (args.prometheus):
+        instrument.write_prometheus(args.prometheus)
+    if (args.instrument or args.prometheus):
+        instrument.display_dict('stage')
+
+    print(f"{summary['files']} files: {summary['ok']} ok, {summary['invalid']} invalid, "
+          f"{summary['error']} error in {summary['seconds']} s with {summary['workers']} "
+          f"workers ({summary['files_per_second']} files/s, "
+          f"{summary['nodes_per_second']} nodes/s)")
+
+    return 0 if summary['error'] == 0 and not summary['interrupted'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+'''
+Benchmark the stages of the KRM ingestion pipeline
+
+The pipeline is timed on synthetic .dat files (krm_synthetic) so the node counts, the number of
+swimbladder chambers, the number of columns, and the file format can be varied beyond the three
+example files. Each stage is timed separately:
+    read       read the lines of the file (krm_data)
+    meta       parse the metadata
+    bodyparts  parse the body part nodes
+    merge      merge with the JSON metadata and convert to echoSMs coordinates (krm_merge_data)
+    validate   validate the merged dictionary to the schema (compiled krm_validate)
+    toml       write the toml file (krm_toml, fast writer)
+The fastest of --repeat runs of each stage is reported. The results can be saved to a JSON file
+and compared to an earlier run to catch regressions:
+    python krm_benchmark.py --npts 100 10000 1000000 --json bench.json
+    python krm_benchmark.py --npts 100 10000 1000000 --compare bench.json --tolerance 0.25
+The program exits with 1 if a stage is slower than the earlier run by more than the tolerance.
+
+jech
+'''
+
+import sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import platform
+import contextlib
+from pathlib import Path
+import numpy as np
+from krm_synthetic import krm_synthetic
+from krm_json import krm_json as kj
+from krm_schema import krm_schema as ks
+from krm_data import krm_data as kd
+from krm_merge_data import krm_merge_data as km
+from krm_validate import krm_validate as kv
+from krm_toml import krm_toml as kt
+
+stages = ['read', 'meta', 'bodyparts', 'merge', 'validate', 'toml']
+
+srcdir = Path(__file__).resolve().parent
+default_json = srcdir.parent / 'Example_Data' / 'Clupea_harengus_bd.json'
+default_schema = srcdir.parent / 'Schema' / 'echoSMs_datastore_schema.json'
+
+
+def time_pipeline(datfile, json_md, validator, tomlfile):
+    '''
+    Run the pipeline once for a .dat file and time each stage
+
+    Parameters:
+    -----------
+    datfile- the .dat file
+    json_md- krm_json object with the metadata
+    validator- krm_validate object
+    tomlfile- the toml file to write
+
+    Returns:
+    --------
+    dictionary of seconds for each stage
+    '''
+
+    seconds = {}
+    t0 = time.perf_counter()
+    krm_data = kd(datfile)
+    t1 = time.perf_counter()
+    seconds['read'] = t1 - t0
+    blocks = krm_data.iter_blocks()
+    next(blocks)
+    t2 = time.perf_counter()
+    seconds['meta'] = t2 - t1
+    for block in blocks:
+        pass
+    t3 = time.perf_counter()
+    seconds['bodyparts'] = t3 - t2
+    krm_merge = km(data=krm_data, json=json_md, headless=True)
+    krm_merge.merge_dicts()
+    t4 = time.perf_counter()
+    seconds['merge'] = t4 - t3
+    validator.validate(krm_merge.krm_data_merged)
+    t5 = time.perf_counter()
+    seconds['validate'] = t5 - t4
+    krm_toml = kt(data_ref=krm_merge, data_obj='krm_data_merged')
+    krm_toml.data_to_toml_file(toml_file=tomlfile, fast=True)
+    seconds['toml'] = time.perf_counter() - t5
+
+    return seconds
+
+
+def run(npts_list, nsb=1, six_columns=False, formats=('new', 'clay'), repeat=3,
+        json_file=default_json, schema_file=default_schema, seed=0):
+    '''
+    Write the synthetic files and time the pipeline for each of them
+
+    Parameters:
+    -----------
+    npts_list- the numbers of points per body part
+    nsb- number of swimbladder chambers
+    six_columns- nonsymmetric coordinates
+    formats- "new" and/or "clay"
+    repeat- number of runs per file. The fastest time of each stage is kept
+    json_file- the metadata JSON file
+    schema_file- the schema file
+    seed- random seed of the synthetic files
+
+    Returns:
+    --------
+    list of dictionaries, one per file, with the file parameters and the seconds per stage
+    '''
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         contextlib.redirect_stdout(io.StringIO()):
+        tmpdir = Path(tmpdir)
+        json_md = kj(json_file)
+        validator = kv(schema_ref=ks(schema_file), schema_obj='schema_md', compiled=True)
+        synthetic = krm_synthetic(seed=seed)
+        for datfile, nodes in synthetic.write_corpus(tmpdir, npts_list, nsb, six_columns,
+                                                     formats):
+            best = None
+            for i in range(repeat):
+                seconds = time_pipeline(datfile, json_md, validator, tmpdir / 'bench.toml')
+                best = seconds if best is None else {k: min(best[k], seconds[k]) for k in best}
+            results.append({'file': datfile.stem,
+                            'format': 'new' if datfile.stem.startswith('synth_new') else 'clay',
+                            'nodes': nodes,
+                            'bytes': datfile.stat().st_size,
+                            'seconds': best})
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=1e-3):
+    '''
+    Compare the results to an earlier run
+
+    Parameters:
+    -----------
+    results- list of results from run()
+    baseline- list of results from an earlier run()
+    tolerance- fraction a stage can be slower than the baseline
+    min_seconds- stages faster than this in the baseline are not compared (timer noise)
+
+    Returns:
+    --------
+    list of (file, stage, baseline seconds, seconds) for the slower stages, and the list of
+    the files of the results that are not in the baseline (not compared)
+    '''
+
+    earlier = {r['file']: r['seconds'] for r in baseline}
+    slower = []
+    unmatched = []
+    for r in results:
+        if (r['file'] not in earlier):
+            unmatched.append(r['file'])
+            continue
+        for stage, s in r['seconds'].items():
+            s0 = earlier[r['file']].get(stage)
+            if (s0 is not None and s0 >= min_seconds and s > s0*(1 + tolerance)):
+                slower.append((r['file'], stage, s0, s))
+
+    return slower, unmatched
+
+
+def display(results):
+    '''
+    print the results as a table in milliseconds and the nodes per second of the whole pipeline
+    '''
+
+    print(f'{"file":28s} {"nodes":>9s} ' + ' '.join(f'{s:>10s}' for s in stages)
+          + f' {"nodes/s":>11s}')
+    for r in results:
+        total = sum(r['seconds'].values())
+        print(f'{r["file"]:28s} {r["nodes"]:9d} '
+              + ' '.join(f'{1000*r["seconds"][s]:10.2f}' for s in stages)
+              + f' {r["nodes"]/total:11.0f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the KRM ingestion pipeline')
+    parser.add_argument('--npts', nargs='+', type=int, default=[100, 1000, 10000, 100000],
+                        help='number of points per body part')
+    parser.add_argument('--nsb', type=int, default=1, help='number of swimbladder chambers')
+    parser.add_argument('--six-columns', action='store_true', help='stbd and port columns')
+    parser.add_argument('--formats', nargs='+', default=['new', 'clay'], choices=['new', 'clay'])
+    parser.add_argument('--repeat', type=int, default=3, help='runs per file')
+    parser.add_argument('--json-file', default=str(default_json), help='metadata JSON file')
+    parser.add_argument('--schema', default=str(default_schema), help='schema file')
+    parser.add_argument('--json', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a stage can be slower than the earlier run')
+    args = parser.parse_args(argv)
+
+    results = run(args.npts, args.nsb, args.six_columns, args.formats, args.repeat,
+                  args.json_file, args.schema)
+    display(results)
+
+    if (args.json):
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'results': results}, f, indent=4)
+
+    if (args.compare):
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        slower, unmatched = compare(results, baseline, args.tolerance)
+        for file in unmatched:
+            print(f'NOT COMPARED: {file} is not in {args.compare}')
+        for file, stage, s0, s in slower:
+            print(f'SLOWER: {file} {stage} {1000*s0:.2f} ms -> {1000*s:.2f} ms')
+        if (len(unmatched) == len(results)):
+            print(f'no file was compared to {args.compare}, check --npts and --formats')
+            return 1
+        if (slower):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
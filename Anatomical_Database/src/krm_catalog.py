@@ -0,0 +1,427 @@
+'''
+SQLite catalog of the merged metadata
+
+The catalog has one row per specimen and anatomical feature (and body part) with the fields that
+are used in queries as indexed columns (the WoRMS taxonomic ranks, the anatomical feature, the
+imaging method, the specimen length, ...) and all of the metadata as JSON. The shape_data is
+saved in the row as a BLOB, or as a reference to the toml file or store it came from.
+
+The catalog is filled from toml files, a packed store (krm_store), or merged documents, and
+can be queried without opening the toml files, e.g., all Clupeidae swimbladders from
+radiographs with a specimen length of 200 to 250 mm:
+    catalog = krm_catalog('catalog.sqlite')
+    catalog.add_tomls('/data/toml')
+    rows = catalog.query(specimen_family='Clupeidae', anatomical_feature='swimbladder',
+                         imaging_method='radiograph', specimen_length__between=(200, 250))
+    metadata, arrays = catalog.shape(rows[0]['id'])
+
+Field names are compared for equality. A suffix selects another comparison:
+    __lt, __le, __gt, __ge, __ne, __between (two values), __in (list), __like (SQL pattern)
+Fields that are not columns are read from the JSON metadata.
+
+It can also be used as a local stand-in for the echoSMs datastore, e.g., in tests.
+
+jech
+'''
+
+import sys
+import re
+import json
+import sqlite3
+import argparse
+from pathlib import Path
+import numpy as np
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+from krm_sidecar import split_document, to_document
+
+
+class krm_catalog():
+    # metadata fields that are columns of the catalog. Each has an index
+    indexed_columns = {'specimen_id': 'TEXT',
+                       'anatomical_feature': 'TEXT',
+                       'aphia_id': 'INTEGER',
+                       'specimen_class': 'TEXT',
+                       'specimen_order': 'TEXT',
+                       'specimen_family': 'TEXT',
+                       'specimen_genus': 'TEXT',
+                       'specimen_species': 'TEXT',
+                       'imaging_method': 'TEXT',
+                       'shape_type': 'TEXT',
+                       'model_type': 'TEXT',
+                       'specimen_length': 'REAL',
+                       'specimen_weight': 'REAL',
+                       'date_collection': 'TEXT'}
+    # the unique key of a row, with the NULLs replaced so they are equal
+    unique_key = ("COALESCE(specimen_id, ''), COALESCE(anatomical_feature, ''), "
+                  "COALESCE(aphia_id, -1), part")
+    # comparisons of the query suffixes
+    operators = {'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=', 'ne': '!=', 'like': 'LIKE'}
+
+    def __init__(self, catalogfile):
+        '''
+        Open (or create) the catalog
+
+        Parameters:
+        -----------
+        catalogfile- SQLite file of the catalog. ":memory:" for a catalog in memory
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.catalogfile = catalogfile
+        if (catalogfile != ':memory:'):
+            Path(catalogfile).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(catalogfile))
+        self.db.row_factory = sqlite3.Row
+        columns = ',\n'.join(f'{c} {t}' for c, t in self.indexed_columns.items())
+        self.db.execute(f'''CREATE TABLE IF NOT EXISTS specimens (
+                                id INTEGER PRIMARY KEY,
+                                part TEXT NOT NULL DEFAULT '',
+                                {columns},
+                                metadata TEXT NOT NULL,
+                                shape_ref TEXT,
+                                shape_blob BLOB,
+                                shape_dtype TEXT,
+                                shape_columns TEXT,
+                                shape_length INTEGER,
+                                UNIQUE (specimen_id, anatomical_feature, aphia_id, part))''')
+        for c in self.indexed_columns:
+            self.db.execute(f'CREATE INDEX IF NOT EXISTS idx_{c} ON specimens ({c})')
+        self.__unique_key()
+        self.db.commit()
+
+
+    def __unique_key(self):
+        '''
+        A row is unique by specimen_id, anatomical_feature, aphia_id, and part. SQLite treats
+        NULLs as distinct in a UNIQUE constraint, so a document without an Aphia ID would be
+        added again each time. The unique index is on the keys with the NULLs replaced
+        '''
+
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND "
+                                 "name = 'idx_unique_key'").fetchone()
+        if (exists):
+            return
+        # a catalog made before the index can have duplicates. Keep the last one added
+        self.db.execute(f'DELETE FROM specimens WHERE id NOT IN '
+                        f'(SELECT MAX(id) FROM specimens GROUP BY {self.unique_key})')
+        self.db.execute(f'CREATE UNIQUE INDEX idx_unique_key ON specimens ({self.unique_key})')
+
+
+    def add(self, doc, arrays=None, part='', shape_ref=None, blob=True, commit=True):
+        '''
+        Add (or replace) a merged document
+
+        Parameters:
+        -----------
+        doc- the merged dictionary, e.g., krm_merge_data.krm_data_merged or a toml file read
+             with tomllib. The shape_data arrays can be left out if shape_ref is given
+        arrays- dictionary of the full precision shape_data arrays. Default is the arrays in
+                doc['shape_data']
+        part- the body part label, e.g., to tell apart swimbladder chambers
+        shape_ref- where the shape_data is, e.g., the toml file
+        blob- save the shape_data arrays in the catalog
+        commit- commit the change. Set False to add many documents and call commit()
+
+        Returns:
+        --------
+        the id of the row
+        '''
+
+        metadata, arrays = split_document(doc, arrays)
+        del metadata['sidecar']
+        row = {c: metadata.get(c) for c in self.indexed_columns}
+        row['shape_type'] = metadata.get('shape_data', {}).get('shape_type')
+        # e.g., toml dates are read as datetime.date
+        row = {c: v if isinstance(v, (str, int, float, type(None))) else str(v)
+               for c, v in row.items()}
+        row |= {'part': part, 'metadata': json.dumps(metadata, default=str),
+                'shape_ref': shape_ref,
+                'shape_blob': None, 'shape_dtype': None, 'shape_columns': None,
+                'shape_length': None}
+        lengths = {v.shape for v in arrays.values()}
+        if (blob and len(lengths) == 1 and len(next(iter(lengths))) == 1):
+            block = np.stack(list(arrays.values()))
+            row |= {'shape_blob': block.tobytes(), 'shape_dtype': block.dtype.name,
+                    'shape_columns': json.dumps(list(arrays)), 'shape_length': block.shape[1]}
+
+        cur = self.db.execute(f'INSERT OR REPLACE INTO specimens ({", ".join(row)}) '
+                              f'VALUES ({", ".join("?"*len(row))})', list(row.values()))
+        if (commit):
+            self.db.commit()
+
+        return cur.lastrowid
+
+
+    def add_tomls(self, tomldir, recursive=False, blob=True):
+        '''
+        Add the toml files in a directory. The toml file is the shape_ref of each row
+
+        Parameters:
+        -----------
+        tomldir- directory with the toml files, or a list of toml files
+        recursive- also search the subdirectories
+        blob- save the shape_data arrays in the catalog
+
+        Returns:
+        --------
+        number of files added
+        '''
+
+        if (isinstance(tomldir, (str, Path))):
+            tomldir = Path(tomldir)
+            files = sorted(tomldir.glob('**/*.toml' if recursive else '*.toml'))
+        else:
+            files = [Path(f) for f in tomldir]
+        for tomlfile in files:
+            with open(tomlfile, 'rb') as f:
+                doc = tomllib.load(f)
+            self.add(doc, part=self.__part_of(doc), shape_ref=str(tomlfile), blob=blob,
+                     commit=False)
+        self.db.commit()
+
+        return len(files)
+
+
+    def add_store(self, store, blob=False):
+        '''
+        Add the records of a packed store (krm_store). The shape_ref is "<store file>#<offset>"
+
+        Parameters:
+        -----------
+        store- krm_store or the binary store file
+        blob- also copy the shape_data arrays to the catalog
+
+        Returns:
+        --------
+        number of records added
+        '''
+
+        from krm_store import krm_store
+        if (isinstance(store, (str, Path))):
+            store = krm_store(store)
+        for specimen_id, feature, aphia_id, part in store.keys():
+            record = store.find(specimen_id, feature, aphia_id, part)
+            metadata, arrays = store.get(specimen_id, feature, aphia_id, part)
+            self.add(metadata, arrays if blob else {}, part=part, blob=blob,
+                     shape_ref=f'{store.storefile}#{record["offset"]}', commit=False)
+        self.db.commit()
+
+        return len(store)
+
+
+    @staticmethod
+    def __part_of(doc):
+        '''
+        merge_all adds the body part label to the description
+        '''
+
+        description = doc.get('description', [])
+        if (isinstance(description, list) and description and
+                str(description[-1]).startswith('body part: ')):
+            return description[-1].removeprefix('body part: ')
+        return ''
+
+
+    def __where(self, filters):
+        '''
+        the SQL WHERE clause and parameters of the query filters
+        '''
+
+        clauses = []
+        params = []
+        for key, value in filters.items():
+            field, op = (key.rsplit('__', 1) + [''])[:2] if '__' in key else (key, '')
+            if (field in self.indexed_columns or field == 'part'):
+                column = field
+            elif (re.fullmatch(r'\w+', field)):
+                column = f"json_extract(metadata, '$.{field}')"
+            else:
+                raise ValueError(f'Invalid field name {field}')
+            match op:
+                case '':
+                    clauses.append(f'{column} = ?')
+                    params.append(value)
+                case 'between':
+                    clauses.append(f'{column} BETWEEN ? AND ?')
+                    params += list(value)
+                case 'in':
+                    clauses.append(f'{column} IN ({", ".join("?"*len(value))})')
+                    params += list(value)
+                case _ if op in self.operators:
+                    clauses.append(f'{column} {self.operators[op]} ?')
+                    params.append(value)
+                case _:
+                    raise ValueError(f'Invalid comparison {op} of {field}')
+
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+    def query(self, order_by='specimen_id', limit=None, **filters):
+        '''
+        Find the rows that match the filters
+
+        Parameters:
+        -----------
+        order_by- column to sort the rows by
+        limit- maximum number of rows
+        filters- field=value, e.g., specimen_family='Clupeidae' or
+                 specimen_length__between=(200, 250)
+
+        Returns:
+        --------
+        list of dictionaries with the id, part, shape_ref, and the metadata of each row
+        '''
+
+        where, params = self.__where(filters)
+        if (order_by not in self.indexed_columns and order_by not in ('id', 'part')):
+            raise ValueError(f'Can not order by {order_by}')
+        sql = f'SELECT id, part, shape_ref, metadata FROM specimens{where} ORDER BY {order_by}'
+        if (limit):
+            sql += f' LIMIT {int(limit)}'
+
+        return [{'id': r['id'], 'part': r['part'], 'shape_ref': r['shape_ref']} |
+                json.loads(r['metadata']) for r in self.db.execute(sql, params)]
+
+
+    def count(self, **filters):
+        '''
+        number of rows that match the filters (see query)
+        '''
+
+        where, params = self.__where(filters)
+
+        return self.db.execute(f'SELECT COUNT(*) FROM specimens{where}', params).fetchone()[0]
+
+
+    def shape(self, row_id):
+        '''
+        The metadata and the shape_data arrays of a row
+
+        Parameters:
+        -----------
+        row_id- the id of the row
+
+        Returns:
+        --------
+        the metadata dictionary and a dictionary of the arrays. The arrays are read from the
+        BLOB, or from the shape_ref if there is no BLOB
+        '''
+
+        r = self.db.execute('SELECT * FROM specimens WHERE id = ?', (row_id,)).fetchone()
+        if (r is None):
+            raise KeyError(f'There is no row {row_id} in the catalog')
+        metadata = json.loads(r['metadata'])
+        if (r['shape_blob'] is not None):
+            block = np.frombuffer(r['shape_blob'], dtype=r['shape_dtype'])
+            columns = json.loads(r['shape_columns'])
+            return metadata, dict(zip(columns, block.reshape(len(columns), r['shape_length'])))
+
+        ref = r['shape_ref'] or ''
+        if ('#' in ref):
+            from krm_store import krm_store
+            store = krm_store(ref.split('#')[0])
+            return store.get(r['specimen_id'], r['anatomical_feature'], r['aphia_id'],
+                             r['part'])
+        if (ref.endswith('.toml')):
+            with open(ref, 'rb') as f:
+                metadata, arrays = split_document(tomllib.load(f))
+            del metadata['sidecar']
+            return metadata, arrays
+
+        return metadata, {}
+
+
+    def document(self, row_id):
+        '''
+        The merged document of a row, with the shape_data arrays as lists
+        '''
+
+        return to_document(*self.shape(row_id))
+
+
+    def commit(self):
+        self.db.commit()
+
+
+    def close(self):
+        self.db.close()
+
+
+    def display_dict(self, dictname):
+        '''
+        print a summary of the catalog to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'stats':
+                counts = self.db.execute('SELECT anatomical_feature, COUNT(*) FROM specimens '
+                                         'GROUP BY anatomical_feature').fetchall()
+                print(json.dumps({'rows': self.count(), 'anatomical_feature': dict(counts)},
+                                 indent=4))
+            case _:
+                print('Incorrect dictionary name: select "stats"')
+
+
+def _parse_filter(text):
+    '''
+    field=value from the command line. Numbers are converted and "between" and "in" take
+    comma separated values
+    '''
+
+    key, value = text.split('=', 1)
+    values = []
+    for v in value.split(',') if key.endswith(('__between', '__in')) else [value]:
+        try:
+            values.append(float(v) if '.' in v else int(v))
+        except ValueError:
+            values.append(v)
+
+    return key, values if key.endswith(('__between', '__in')) else values[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and query a catalog of the metadata')
+    parser.add_argument('catalogfile', help='SQLite catalog file')
+    parser.add_argument('--add-toml', nargs='*', default=[], help='toml directories to add')
+    parser.add_argument('--add-store', nargs='*', default=[], help='krm_store files to add')
+    parser.add_argument('--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--no-blob', action='store_true',
+                        help='only save a reference to the shape_data')
+    parser.add_argument('--query', nargs='*', metavar='FIELD=VALUE',
+                        help='e.g., specimen_family=Clupeidae specimen_length__between=200,250')
+    parser.add_argument('--stats', action='store_true', help='print the catalog summary')
+    args = parser.parse_args(argv)
+
+    catalog = krm_catalog(args.catalogfile)
+    for tomldir in args.add_toml:
+        print(f'{catalog.add_tomls(tomldir, args.recursive, not args.no_blob)} toml files '
+              f'added from {tomldir}')
+    for storefile in args.add_store:
+        print(f'{catalog.add_store(storefile, not args.no_blob)} records added from {storefile}')
+    if (args.query is not None):
+        for r in catalog.query(**dict(_parse_filter(q) for q in args.query)):
+            print(f"{r['id']:6d} {r['specimen_id']:20s} {r['anatomical_feature']:12s} "
+                  f"{r.get('specimen_length', '')!s:>8s} {r['part']:24s} {r['shape_ref']}")
+    if (args.stats):
+        catalog.display_dict('stats')
+    catalog.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+'''
+Convert KRM coordinates to echoSMs coordinates with NumPy
+
+The KRM .dat files give each node of a body part as
+    x z-upper z-lower width            (symmetric about the x axis, i.e., y = 0)
+    x z-upper z-lower width stbd port  (nonsymmetric, the body part can "wiggle")
+echoSMs uses the center line (x, y, z) and the 1/2 height and 1/2 width at each node:
+    y = (stbd + port)/2 or 0
+    z = (z-upper + z-lower)/2
+    height = (z-upper - z-lower)/2
+    width = (stbd - port)/2 or width/2
+
+The conversion works on the whole node array of a body part, on a stack of arrays with the same
+number of nodes (e.g., shape (nspecimens, nnodes, ncol)), or on a list of arrays with different
+numbers of nodes. The rounding and the floating point precision are set when the converter is
+created.
+
+jech
+'''
+
+import numpy as np
+
+
+class krm_convert():
+    # the KRM column order when the column names are not given
+    krm_columns = ['x', 'z-upper', 'z-lower', 'width', 'stbd', 'port']
+    # the echoSMs coordinates
+    echosms_columns = ['x', 'y', 'z', 'height', 'width']
+
+    def __init__(self, decimals=5, dtype=np.float64):
+        '''
+        Parameters:
+        -----------
+        decimals- number of decimals to round the echoSMs coordinates to. None does not round.
+                  The default of 5 decimals matches the earlier per-node conversion
+        dtype- floating point precision of the conversion, e.g., np.float64 or np.float32
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.decimals = decimals
+        self.dtype = np.dtype(dtype)
+
+
+    def convert(self, nodes, columns=None, rounded=True):
+        '''
+        Convert KRM nodes to echoSMs coordinates
+
+        Parameters:
+        -----------
+        nodes- array with the KRM coordinates in the last axis, e.g., (nnodes, 4) or
+               (nspecimens, nnodes, 6)
+        columns- the column names of the last axis. Default is the KRM column order
+        rounded- round to the decimals of the converter. False keeps the full precision
+
+        Returns:
+        --------
+        dictionary of arrays x, y, z, height, width. Each array has the shape of nodes without
+        the last axis
+        '''
+
+        nodes = np.asarray(nodes, dtype=self.dtype)
+        if (columns is None or not {'x', 'z-upper', 'z-lower'}.issubset(columns)):
+            columns = self.krm_columns[:nodes.shape[-1]]
+        col = {name: nodes[..., i] for i, name in enumerate(columns)}
+
+        shape_data = {'x': col['x'].copy(),
+                      'z': (col['z-upper'] + col['z-lower'])/2,
+                      'height': (col['z-upper'] - col['z-lower'])/2}
+        if ('stbd' in col and 'port' in col):
+            # nonsymmetric data
+            shape_data['y'] = (col['stbd'] + col['port'])/2
+            shape_data['width'] = (col['stbd'] - col['port'])/2
+        else:
+            # symmetric data
+            shape_data['y'] = np.zeros_like(col['x'])
+            shape_data['width'] = col['width']/2
+
+        if (rounded):
+            shape_data = self.round_coordinates(shape_data)
+
+        return {k: shape_data[k] for k in self.echosms_columns}
+
+
+    def round_coordinates(self, shape_data):
+        '''
+        Round a dictionary of coordinate arrays to the decimals of the converter
+
+        Parameters:
+        -----------
+        shape_data- dictionary of arrays, e.g., the unrounded output of convert
+
+        Returns:
+        --------
+        dictionary of rounded arrays. The arrays are not changed if decimals is None
+        '''
+
+        if (self.decimals is None):
+            return dict(shape_data)
+
+        return {k: self.round(v, self.decimals) for k, v in shape_data.items()}
+
+
+    @staticmethod
+    def round(values, decimals):
+        '''
+        Round the array the same as the Python round() function. np.round scales the values by 
+        10**decimals and can round a value that is just below a half (e.g., 2.963414999...) up,
+        where round() rounds it down. The few values that are that close to a half are rounded
+        with round() so the results match the per-node conversion
+
+        Parameters:
+        -----------
+        values- float array
+        decimals- number of decimals
+
+        Returns:
+        --------
+        rounded float array of the same shape and dtype
+        '''
+
+        out = np.round(values, decimals)
+        scaled = np.abs(values*10.0**decimals)
+        near_half = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-8*np.maximum(scaled, 1.0)
+        if (near_half.any()):
+            out[near_half] = [round(v, decimals) for v in values[near_half].tolist()]
+
+        return out
+
+
+    def convert_many(self, nodes_list, columns=None, rounded=True):
+        '''
+        Convert a list of node arrays that can have different numbers of nodes. The arrays are
+        concatenated, converted in one step, and split again
+
+        Parameters:
+        -----------
+        nodes_list- list of 2-D arrays (nnodes, ncol). All arrays need the same columns
+        columns- the column names. Default is the KRM column order
+        rounded- round to the decimals of the converter
+
+        Returns:
+        --------
+        list of dictionaries of arrays x, y, z, height, width
+        '''
+
+        if (len(nodes_list) == 0):
+            return []
+        split_at = np.cumsum([len(n) for n in nodes_list])[:-1]
+        shape_data = self.convert(np.concatenate(nodes_list), columns, rounded)
+        parts = {k: np.split(v, split_at) for k, v in shape_data.items()}
+
+        return [{k: parts[k][i] for k in parts} for i in range(len(nodes_list))]
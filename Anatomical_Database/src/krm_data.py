@@ -36,25 +36,241 @@ KRM .dat files are text files and come in two types:
 The data are read and organized in a dictionary that follows the echoSMs datastore convention and
 can be converted and exported to the toml format used by echoSMs.
 
+The coordinates of each body part are converted in one step to a 2-D NumPy array with one row per
+node and one column per coordinate. The column names are taken from the header line, e.g.,
+    x z-upper z-lower width [stbd port]
+The original coordinate strings are kept only when requested (keep_strings=True).
+
+The files can be read in one chunk (the default) or streamed (stream=True). A streamed file is 
+read once from top to bottom and the metadata and body parts are returned as they are read 
+(iter_blocks), so the whole file is never held in memory. Files can be given as a file name, an 
+open file object, or "-" for stdin. gzip, bzip2, and xz compressed files are decompressed as 
+they are read.
+
+krm_record is a compact record of one file for surveys of many files. It scans the file once
+for the metadata and the byte offsets of the body parts, and reads and converts the coordinates
+of a body part only when that body part is used:
+    record = krm_record('aherr001.dat')
+    record.data_md
+    record['smoothed swimbladder 0']['nodes']
+
+scan_metadata reads only the metadata: the file is read up to the header line and the comment
+on the last line of a Clay-format file is read from the end of the file (see krm_scan.py for
+directories of files).
+
 jech
 '''
 
 import sys
+import io
+import gzip
+import bz2
+import lzma
+import contextlib
+from itertools import islice
+from collections.abc import Mapping
 from pathlib import Path
 from dataclasses import dataclass, asdict
 import re
 import pprint
 from datetime import datetime
+import numpy as np
+from krm_instrument import instrument
+
+# the patterns are compiled once rather than on every line
+_re_meta_start = re.compile(r'<meta>')
+_re_meta_end = re.compile(r'</meta>')
+_re_title = re.compile(r'^Title')
+_re_fish_length = re.compile(r'^Fish_Length')
+_re_fish_mass = re.compile(r'^Fish_Mass')
+_re_nsb = re.compile(r'^nsb')
+_re_bladder_type = re.compile(r'^Bladder_Type')
+_re_rotated = re.compile(r'^Rotated')
+_re_smooth = re.compile(r'^Smooth')
+_re_straighten = re.compile(r'^straighten')
+_re_images = re.compile(r'^Images')
+_re_preparer = re.compile(r'^Preparer')
+_re_file_created = re.compile(r'^File created')
+_re_fish_length_clay = re.compile(r'fish length')
+_re_fish_mass_clay = re.compile(r'fish mass')
+_re_mm = re.compile(r' mm ')
+_re_cm = re.compile(r' cm ')
+_re_g = re.compile(r' g ')
+_re_kg = re.compile(r' kg ')
+
+# the first bytes of compressed files
+_compressed = {b'\x1f\x8b': lambda f: gzip.GzipFile(fileobj=f),
+               b'BZh': bz2.BZ2File,
+               b'\xfd7zXZ\x00': lzma.LZMAFile}
+
+
+@contextlib.contextmanager
+def open_krm(infn):
+    '''
+    Open a KRM .dat file for reading as text. Compressed files are recognized by their first 
+    bytes, not the suffix, so compressed data piped through stdin are also decompressed
+
+    Parameters:
+    -----------
+    infn: file name (pathlib object or string), "-" for stdin, or an open file object in 
+          text or binary mode
+
+    Returns:
+    --------
+    a text file object. Files that are opened here are closed on exit; file objects that 
+    were passed in (and stdin) are left open
+    '''
+
+    if (isinstance(infn, io.TextIOBase) and infn is not sys.stdin):
+        # already text, nothing to decompress
+        yield infn
+        return
+
+    with open_krm_binary(infn) as raw:
+        f = io.TextIOWrapper(raw)
+        try:
+            yield f
+        finally:
+            # detach so the file objects that were passed in are not closed
+            f.detach()
+
+
+@contextlib.contextmanager
+def open_krm_binary(infn):
+    '''
+    Open a KRM .dat file for reading as bytes, decompressed as in open_krm. The byte offsets
+    of krm_record are offsets in this stream
+
+    Parameters:
+    -----------
+    infn: file name (pathlib object or string), "-" for stdin, or an open file object in 
+          binary mode
+
+    Returns:
+    --------
+    a binary file object. Files that are opened here are closed on exit
+    '''
+
+    owned = None
+    if (infn == '-' or infn is sys.stdin):
+        raw = sys.stdin.buffer
+    elif (hasattr(infn, 'read')):
+        raw = infn
+    else:
+        raw = owned = open(Path(infn), 'rb')
+
+    try:
+        if (not hasattr(raw, 'peek')):
+            raw = io.BufferedReader(raw)
+        head = raw.peek(6)[:6]
+        for magic, decompressor in _compressed.items():
+            if (head.startswith(magic)):
+                raw = decompressor(raw)
+                break
+        yield raw
+    finally:
+        # the decompressors do not close the file they read from
+        if (owned is not None):
+            owned.close()
+
+
+def _last_line(f):
+    '''
+    The last line of a binary file, as readlines()[-1], or None if there are no more lines. A
+    file that can seek is read backwards from the end in blocks until a line end is found
+    '''
+
+    if (isinstance(f, (gzip.GzipFile, bz2.BZ2File, lzma.LZMAFile)) or not f.seekable()):
+        last = None
+        for line in f:
+            last = line
+        return last
+
+    here = f.tell()
+    end = f.seek(0, io.SEEK_END)
+    if (end <= here):
+        return None
+    size = 4096
+    while (True):
+        start = max(here, end - size)
+        f.seek(start)
+        tail = f.read(end - start)
+        # the line end of the last line (if any) is not the start of the line
+        i = tail.rfind(b'\n', 0, len(tail) - 1)
+        if (i >= 0 or start == here):
+            return tail[i+1:]
+        size *= 2
+
+
+def _skip_lines(f, n):
+    '''
+    Skip n lines of a binary file, looking for the line ends in the buffered blocks of the file
+    rather than reading line by line
+
+    Returns:
+    --------
+    the number of bytes skipped
+    '''
+
+    if (not hasattr(f, 'peek')):
+        return sum(len(f.readline()) for i in range(n))
+
+    skipped = 0
+    while (n > 0):
+        block = f.peek(1 << 16)
+        if (not block):
+            break
+        k = block.count(b'\n')
+        if (k < n):
+            end = len(block)
+            n -= k
+        else:
+            end = 0
+            for i in range(n):
+                end = block.index(b'\n', end) + 1
+            n = 0
+        f.read(end)
+        skipped += end
+
+    return skipped
+
+
+def scan_metadata(infn, quiet=False):
+    '''
+    The metadata of a KRM .dat file without reading the coordinates (see krm_data.scan_metadata)
+
+    Parameters:
+    -----------
+    infn: file name (pathlib object or string)
+    quiet: do not print the metadata of a Clay-format file as it is read
+
+    Returns:
+    --------
+    dictionary with the file, newformat, nsb, header, and the metadata dictionary data_md
+    '''
+
+    scan = krm_data(infn, stream=True)
+    scan.scan_metadata(quiet)
+
+    return {'file': str(infn), 'newformat': scan.newformat, 'nsb': scan.nsb,
+            'header': scan.data_bp['header'], 'data_md': scan.data_md}
+
 
 class krm_data():
-    def __init__(self, infn):
+    def __init__(self, infn, keep_strings=False, stream=False):
         '''
         Read the entire data file in one chunk
 
         Parameters:
         -----------
         infn: Input file name with full path. It should be a pathlib object, but will be converted
-              to one if not.
+              to one if not. It can also be an open file object or "-" for stdin. Compressed
+              (.gz, .bz2, .xz) files are decompressed.
+        keep_strings: also keep the coordinate lines as a list of strings in 
+              data_bp[bp]['nodes_str']. This is the format of the nodes in earlier versions.
+        stream: do not read the file now. The file is read once, line by line, by parse() or
+              iter_blocks(). The line index methods (isnewformat, new_meta_to_dict, ...) need
+              the whole file and can not be used with stream=True
 
         Returns:
         --------
@@ -70,18 +286,25 @@ class krm_data():
         self.data_md = {}
         # dictionary for the body part data
         self.data_bp = {}
+        # keep the coordinates as strings as well as the array
+        self.keep_strings = keep_strings
 
         # check whether the filename is a pathlib object. If not set it to one.
-        if (not isinstance(infn, Path)):
+        if (not isinstance(infn, Path) and not hasattr(infn, 'read') and infn != '-'):
             infn = Path(infn)
-        
+        self.infn = infn
+        self.krmdata = None
+        self.nlines = None
+        if (stream):
+            return
+
         # open the file and read the file in one chunk as a list of strings
         try:
-            with open(infn, 'r') as f:
+            with open_krm(infn) as f:
                 self.krmdata = f.readlines()
         except FileNotFoundError:
-            print(f'Error: The file {infn} was not found. Exiting the program')
-            sys.exit()
+            print(f'Error: The file {infn} was not found')
+            raise
 
         # the number of strings (i.e., lines) in the string array (i.e., file)
         self.nlines = len(self.krmdata)
@@ -102,7 +325,7 @@ class krm_data():
         '''
 
         self.idx = idx
-        if (re.fullmatch('<meta>', self.krmdata[self.idx].strip())):
+        if (_re_meta_start.fullmatch(self.krmdata[self.idx].strip())):
             self.newformat = True
         else:
             self.newformat = False
@@ -126,6 +349,211 @@ class krm_data():
         self.idx += increment
 
 
+    def parse(self):
+        '''
+        Read the metadata and all the body parts in one call. This is the same sequence of
+        steps as in make_krm_toml.py and works for both the Clay and new-format files
+
+        Parameters:
+        -----------
+            none- uses self.krmdata, or streams the file if it was not read
+
+        Returns:
+        --------
+            sets self.data_md and self.data_bp
+        '''
+
+        with instrument.stage('read') as s:
+            for block in self.iter_blocks():
+                pass
+            if (instrument.enabled):
+                s.add(nodes=sum(len(v['nodes']) for k, v in self.data_bp.items()
+                                if k != 'header'))
+                if (isinstance(self.infn, Path) and self.infn.exists()):
+                    s.add(bytes_read=self.infn.stat().st_size)
+
+
+    def iter_blocks(self):
+        '''
+        Read the file once from top to bottom and return the metadata and body parts as they 
+        are read. The metadata are returned before the first body part. For Clay-format files the
+        comment on the last line of the file is added to the description of the same metadata 
+        dictionary after the last body part is read.
+
+        Parameters:
+        -----------
+            none- uses self.krmdata if the file was read, otherwise streams the file
+
+        Returns:
+        --------
+            generator of ('meta', self.data_md) and ('bodypart', label, self.data_bp[label])
+        '''
+
+        if (self.krmdata is not None):
+            yield from self.__blocks(iter(self.krmdata))
+            return
+
+        try:
+            with open_krm(self.infn) as f:
+                yield from self.__blocks(f)
+        except FileNotFoundError:
+            print(f'Error: The file {self.infn} was not found')
+            raise
+
+
+    def __blocks(self, lines):
+        '''
+        Parse the lines of a KRM file in one pass
+
+        Parameters:
+        -----------
+            lines: iterator over the lines of the file
+
+        Returns:
+        --------
+            generator, see iter_blocks
+        '''
+
+        first = next(lines)
+        if (_re_meta_start.fullmatch(first.strip())):
+            self.newformat = True
+            for line in lines:
+                tmpstr = line.strip()
+                if (_re_meta_end.fullmatch(tmpstr)):
+                    break
+                self.__new_meta_line(tmpstr)
+            self.data_bp['header'] = next(lines).strip()
+        else:
+            self.newformat = False
+            self.__clay_meta_lines([first] + list(islice(lines, 3)))
+            self.data_bp['header'] = next(lines).strip().replace('"', '')
+        yield 'meta', self.data_md
+
+        # the body parts. the total number of body parts is nsb+1
+        for i in range(self.nsb+1):
+            label = next(lines)
+            npts = int(next(lines).strip().split()[0])
+            bp, bp_dict = self.__lines_to_bp(label, npts, list(islice(lines, npts+1)))
+            yield 'bodypart', bp, bp_dict
+
+        if (not self.newformat):
+            # the comment is the last line of the file
+            last = None
+            for line in lines:
+                last = line
+            if (last is not None):
+                self.__clay_last_line(last)
+
+
+    def scan_metadata(self, quiet=False):
+        '''
+        Read only the metadata, without the coordinates. The file is read up to the header
+        line (after </meta> or the four Clay lines). For Clay-format files the comment on the
+        last line is read from the end of the file, so the coordinates in between are not
+        read. Compressed files can not seek from the end and are read to the end
+
+        Parameters:
+        -----------
+            none- reads self.infn
+            Optional- quiet- do not print the metadata of a Clay-format file as it is read
+
+        Returns:
+        --------
+            sets self.data_md, self.nsb, self.newformat, and self.data_bp['header'] and
+            returns self.data_md
+        '''
+
+        with open_krm_binary(self.infn) as f:
+            first = f.readline()
+            nbytes = len(first)
+            if (_re_meta_start.fullmatch(first.decode().strip())):
+                self.newformat = True
+                for line in f:
+                    nbytes += len(line)
+                    tmpstr = line.decode().strip()
+                    if (_re_meta_end.fullmatch(tmpstr)):
+                        break
+                    self.__new_meta_line(tmpstr)
+                line = f.readline()
+                self.data_bp['header'] = line.decode().strip()
+            else:
+                self.newformat = False
+                lines = [f.readline() for i in range(3)]
+                nbytes += sum(len(line) for line in lines)
+                self.__clay_meta_lines([first.decode()] + [line.decode() for line in lines],
+                                       quiet)
+                line = f.readline()
+                self.data_bp['header'] = line.decode().strip().replace('"', '')
+                last = _last_line(f)
+                if (last is not None):
+                    nbytes += len(last)
+                    self.__clay_last_line(last.decode())
+            nbytes += len(line)
+        instrument.count('read', bytes_read=nbytes)
+
+        return self.data_md
+
+
+    def index_blocks(self):
+        '''
+        Read the metadata and find where the coordinates of each body part are in the file,
+        without converting them (see krm_record). The coordinate lines have no fixed length, so
+        they are still read to count the line ends, but in blocks and without splitting or
+        decoding them. The comment of a Clay-format file is read from the end of the file
+
+        Parameters:
+        -----------
+            none- reads self.infn, which needs to be a file name or a seekable binary file
+
+        Returns:
+        --------
+            sets self.data_md and self.data_bp['header'], and returns a dictionary of
+            {label: (npts, start, end)} with the byte offsets of the coordinate lines of each
+            body part in the (decompressed) file
+        '''
+
+        index = {}
+        with open_krm_binary(self.infn) as f:
+            first = f.readline()
+            pos = len(first)
+            first = first.decode()
+            if (_re_meta_start.fullmatch(first.strip())):
+                self.newformat = True
+                for line in f:
+                    pos += len(line)
+                    tmpstr = line.decode().strip()
+                    if (_re_meta_end.fullmatch(tmpstr)):
+                        break
+                    self.__new_meta_line(tmpstr)
+                line = f.readline()
+                self.data_bp['header'] = line.decode().strip()
+            else:
+                self.newformat = False
+                lines = [f.readline() for i in range(3)]
+                pos += sum(len(line) for line in lines)
+                self.__clay_meta_lines([first] + [line.decode() for line in lines])
+                line = f.readline()
+                self.data_bp['header'] = line.decode().strip().replace('"', '')
+            pos += len(line)
+
+            # the body parts. the total number of body parts is nsb+1
+            for i in range(self.nsb+1):
+                label = f.readline()
+                count = f.readline()
+                npts = int(count.decode().strip().split()[0])
+                start = pos + len(label) + len(count)
+                pos = start + _skip_lines(f, npts+1)
+                index[label.decode().strip().replace('"', '')] = (npts, start, pos)
+
+            if (not self.newformat):
+                # the comment is the last line of the file
+                last = _last_line(f)
+                if (last is not None):
+                    self.__clay_last_line(last.decode())
+
+        return index
+
+
     def __istext(self, txt: str):
         '''
         Determine if the string has meaningful text, i.e., not a line return or empty spaces
@@ -156,51 +584,66 @@ class krm_data():
             self.data_md
         '''
 
-        while(not re.fullmatch('</meta>', self.krmdata[self.idx].strip())):
-            tmpstr = self.krmdata[self.idx].strip()
-            if(self.__istext(tmpstr)):
-                match tmpstr:
-                    case _ if re.match(r"^Title", tmpstr): 
-                        self.data_md.setdefault('description', []).append(
-                                ' '.join(tmpstr.split()[2:])
-                                )
-                    case _ if re.match(r"^Fish_Length", tmpstr): 
-                        self.data_md['specimen_length'] = float(tmpstr.split()[-1])
-                    case _ if re.match(r"^Fish_Mass", tmpstr): 
-                        tmpw = float(tmpstr.split()[-1])
-                        if (tmpw < 0):
-                            tmpw = 0.0
-                        self.data_md['specimen_weight'] = tmpw
-                    case _ if re.match(r"^nsb", tmpstr): 
-                        self.nsb = int(tmpstr.split()[-1])
-                    case _ if re.match(r"^Bladder_Type", tmpstr): 
-                        # put the bladder type in the description 
-                        tmpstr = 'bladder type: '+' '.join(tmpstr.split()[2:])
-                        self.data_md.setdefault('description', []).append(tmpstr)
-                    case _ if re.match(r"^Rotated", tmpstr): 
-                        self.data_md['rotate'] = True
-                        self.data_md['rotate_method'] = ' '.join(tmpstr.split()[2:])
-                    case _ if re.match(r"^Smooth", tmpstr): 
-                        self.data_md['smooth'] = True
-                        self.data_md['smooth_method'] = ' '.join(tmpstr.split()[2:])
-                    case _ if re.match(r"^straighten", tmpstr): 
-                        self.data_md['straighten'] = True
-                        self.data_md['straighten_method'] = ' '.join(tmpstr.split()[2:])
-                    case _ if re.match(r"^Images", tmpstr): 
-                        self.data_md['image_files'] = ' '.join(tmpstr.split()[2:])
-                    case _ if re.match(r"^Preparer", tmpstr): 
-                        tmpstr = 'preparer: '+' '.join(tmpstr.split()[2:])
-                        self.data_md.setdefault('description', []).append(tmpstr)
-                    case _ if re.match(r"^File created", tmpstr): 
-                        tmparr = (' '.join(tmpstr.split()[2:])).split()
-                        tmpdt = datetime.strptime(tmparr[4]+'-'+tmparr[1]+'-'+tmparr[2],
-                                                  '%Y-%b-%d')
-                        self.data_md['date_created'] = tmpdt.strftime("%Y-%m-%d") 
-                    case _:
-                        self.data_md.setdefault('description', []).append(tmpstr)
+        while(not _re_meta_end.fullmatch(self.krmdata[self.idx].strip())):
+            self.__new_meta_line(self.krmdata[self.idx].strip())
             self.idx += 1
 
 
+    def __new_meta_line(self, tmpstr):
+        '''
+        Put one line of the <meta> section into the metadata dictionary
+
+        Parameters:
+        -----------
+            tmpstr: the stripped line
+
+        Returns:
+        --------
+            self.data_md
+        '''
+
+        if(self.__istext(tmpstr)):
+            match tmpstr:
+                case _ if _re_title.match(tmpstr): 
+                    self.data_md.setdefault('description', []).append(
+                            ' '.join(tmpstr.split()[2:])
+                            )
+                case _ if _re_fish_length.match(tmpstr): 
+                    self.data_md['specimen_length'] = float(tmpstr.split()[-1])
+                case _ if _re_fish_mass.match(tmpstr): 
+                    tmpw = float(tmpstr.split()[-1])
+                    if (tmpw < 0):
+                        tmpw = 0.0
+                    self.data_md['specimen_weight'] = tmpw
+                case _ if _re_nsb.match(tmpstr): 
+                    self.nsb = int(tmpstr.split()[-1])
+                case _ if _re_bladder_type.match(tmpstr): 
+                    # put the bladder type in the description 
+                    tmpstr = 'bladder type: '+' '.join(tmpstr.split()[2:])
+                    self.data_md.setdefault('description', []).append(tmpstr)
+                case _ if _re_rotated.match(tmpstr): 
+                    self.data_md['rotate'] = True
+                    self.data_md['rotate_method'] = ' '.join(tmpstr.split()[2:])
+                case _ if _re_smooth.match(tmpstr): 
+                    self.data_md['smooth'] = True
+                    self.data_md['smooth_method'] = ' '.join(tmpstr.split()[2:])
+                case _ if _re_straighten.match(tmpstr): 
+                    self.data_md['straighten'] = True
+                    self.data_md['straighten_method'] = ' '.join(tmpstr.split()[2:])
+                case _ if _re_images.match(tmpstr): 
+                    self.data_md['image_files'] = ' '.join(tmpstr.split()[2:])
+                case _ if _re_preparer.match(tmpstr): 
+                    tmpstr = 'preparer: '+' '.join(tmpstr.split()[2:])
+                    self.data_md.setdefault('description', []).append(tmpstr)
+                case _ if _re_file_created.match(tmpstr): 
+                    tmparr = (' '.join(tmpstr.split()[2:])).split()
+                    tmpdt = datetime.strptime(tmparr[4]+'-'+tmparr[1]+'-'+tmparr[2],
+                                              '%Y-%b-%d')
+                    self.data_md['date_created'] = tmpdt.strftime("%Y-%m-%d") 
+                case _:
+                    self.data_md.setdefault('description', []).append(tmpstr)
+
+
     def clay_meta_to_dict(self):
         '''
         Read the metadata section of the KRM Clay-format file
@@ -215,45 +658,67 @@ class krm_data():
         '''
 
         # the Clay format is always four lines for metadata plus the final line in the file
+        self.__clay_meta_lines(self.krmdata[self.idx:self.idx+4])
+        self.idx += 3
+        # get the last line of the file and add it to the description
+        self.__clay_last_line(self.krmdata[self.nlines-1])
+
+
+    def __clay_meta_lines(self, lines, quiet=False):
+        '''
+        Put the four metadata lines at the top of a Clay-format file into the metadata dictionary
+
+        Parameters:
+        -----------
+            lines: the first four lines of the file
+
+        Returns:
+        --------
+            self.data_md
+        '''
+
         # the 1st line is a title/comment
         self.data_md.setdefault('description', []).append(
-                self.krmdata[self.idx].strip().replace('"', '')
+                lines[0].strip().replace('"', '')
                 )
-        self.idx += 1
         # the 2nd line should be fish length, but confirm
-        tmpstr = self.krmdata[self.idx].strip()
-        if re.search(r"fish length", tmpstr):
+        tmpstr = lines[1].strip()
+        if _re_fish_length_clay.search(tmpstr):
             self.data_md['specimen_length'] = float(tmpstr.split()[-1])
             # the units are in the text
-            if re.search(r" mm ", tmpstr):
+            if _re_mm.search(tmpstr):
                 self.data_md['length_unit'] = 'millimeter'
-            elif re.search(r" cm ", tmpstr):
+            elif _re_cm.search(tmpstr):
                 self.data_md['length_unit'] = 'centimeter'
             else:
                 self.data_md['length_unit'] = 'unknown' 
         # the 3rd line should be fish weight/mass
-        self.idx += 1
-        tmpstr = self.krmdata[self.idx].strip()
-        if re.search(r"fish mass", tmpstr):
+        tmpstr = lines[2].strip()
+        if _re_fish_mass_clay.search(tmpstr):
             tmpw = float(tmpstr.split()[-1])
             if (tmpw < 0):
                 tmpw = 0.0
-            print(f'fish mass: {tmpw}')
+            if (not quiet):
+                print(f'fish mass: {tmpw}')
             self.data_md['specimen_weight'] = tmpw
-        if re.search(r" g ", tmpstr):
+        if _re_g.search(tmpstr):
             self.data_md['specimen_weight_unit'] = 'gram'
-        elif re.search(r" kg ", tmpstr):
+        elif _re_kg.search(tmpstr):
             self.data_md['specimen_weight_unit'] = 'kilogram'
         else:
             self.data_md['specimen_weight_unit'] = 'unknown'
         # the 4th line is the number of inclusions/swimbladders
-        self.idx += 1
-        tmp = self.krmdata[self.idx].strip().split()
+        tmp = lines[3].strip().split()
         self.nsb = int(tmp[-1])
-        # get the last line of the file and add it to the description
-        self.data_md.setdefault('description', []).append(
-                self.krmdata[self.nlines-1].strip().replace('"', '')
-                )
+
+
+    def __clay_last_line(self, line):
+        '''
+        the last line of a Clay-format file is a comment. Add it to the description
+        '''
+
+        self.data_md.setdefault('description', []).append(line.strip().replace('"', ''))
+
 
     def clay_bps_to_dict(self):
         '''
@@ -318,23 +783,88 @@ class krm_data():
             returns self.data_bp
         '''
 
-        # parse the header to match to the coordinates"
-        #self.data_bp['header'] = tmpstr
-        hdrarr = self.data_bp['header'].split()
         # the next sections of data are organized by body part, number of sets of coordinates, and 
         #   the coordinates, each coordinate set is one line
         # body part label, which can have an operation (e.g., smoothed) in the description
-        bp = self.krmdata[self.idx].strip().replace('"', '')
         # the next line is the number of data points
-        self.idx += 1
-        npts = int(self.krmdata[self.idx].strip().split()[0])
-        self.data_bp[bp] = {'npts' : npts}
-        # read the coordinate points. read them as a string and append them to a list 
-        self.idx += 1
-        for i in range(npts+1):
-            tmpstr = self.krmdata[self.idx].strip()
-            self.data_bp[bp].setdefault('nodes', []).append(tmpstr)
-            self.idx += 1
+        npts = int(self.krmdata[self.idx+1].strip().split()[0])
+        # the coordinate points. there are npts+1 lines, i.e., the nodes are numbered 0 to npts
+        self.__lines_to_bp(self.krmdata[self.idx], npts,
+                           self.krmdata[self.idx+2:self.idx+npts+3])
+        self.idx += npts+3
+
+
+    def __lines_to_bp(self, label, npts, lines):
+        '''
+        Put the coordinates of one body part into the body part dictionary
+
+        Parameters:
+        -----------
+            label: the body part label line
+            npts: the number of points given in the file
+            lines: the coordinate lines
+
+        Returns:
+        --------
+            the body part label and its dictionary in self.data_bp
+        '''
+
+        # parse the header to match to the coordinates
+        # the Clay header is comma separated, e.g., "x,   z-upper,   z-lower,   width"
+        hdrarr = self.data_bp['header'].replace(',', ' ').split()
+        bp = label.strip().replace('"', '')
+        if (len(lines) != npts+1):
+            raise ValueError(f'{bp}: expected {npts+1} coordinate lines, found {len(lines)}')
+        nodes, columns = self.nodes_to_array(lines, hdrarr)
+        self.data_bp[bp] = {'npts': npts, 'columns': columns, 'nodes': nodes}
+        if (self.keep_strings):
+            self.data_bp[bp]['nodes_str'] = [l.strip() for l in lines]
+
+        return bp, self.data_bp[bp]
+
+
+    @staticmethod
+    def nodes_to_array(lines, hdrarr):
+        '''
+        Convert the coordinate lines of a body part to a 2-D array in one step
+
+        Parameters:
+        -----------
+            lines: list of strings, one string for each node
+            hdrarr: list of the column names from the header line
+
+        Returns:
+        --------
+            2-D float array with one row per node and the list of column names. The header can
+            have more names than there are columns (e.g., "stbd port" for symmetric data), so 
+            only the names of the columns in the data are returned
+        '''
+
+        ncol = len(lines[0].split()) if lines else len(hdrarr)
+        nodes = np.array(' '.join(lines).split(), dtype=np.float64)
+        if (nodes.size != len(lines)*ncol):
+            raise ValueError(f'The coordinates do not have {ncol} values on every line')
+        nodes = nodes.reshape(len(lines), ncol)
+        columns = hdrarr[:ncol] + [f'column{i}' for i in range(len(hdrarr), ncol)]
+
+        return nodes, columns
+
+
+    def column(self, bp, name):
+        '''
+        Get one coordinate of a body part by the column name in the header
+
+        Parameters:
+        -----------
+            bp: the body part label, e.g., "fish body"
+            name: the column name, e.g., "z-upper"
+
+        Returns:
+        --------
+            1-D float array
+        '''
+
+        return self.data_bp[bp]['nodes'][:, self.data_bp[bp]['columns'].index(name)]
 
 
     def display_dict(self, dictname):
@@ -359,3 +889,169 @@ class krm_data():
                 print('Incorrect dictionary name: select "meta" or "bp"')
 
 
+
+
+class krm_record():
+    # a record per file, so the attributes are slots rather than a dictionary
+    __slots__ = ('infn', 'newformat', 'nsb', 'data_md', 'header', 'index', 'bytes_read',
+                 '_bp', '_view')
+
+    def __init__(self, infn):
+        '''
+        Scan a KRM .dat file once for the metadata and the positions of the body parts. The
+        coordinates of a body part are read and converted only when the body part is used, so
+        a survey of many files that only needs the metadata or one feature does not convert
+        (or keep) the other body parts
+
+        Parameters:
+        -----------
+        infn: file name (pathlib object or string). Compressed files work, but reading a body
+              part decompresses the file up to the body part
+
+        Returns:
+        --------
+        none
+        '''
+
+        if (hasattr(infn, 'read') or infn == '-'):
+            raise ValueError('krm_record needs a file name, the file is read again for each '
+                             'body part')
+        scan = krm_data(infn, stream=True)
+        self.index = scan.index_blocks()
+        self.infn = scan.infn
+        self.newformat = scan.newformat
+        self.nsb = scan.nsb
+        self.data_md = scan.data_md
+        self.header = scan.data_bp['header']
+        # the bytes of coordinates read after the scan
+        self.bytes_read = 0
+        self._bp = {}
+        self._view = None
+
+
+    @property
+    def labels(self):
+        '''
+        The body part labels in the order of the file
+        '''
+
+        return list(self.index)
+
+
+    def body_part(self, label):
+        '''
+        The coordinates of a body part. They are read and converted the first time the body
+        part is used
+
+        Parameters:
+        -----------
+            label: the body part label, e.g., "fish body"
+
+        Returns:
+        --------
+            dictionary with npts, columns, and nodes, as krm_data.data_bp[label]
+        '''
+
+        bp = self._bp.get(label)
+        if (bp is None):
+            npts, start, end = self.index[label]
+            with open_krm_binary(self.infn) as f:
+                f.seek(start)
+                lines = f.read(end - start).decode().splitlines()
+            self.bytes_read += end - start
+            if (len(lines) != npts+1):
+                raise ValueError(f'{label}: expected {npts+1} coordinate lines, found '
+                                 f'{len(lines)}')
+            nodes, columns = krm_data.nodes_to_array(lines,
+                                                     self.header.replace(',', ' ').split())
+            bp = self._bp[label] = {'npts': npts, 'columns': columns, 'nodes': nodes}
+            instrument.count('read', nodes=len(nodes), bytes_read=end - start)
+
+        return bp
+
+
+    def release(self, label=None):
+        '''
+        Drop the coordinates of a body part (or all of them) that were read. They are read
+        again if the body part is used again
+        '''
+
+        if (label is None):
+            self._bp.clear()
+        else:
+            self._bp.pop(label, None)
+
+
+    @property
+    def data_bp(self):
+        '''
+        The body parts as krm_data.data_bp, with the "header" and a dictionary for each body
+        part that is read when it is used, so a krm_record can be merged with krm_merge_data
+        '''
+
+        if (self._view is None):
+            self._view = _body_parts(self)
+
+        return self._view
+
+
+    def __getitem__(self, label):
+        return self.body_part(label)
+
+
+    def __contains__(self, label):
+        return label in self.index
+
+
+    def __iter__(self):
+        return iter(self.index)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def display_dict(self, dictname):
+        '''
+        print the metadata or the body part index to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'meta':
+                pprint.pprint(self.data_md)
+            case 'index':
+                for label, (npts, start, end) in self.index.items():
+                    read = 'read' if label in self._bp else ''
+                    print(f'{label:30s} {npts:6d} nodes  bytes {start}-{end}  {read}')
+            case _:
+                print('Incorrect dictionary name: select "meta" or "index"')
+
+
+class _body_parts(Mapping):
+    '''
+    The data_bp view of a krm_record
+    '''
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, key):
+        if (key == 'header'):
+            return self.record.header
+        return self.record.body_part(key)
+
+    def __iter__(self):
+        yield 'header'
+        yield from self.record.index
+
+    def __len__(self):
+        return len(self.record.index) + 1
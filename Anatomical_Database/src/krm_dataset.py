@@ -0,0 +1,387 @@
+'''
+Build a multi-specimen dataset for the anatomical datastore schema
+
+Schema/anatomical_data_store.json has one document per dataset (e.g., a survey) with the
+dataset metadata and a "specimens" array, where each specimen has its "shapes" (the fish body,
+the swimbladder, ...). This merges many KRM .dat files of one dataset into one such document.
+
+The specimens are written to the output file as they are added, so only one specimen is in
+memory at a time, and a dataset can have thousands of specimens. The dataset metadata are
+taken from the JSON metadata and the merged document of the first specimen, and can be
+replaced with a dataset JSON file. dataset_size is computed when the file is closed from the
+size of the output file (and of the raw .dat and JSON files, as the schema asks for) in MiB.
+
+A .dat or JSON file that can not be read or merged is recorded in the errors and skipped, and
+the file is closed (with dataset_size) even if the build stops, e.g.:
+    with krm_dataset('survey_dataset.json') as dataset:
+        dataset.add_specimen('aherr001.dat', 'Clupea_harengus_bd.json')
+
+The KRM coordinates are in the shape_units of the JSON metadata (usually millimeter) and are
+converted to meters, the units of the schema.
+
+Example:
+    python krm_dataset.py --schema ../Schema/anatomical_data_store.json \
+                          --dataset survey.json --output survey_dataset.json ../Example_Data
+
+jech
+'''
+
+import sys
+import io
+import json
+import argparse
+import contextlib
+from pathlib import Path
+from krm_json import krm_json as kj
+from krm_data import krm_data as kd
+from krm_merge_data import krm_merge_data as km
+
+# scale to meters of the length units
+to_meter = {'millimeter': 0.001, 'centimeter': 0.01, 'meter': 1.0}
+# scale to kilograms of the weight units
+to_kilogram = {'gram': 0.001, 'kilogram': 1.0}
+
+# dataset fields that have the same name in the merged documents
+dataset_fields = ['dataset_id', 'anatomical_category', 'anatomical_feature', 'aphia_id',
+                  'reference', 'activity_name', 'location', 'latitude', 'longitude', 'depth',
+                  'date_collection', 'date_image', 'investigators',
+                  'data_collection_description', 'imaging_method', 'shape_method',
+                  'shape_method_processing', 'model_type', 'sound_speed_method',
+                  'mass_density_method', 'date_last_modified']
+# dataset fields that have another name in the merged documents
+renamed_fields = {'date_first_added': 'date_created',
+                  'note': 'notes',
+                  'class': 'specimen_class',
+                  'order': 'specimen_order',
+                  'family': 'specimen_family',
+                  'genus': 'specimen_genus',
+                  'species': 'specimen_species'}
+# fields of each shape (besides the coordinates)
+shape_fields = ['boundary', 'mass_density', 'sound_speed_compressional', 'sound_speed_shear',
+                'mass_density_ratio', 'sound_speed_ratio', 'youngs_modulus']
+
+
+def dataset_metadata(doc):
+    '''
+    The dataset metadata of a merged document
+
+    Parameters:
+    -----------
+    doc- merged dictionary (e.g., from krm_merge_data.merge_all)
+
+    Returns:
+    --------
+    dictionary of the dataset fields in the document
+    '''
+
+    md = {k: doc[k] for k in dataset_fields if k in doc}
+    md |= {k: doc[v] for k, v in renamed_fields.items() if v in doc}
+    description = doc.get('description')
+    if (isinstance(description, list)):
+        # the first item is the description of the JSON file; the others are per specimen
+        description = description[0] if description else ''
+    if (description is not None):
+        md['description'] = str(description)
+    vernaculars = doc.get('specimen_vernaculars')
+    if (vernaculars):
+        md['vernacular_name'] = vernaculars[0] if isinstance(vernaculars, list) else vernaculars
+    if (md.get('dataset_id') == ''):
+        del md['dataset_id']
+
+    return md
+
+
+def specimen(docs):
+    '''
+    One specimen of the dataset from the merged documents of its body parts
+
+    Parameters:
+    -----------
+    docs- list of the merged documents of the body parts of one specimen
+
+    Returns:
+    --------
+    the specimen dictionary with a shape for each document
+    '''
+
+    doc = docs[0]
+    length_scale = to_meter.get(doc.get('specimen_length_unit'), 1.0)
+    sp = {'specimen_id': str(doc.get('specimen_id', '')),
+          'specimen_condition': doc.get('specimen_condition', 'unknown'),
+          'length': round(doc.get('specimen_length', 0.0)*length_scale, 6),
+          'length_type': doc.get('specimen_length_type', 'unknown'),
+          'shape_type': doc['shape_data']['shape_type']}
+    weight = doc.get('specimen_weight')
+    weight_scale = to_kilogram.get(doc.get('specimen_weight_unit', 'gram'))
+    if (weight and weight > 0 and weight_scale):
+        sp['weight'] = round(weight*weight_scale, 9)
+
+    sp['shapes'] = []
+    for d in docs:
+        scale = to_meter.get(d.get('shape_units'), 1.0)
+        shape = {'name': d.get('anatomical_feature', 'other')}
+        for k, v in d['shape_data'].items():
+            if (k == 'shape_type'):
+                continue
+            if (k in ('x', 'y', 'z', 'height', 'width', 'voxel_size') and scale != 1.0):
+                v = [round(c*scale, 9) for c in v]
+            shape[k] = v
+        shape |= {k: d[k] for k in shape_fields if k in d and k not in shape}
+        sp['shapes'].append(shape)
+
+    return sp
+
+
+class krm_dataset():
+    def __init__(self, outfile, dataset_md=None, schema_file=None, include_raw=True):
+        '''
+        Start a dataset file
+
+        Parameters:
+        -----------
+        outfile- the dataset JSON file
+        dataset_md- dictionary of dataset fields. These replace the fields taken from the first
+                    specimen
+        schema_file- the anatomical datastore schema. If given, the dataset fields and each
+                     specimen are validated as they are written
+        include_raw- include the size of the raw .dat and JSON files in dataset_size
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.outfile = Path(outfile)
+        self.dataset_md = dict(dataset_md or {})
+        self.include_raw = include_raw
+        self.f = None
+        self.nspecimens = 0
+        self.raw_bytes = 0
+        self.errors = []
+        self.failed = []
+        self.summary = None
+        self.specimen_validator = None
+        self.dataset_validator = None
+        if (schema_file):
+            self.__validators(schema_file)
+
+
+    def __validators(self, schema_file):
+        '''
+        validators of one specimen and of the dataset fields without the specimens
+        '''
+
+        from krm_validate import compiled_validator
+        with open(schema_file, 'r') as f:
+            schema = json.load(f)
+        items = schema['properties']['specimens']['items']
+        self.specimen_validator = compiled_validator(
+            {'$schema': schema.get('$schema'), '$defs': schema.get('$defs', {})} | items)
+        dataset_schema = dict(schema)
+        dataset_schema['properties'] = {k: v for k, v in schema['properties'].items()
+                                        if k not in ('specimens', 'dataset_size')}
+        dataset_schema['required'] = [r for r in schema['required']
+                                      if r not in ('specimens', 'dataset_size')]
+        self.dataset_validator = compiled_validator(dataset_schema)
+
+
+    def __check(self, validator, instance, where):
+        if (validator is None):
+            return True
+        errors = [f'{where} {e.json_path}: {e.message[:200]}'
+                  for e in validator.iter_errors(instance)]
+        self.errors += errors
+        for e in errors:
+            print(f'Not valid: {e}')
+
+        return not errors
+
+
+    def __start(self, doc, json_doc):
+        '''
+        write the dataset fields and the start of the specimens array
+        '''
+
+        md = dataset_metadata(doc) | dataset_metadata(json_doc or {}) | self.dataset_md
+        md.setdefault('dataset_id', self.outfile.stem)
+        self.dataset_md = md
+        self.__check(self.dataset_validator, md, 'dataset')
+        self.outfile.parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(self.outfile, 'w')
+        self.f.write(json.dumps(md, indent=4)[:-2] + ',\n    "specimens": [\n')
+
+
+    def add_documents(self, docs, raw_files=(), json_doc=None):
+        '''
+        Write a specimen from the merged documents of its body parts
+
+        Parameters:
+        -----------
+        docs- list of merged documents of one specimen (e.g., the values of
+              krm_merge_data.merge_all)
+        raw_files- the input files of the specimen, for dataset_size
+        json_doc- the JSON metadata of the specimen. For the first specimen, its fields (e.g.,
+                  the description and date_created) are used for the dataset rather than the
+                  fields from the .dat file
+
+        Returns:
+        --------
+        boolean whether the specimen is valid (True if there is no schema)
+        '''
+
+        docs = list(docs)
+        if (not docs):
+            print('No documents for the specimen. Nothing is written')
+            return False
+        if (self.f is None):
+            self.__start(docs[0], json_doc)
+        elif (docs[0].get('aphia_id') != self.dataset_md.get('aphia_id')):
+            print(f"Warning: {docs[0].get('specimen_id')} has the Aphia ID "
+                  f"{docs[0].get('aphia_id')}, the dataset has {self.dataset_md.get('aphia_id')}")
+
+        sp = specimen(docs)
+        valid = self.__check(self.specimen_validator, sp, sp['specimen_id'])
+        if (self.nspecimens):
+            self.f.write(',\n')
+        self.f.write(json.dumps(sp))
+        self.nspecimens += 1
+        if (self.include_raw):
+            self.raw_bytes += sum(Path(r).stat().st_size for r in raw_files)
+
+        return valid
+
+
+    def add_specimen(self, datfile, jsonfile, worms_md=None):
+        '''
+        Read, merge, and write a specimen from its .dat and JSON files
+
+        Parameters:
+        -----------
+        datfile- the KRM .dat file
+        jsonfile- the JSON metadata file
+        worms_md- krm_worms instance with the taxonomic ranks, if any
+
+        Returns:
+        --------
+        boolean whether the specimen is valid
+        '''
+
+        # a file that can not be read or merged is recorded and skipped, so one bad file does
+        # not stop the dataset
+        stage = 'json'
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                json_md = kj(jsonfile)
+                stage = 'read'
+                krm_data = kd(datfile, stream=True)
+                krm_data.parse()
+                stage = 'merge'
+                krm_merge = km(data=krm_data, worms=worms_md, json=json_md, headless=True)
+                docs = krm_merge.merge_all(returndict=True)
+        except Exception as e:
+            error = f'{datfile} {stage}: {type(e).__name__}: {e}'
+            self.errors.append(error)
+            self.failed.append({'dat_file': str(datfile), 'json_file': str(jsonfile),
+                                'stage': stage, 'error_type': type(e).__name__,
+                                'error': str(e)})
+            print(f'Failed: {error}')
+            return False
+
+        return self.add_documents(docs.values(), raw_files=(datfile, jsonfile),
+                                  json_doc=json_md.json_md)
+
+
+    def close(self):
+        '''
+        Finish the specimens array and write dataset_size
+
+        Parameters:
+        -----------
+        none
+
+        Returns:
+        --------
+        dictionary with the number of specimens, dataset_size, the errors (validation and
+        failed files), and the failed files. Closing again returns the same dictionary
+        '''
+
+        if (self.summary is not None):
+            return self.summary
+        if (self.f is None):
+            print('There are no specimens. The dataset was not written')
+            self.summary = {'specimens': 0, 'dataset_size': 0.0, 'errors': self.errors,
+                            'failed': self.failed}
+            return self.summary
+
+        self.f.write('\n    ]')
+        self.f.flush()
+        # the size includes the dataset_size field itself. The field has a fixed number of
+        # decimals, so its length only changes if the number of digits does
+        written = self.f.tell()
+        size = 0.0
+        for i in range(3):
+            tail = f',\n    "dataset_size": {size:.6f}\n}}\n'
+            size = (written + len(tail) + self.raw_bytes)/2**20
+        tail = f',\n    "dataset_size": {size:.6f}\n}}\n'
+        self.f.write(tail)
+        self.f.close()
+        self.f = None
+        self.summary = {'specimens': self.nspecimens, 'dataset_size': float(f'{size:.6f}'),
+                        'errors': self.errors, 'failed': self.failed}
+
+        return self.summary
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        # the specimens that were written are a complete dataset even if the build stops
+        self.close()
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a multi-specimen anatomical dataset')
+    parser.add_argument('datadir', nargs='?', help='directory with the JSON and .dat files')
+    parser.add_argument('--manifest', help='CSV file with the dat_file and json_file columns')
+    parser.add_argument('--output', required=True, help='the dataset JSON file')
+    parser.add_argument('--dataset', help='JSON file with dataset fields')
+    parser.add_argument('--schema', help='anatomical datastore schema to validate to')
+    parser.add_argument('--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--no-raw-size', action='store_true',
+                        help='dataset_size is only the size of the output file')
+    args = parser.parse_args(argv)
+
+    from krm_batch import tasks_from_directory, tasks_from_manifest
+    if (args.manifest):
+        tasks = tasks_from_manifest(args.manifest)
+    elif (args.datadir):
+        tasks, unpaired = tasks_from_directory(args.datadir, recursive=args.recursive)
+    else:
+        parser.error('provide a data directory or --manifest')
+
+    dataset_md = {}
+    if (args.dataset):
+        with open(args.dataset, 'r') as f:
+            dataset_md = json.load(f)
+
+    with krm_dataset(args.output, dataset_md, args.schema, not args.no_raw_size) as dataset:
+        seen = set()
+        for task in tasks:
+            # the same .dat file can be paired with several JSON files (e.g., one per feature)
+            if (task.dat_file in seen):
+                continue
+            seen.add(task.dat_file)
+            dataset.add_specimen(task.dat_file, task.json_file)
+    summary = dataset.close()
+    print(f"{summary['specimens']} specimens, {summary['dataset_size']} MiB, "
+          f"{len(summary['errors']) - len(summary['failed'])} validation errors, "
+          f"{len(summary['failed'])} failed files: {args.output}")
+
+    return 0 if not summary['errors'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+'''
+HTTP client for the WoRMS REST service
+
+The connections are kept open (keep-alive) and reused from a pool, so many lookups do not pay for
+a new connection (and TLS handshake) each time. Requests have a timeout and are retried with a
+backoff on connection errors and on "busy" responses (429, 5xx). Responses are parsed as JSON.
+
+The base URL can be changed, e.g., to a local stand-in server for testing:
+    http = krm_http(base_url='http://127.0.0.1:8000/rest/')
+
+jech
+'''
+
+import json
+import time
+import queue
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+
+
+# errors of a pooled connection that the server closed while it was idle. These are retried
+# on another connection at once. Other errors (e.g., a timeout) are retried with the backoff
+_stale_errors = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class krm_http():
+    # WoRMS returns 204 (no content) or 400 when an Aphia ID or name is not found
+    not_found = (204, 400, 404)
+    # responses that are retried
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url='https://www.marinespecies.org/rest/', timeout=30, retries=3,
+                 backoff=1.0, pool_size=8):
+        '''
+        Parameters:
+        -----------
+        base_url- the URL of the REST service
+        timeout- timeout of a connection or read in seconds
+        retries- number of times a request is retried
+        backoff- seconds to wait before the first retry. The wait doubles for each retry
+        pool_size- maximum number of open connections that are kept for reuse
+
+        Returns:
+        --------
+        none
+        '''
+
+        url = urlsplit(base_url)
+        self.https = (url.scheme == 'https')
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path if url.path.endswith('/') else url.path+'/'
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.stats = {'requests': 0, 'connections': 0, 'retries': 0}
+        self.lock = threading.Lock()
+
+
+    def __count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+    def __connect(self):
+        self.__count('connections')
+        if (self.https):
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+    def __acquire(self):
+        '''
+        returns a connection and whether it was reused from the pool
+        '''
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return self.__connect(), False
+
+
+    def __release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+    def get_json(self, path):
+        '''
+        GET a path relative to the base URL and parse the response as JSON
+
+        Parameters:
+        -----------
+        path- e.g., "AphiaVernacularsByAphiaID/126417"
+
+        Returns:
+        --------
+        the parsed JSON or None if the service has no data for the request
+        '''
+
+        url = self.base_path + quote(path, safe='/?=&')
+        wait = self.backoff
+        attempt = 0
+        while True:
+            conn, reused = self.__acquire()
+            try:
+                self.__count('requests')
+                conn.request('GET', url, headers={'Accept': 'application/json',
+                                                  'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+                body = resp.read()
+                status = resp.status
+                if (resp.will_close):
+                    conn.close()
+                else:
+                    self.__release(conn)
+            except (OSError, http.client.HTTPException) as e:
+                # the connection is not reused after an error
+                conn.close()
+                if (reused and isinstance(e, _stale_errors)):
+                    # the server closed the idle connection. Try again with another one
+                    continue
+                if (attempt == self.retries):
+                    raise ConnectionError(f'GET {url} failed: {e}') from e
+            else:
+                if (status == 200):
+                    return json.loads(body) if body.strip() else None
+                if (status in self.not_found):
+                    return None
+                if (status not in self.retry_status or attempt == self.retries):
+                    raise ConnectionError(f'GET {url} returned status {status}')
+            attempt += 1
+            self.__count('retries')
+            time.sleep(wait)
+            wait *= 2
+
+
+    def close(self):
+        '''
+        Close the pooled connections
+        '''
+
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
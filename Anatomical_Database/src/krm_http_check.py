@@ -0,0 +1,250 @@
+'''
+Check the pooled HTTP client (krm_http) against a local stand-in for the WoRMS REST service
+
+The stand-in is an http.server on 127.0.0.1 with paths that answer the way WoRMS (or a busy
+network) can:
+    ok/<n>          200 with JSON, the connection is kept open
+    empty, bad      204 (no content) and 400, how WoRMS answers an unknown Aphia ID
+    busy/<key>/<n>  429 for the first n requests of the key, then 200
+    fail            500 every time
+    slow            answers after the client timeout, also on a pooled connection
+    drop            200, then the server closes the connection the client keeps for reuse
+and the WoRMS paths that krm_worms uses for one Aphia ID (126417, Atlantic herring). Each check
+prints ok or FAIL and the program exits with 1 if a check fails, so it can be run in CI:
+    python krm_http_check.py
+
+jech
+'''
+
+import sys
+import io
+import json
+import time
+import argparse
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from krm_http import krm_http
+
+# the WoRMS answers for Aphia ID 126417
+worms_paths = {
+    'AphiaClassificationByAphiaID/126417':
+        {'AphiaID': 2, 'rank': 'Kingdom', 'scientificname': 'Animalia',
+         'child': {'AphiaID': 1517375, 'rank': 'Class', 'scientificname': 'Teleostei',
+                   'child': {'AphiaID': 10295, 'rank': 'Order',
+                             'scientificname': 'Clupeiformes',
+                             'child': {'AphiaID': 125464, 'rank': 'Family',
+                                       'scientificname': 'Clupeidae',
+                                       'child': {'AphiaID': 126416, 'rank': 'Genus',
+                                                 'scientificname': 'Clupea',
+                                                 'child': {'AphiaID': 126417,
+                                                           'rank': 'Species',
+                                                           'scientificname':
+                                                               'Clupea harengus',
+                                                           'child': None}}}}}},
+    'AphiaVernacularsByAphiaID/126417':
+        [{'vernacular': 'Atlantic herring', 'language_code': 'eng', 'language': 'English'},
+         {'vernacular': 'hareng', 'language_code': 'fra', 'language': 'French'}]}
+
+
+class _standin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately. Send them without waiting for an ACK
+    disable_nagle_algorithm = True
+    # requests of each busy key
+    busy = {}
+    lock = threading.Lock()
+    delay = 1.0
+
+    def log_message(self, *args):
+        pass
+
+    def __send(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g., on the slow path
+            self.close_connection = True
+
+    def do_GET(self):
+        path = self.path.removeprefix('/rest/')
+        parts = path.split('/')
+        match parts[0]:
+            case 'ok':
+                self.__send(200, {'n': int(parts[1])})
+            case 'empty':
+                self.__send(204)
+            case 'bad':
+                self.__send(400)
+            case 'busy':
+                with self.lock:
+                    n = self.busy[parts[1]] = self.busy.get(parts[1], 0) + 1
+                if (n <= int(parts[2])):
+                    self.__send(429)
+                else:
+                    self.__send(200, {'attempts': n})
+            case 'fail':
+                self.__send(500)
+            case 'slow':
+                time.sleep(self.delay)
+                self.__send(200, {})
+            case 'drop':
+                self.__send(200, {'dropped': True})
+                self.close_connection = True
+            case _:
+                if (path in worms_paths):
+                    self.__send(200, worms_paths[path])
+                else:
+                    self.__send(204)
+
+
+def standin_server():
+    '''
+    Start the stand-in server in a thread
+
+    Returns:
+    --------
+    the server (call shutdown() to stop it) and its base URL
+    '''
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _standin)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/rest/'
+
+
+def _raises(func):
+    try:
+        func()
+    except ConnectionError:
+        return True
+    return False
+
+
+def run_checks(base_url, timeout=0.3):
+    '''
+    Run the checks of krm_http against a stand-in server
+
+    Parameters:
+    -----------
+    base_url- base URL of the stand-in server
+    timeout- timeout of the client in seconds. The slow path answers after 3 times this
+
+    Returns:
+    --------
+    list of (check, passed, detail)
+    '''
+
+    _standin.delay = 3*timeout
+    checks = []
+
+    def client(**kwargs):
+        return krm_http(base_url=base_url, timeout=timeout, backoff=0.01, **kwargs)
+
+    # the connection is reused for the requests
+    http = client()
+    answers = [http.get_json(f'ok/{i}') for i in range(20)]
+    checks.append(('connection reuse', answers == [{'n': i} for i in range(20)] and
+                   http.stats['connections'] == 1, dict(http.stats)))
+    http.close()
+
+    http = client()
+    checks.append(('204 and 400 are not found',
+                   http.get_json('empty') is None and http.get_json('bad') is None and
+                   http.stats['retries'] == 0, dict(http.stats)))
+    http.close()
+
+    http = client(retries=3)
+    answer = http.get_json('busy/a/2')
+    checks.append(('429 is retried with backoff',
+                   answer == {'attempts': 3} and http.stats['retries'] == 2, dict(http.stats)))
+    http.close()
+
+    http = client(retries=2)
+    checks.append(('500 fails after the retries',
+                   _raises(lambda: http.get_json('fail')) and http.stats['requests'] == 3,
+                   dict(http.stats)))
+    http.close()
+
+    http = client(retries=1)
+    start = time.perf_counter()
+    raised = _raises(lambda: http.get_json('slow'))
+    elapsed = time.perf_counter() - start
+    checks.append(('timeout is retried then fails',
+                   raised and http.stats['requests'] == 2 and elapsed < 4*timeout,
+                   dict(http.stats) | {'seconds': round(elapsed, 3)}))
+    http.close()
+
+    # a timeout on a pooled connection is an attempt, not a closed idle connection
+    http = client(retries=1)
+    http.get_json('ok/0')
+    raised = _raises(lambda: http.get_json('slow'))
+    checks.append(('timeout on a pooled connection',
+                   raised and http.stats['requests'] == 3 and http.stats['retries'] == 1,
+                   dict(http.stats)))
+    http.close()
+
+    # the server closes the pooled connection. The next request uses a new connection
+    # without counting a retry
+    http = client()
+    first = http.get_json('drop')
+    second = http.get_json('ok/1')
+    checks.append(('closed pooled connection is replaced',
+                   first == {'dropped': True} and second == {'n': 1} and
+                   http.stats['retries'] == 0 and http.stats['connections'] == 2,
+                   dict(http.stats)))
+    http.close()
+
+    # the threads share the pool, which is never larger than pool_size
+    http = client(pool_size=4)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        answers = list(pool.map(lambda i: http.get_json(f'ok/{i}'), range(200)))
+    checks.append(('threads share the pool',
+                   answers == [{'n': i} for i in range(200)] and
+                   http.pool.qsize() <= 4, dict(http.stats)))
+    http.close()
+
+    # krm_worms looks up the ranks and vernaculars with the client
+    from krm_worms import fetch_many
+    http = client()
+    with contextlib.redirect_stdout(io.StringIO()):
+        found = fetch_many([126417, 1], http=http)
+    md = found[126417]
+    checks.append(('krm_worms lookups',
+                   md is not None and md.get('specimen_family') == 'Clupeidae' and
+                   md.get('specimen_vernaculars') == ['Atlantic herring'] and found[1] is None,
+                   {k: v for k, v in (md or {}).items() if k.startswith('specimen_')}))
+    http.close()
+
+    return checks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check krm_http against a local stand-in '
+                                                 'server')
+    parser.add_argument('--timeout', type=float, default=0.3, help='client timeout in seconds')
+    args = parser.parse_args(argv)
+
+    server, base_url = standin_server()
+    try:
+        checks = run_checks(base_url, args.timeout)
+    finally:
+        server.shutdown()
+
+    failed = False
+    for name, passed, detail in checks:
+        failed = failed or not passed
+        print(f'{name:40s} {"ok" if passed else "FAIL"}  {detail}')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+'''
+Check the import time of the krm_* modules
+
+Short-lived worker processes and command line calls pay the import time of every module on each
+start. This program imports each module in a new interpreter with "python -X importtime" and
+checks that:
+    the cumulative import time is within the budget for the module
+    the heavy packages (matplotlib, jsonschema, toml, pyworms, requests) are not imported until
+    they are used
+It exits with 1 if a check fails, so it can be run as a test in CI:
+    python krm_importtime.py
+    python krm_importtime.py --repeat 5 --scale 2.0   # slower machine
+
+jech
+'''
+
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+
+# cumulative import time budgets in milliseconds. numpy is most of the time for the modules
+# that read, convert, and write the data
+budgets_ms = {'krm_data': 250,
+              'krm_convert': 200,
+              'krm_merge_data': 250,
+              'krm_json': 50,
+              'krm_schema': 50,
+              'krm_worms': 150,
+              'krm_worms_cache': 50,
+              'krm_http': 100,
+              'krm_instrument': 50,
+              'krm_validate': 75,
+              'krm_validate_bulk': 100,
+              'krm_manifest': 50,
+              'krm_toml': 200,
+              'krm_sidecar': 250,
+              'krm_store': 250,
+              'krm_catalog': 250,
+              'krm_dataset': 250,
+              'krm_synthetic': 250,
+              'krm_benchmark': 250,
+              'krm_mesh': 250,
+              'krm_voxel': 250,
+              'krm_resample': 250,
+              'krm_render': 250,
+              'krm_scan': 250,
+              'krm_batch': 400}
+
+# packages that are only imported when they are used
+heavy = ['matplotlib', 'jsonschema', 'toml', 'pyworms', 'requests']
+
+
+def measure(module, repeat=3):
+    '''
+    Import a module in a new interpreter and measure the import time
+
+    Parameters:
+    -----------
+    module- the module name
+    repeat- number of times to import the module. The fastest time is used
+
+    Returns:
+    --------
+    the cumulative import time in milliseconds (None if the module was not in the importtime
+    output) and the list of heavy packages that were imported
+    '''
+
+    srcdir = Path(__file__).resolve().parent
+    code = (f'import {module}, sys; '
+            f'print(",".join(m for m in {heavy!r} if m in sys.modules))')
+    best = None
+    loaded = []
+    for i in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=srcdir,
+                              capture_output=True, text=True, check=True)
+        # the line for the module itself has the cumulative time in microseconds
+        cumulative = None
+        for line in proc.stderr.splitlines():
+            fields = [f.strip() for f in line.split('|')]
+            if (len(fields) == 3 and fields[2] == module):
+                cumulative = int(fields[1])/1000
+        if (cumulative is None):
+            return None, []
+        best = cumulative if best is None else min(best, cumulative)
+        loaded = [m for m in proc.stdout.strip().split(',') if m]
+
+    return best, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the import time of the krm modules')
+    parser.add_argument('modules', nargs='*', default=list(budgets_ms),
+                        help='modules to check (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of imports per module')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets')
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f'{"module":16s} {"ms":>8s} {"budget":>8s}  heavy imports')
+    for module in args.modules:
+        ms, loaded = measure(module, args.repeat)
+        budget = budgets_ms.get(module, 100)*args.scale
+        if (ms is None):
+            failed = True
+            print(f'{module:16s} {"-":>8s} {budget:8.1f}  no import time for the module  FAIL')
+            continue
+        ok = (ms <= budget and not loaded)
+        failed = failed or not ok
+        print(f'{module:16s} {ms:8.1f} {budget:8.1f}  {",".join(loaded) or "-"}'
+              + ('' if ok else '  FAIL'))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+'''
+Stage timers and counters for the ingestion pipeline
+
+The krm classes time their stages and count what they do with the module instance
+"instrument":
+    read        krm_data.parse: bytes read (of the file on disk) and nodes
+    worms       krm_worms lookups: requests to WoRMS, cache hits and misses
+    merge       krm_merge_data.merge_dicts and merge_all: body parts and nodes
+    validate    krm_validate.validate and validate_many: documents and invalid documents
+    toml        krm_toml.write_toml and data_to_toml_file: bytes written
+Each call of a stage is a record with the wall time, the CPU time of the thread, the counters,
+and the specimen that was being processed in the thread (set with instrument.specimen()). The
+records can be summarized by stage or by specimen and written as JSON lines or as a Prometheus
+text file (for the node exporter textfile collector), e.g., with krm_batch:
+    python krm_batch.py --schema ../Schema/echoSMs_datastore_schema.json \
+                        --instrument metrics.jsonl --prometheus metrics.prom ../Example_Data
+    python krm_instrument.py metrics.jsonl
+
+The instrumentation is off unless it is enabled with instrument.enable() or the KRM_INSTRUMENT
+environment variable is set. When it is off, a stage is a shared object that does nothing and a
+timed function is one extra call, so the cost is negligible.
+
+jech
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import functools
+
+
+class _null_stage():
+    '''
+    The stage when the instrumentation is off
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_null = _null_stage()
+
+
+class _stage():
+    '''
+    One call of a stage. It is added to the records when it exits
+    '''
+    __slots__ = ('owner', 'record', 'wall', 'cpu')
+
+    def __init__(self, owner, name, counters):
+        self.owner = owner
+        self.record = {'stage': name, 'specimen': owner.current_specimen} | counters
+
+    def add(self, **counters):
+        for k, v in counters.items():
+            self.record[k] = self.record.get(k, 0) + v
+
+    def __enter__(self):
+        self.owner._stack().append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.record['wall'] = time.perf_counter() - self.wall
+        self.record['cpu'] = time.thread_time() - self.cpu
+        if (exc_type is not None):
+            self.record['errors'] = self.record.get('errors', 0) + 1
+        self.owner._stack().pop()
+        self.owner.records.append(self.record)
+        return False
+
+
+class krm_instrument():
+    # the fields of a record that are not counters
+    fields = ('stage', 'specimen', 'wall', 'cpu')
+
+    def __init__(self, enabled=False):
+        '''
+        Parameters:
+        -----------
+        enabled- record the stages
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.enabled = enabled
+        self.records = []
+        self._local = threading.local()
+
+
+    @property
+    def current_specimen(self):
+        '''
+        the specimen of this thread (set with specimen())
+        '''
+
+        return getattr(self._local, 'specimen', '')
+
+
+    @current_specimen.setter
+    def current_specimen(self, name):
+        self._local.specimen = name
+
+
+    def _stack(self):
+        '''
+        the open stages of this thread
+        '''
+
+        if (not hasattr(self._local, 'stack')):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def enable(self, enabled=True):
+        '''
+        Turn the instrumentation on or off
+        '''
+
+        self.enabled = enabled
+
+
+    def stage(self, name, **counters):
+        '''
+        Time a stage:
+            with instrument.stage('read') as s:
+                ...
+                s.add(nodes=233)
+
+        Parameters:
+        -----------
+        name- the stage
+        counters- initial counters of the record
+
+        Returns:
+        --------
+        context manager with an add(**counters) method
+        '''
+
+        if (not self.enabled):
+            return _null
+
+        return _stage(self, name, counters)
+
+
+    def count(self, name, **counters):
+        '''
+        Add to the counters of a stage. The counters are added to the innermost open call of
+        the stage in this thread, or are a record of their own if the stage is not open
+
+        Parameters:
+        -----------
+        name- the stage
+        counters- the increments, e.g., cache_hits=1
+
+        Returns:
+        --------
+        none
+        '''
+
+        if (not self.enabled):
+            return
+        for s in reversed(self._stack()):
+            if (s.record['stage'] == name):
+                s.add(**counters)
+                return
+        self.records.append({'stage': name, 'specimen': self.current_specimen} | counters)
+
+
+    def specimen(self, name):
+        '''
+        Set the specimen of the records in a with block. The specimen is set for this thread,
+        so threads started in the block need to set it too:
+            with instrument.specimen('aherr001'):
+                ...
+        '''
+
+        return _specimen(self, name)
+
+
+    def drain(self):
+        '''
+        Remove and return the records, e.g., to send them from a worker process
+        '''
+
+        records = self.records
+        self.records = []
+
+        return records
+
+
+    def extend(self, records):
+        '''
+        Add records, e.g., from a worker process
+        '''
+
+        self.records.extend(records)
+
+
+    def reset(self):
+        self.records = []
+
+
+    def summary(self, by='stage'):
+        '''
+        The totals of the records
+
+        Parameters:
+        -----------
+        by- "stage", "specimen", or "both" (keyed by (stage, specimen))
+
+        Returns:
+        --------
+        dictionary of {key: {calls, wall, cpu, counters...}}
+        '''
+
+        totals = {}
+        for r in self.records:
+            match by:
+                case 'stage':
+                    key = r['stage']
+                case 'specimen':
+                    key = r['specimen']
+                case 'both':
+                    key = (r['stage'], r['specimen'])
+                case _:
+                    raise ValueError(f'Incorrect summary {by}: select "stage", "specimen", '
+                                     f'or "both"')
+            t = totals.setdefault(key, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            if ('wall' in r):
+                t['calls'] += 1
+            for k, v in r.items():
+                if (k not in ('stage', 'specimen') and isinstance(v, (int, float))):
+                    t[k] = t.get(k, 0) + v
+
+        return totals
+
+
+    def write_jsonl(self, jsonlfile, append=False):
+        '''
+        Write the records as JSON lines
+        '''
+
+        with open(jsonlfile, 'a' if append else 'w') as f:
+            for r in self.records:
+                f.write(json.dumps(r)+'\n')
+
+
+    def read_jsonl(self, jsonlfile):
+        '''
+        Add the records of a JSON lines file
+        '''
+
+        with open(jsonlfile, 'r') as f:
+            self.records.extend(json.loads(line) for line in f if line.strip())
+
+
+    def prometheus(self, prefix='krm'):
+        '''
+        The totals by stage in the Prometheus text format. The specimens are not labels, so the
+        number of series does not grow with the number of specimens
+
+        Returns:
+        --------
+        the text
+        '''
+
+        totals = self.summary('stage')
+        names = {'calls': ('calls_total', 'Number of calls of the stage'),
+                 'wall': ('wall_seconds_total', 'Wall time of the stage'),
+                 'cpu': ('cpu_seconds_total', 'CPU time of the stage')}
+        counters = sorted({k for t in totals.values() for k in t} - set(names))
+        lines = []
+        for k in list(names) + counters:
+            metric, text = names.get(k, (f'{k}_total', f'Total {k} of the stage'))
+            metric = f'{prefix}_{metric}'
+            lines.append(f'# HELP {metric} {text}')
+            lines.append(f'# TYPE {metric} counter')
+            for stage, t in sorted(totals.items()):
+                if (k in t):
+                    lines.append(f'{metric}{{stage="{stage}"}} {t[k]:.9g}')
+
+        return '\n'.join(lines)+'\n'
+
+
+    def write_prometheus(self, promfile, prefix='krm'):
+        '''
+        Write the Prometheus text file. It is written to a temporary file that replaces the
+        file, so a collector does not read a partial file
+        '''
+
+        tmpfile = f'{promfile}.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmpfile, promfile)
+
+
+    def display_dict(self, dictname):
+        '''
+        print the totals to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'stage' | 'specimen':
+                totals = self.summary(dictname)
+                wall = sum(t['wall'] for t in totals.values()) or 1.0
+                for key, t in totals.items():
+                    counters = ', '.join(f'{k} {v:g}' for k, v in t.items()
+                                         if k not in ('calls', 'wall', 'cpu'))
+                    print(f"{key:20s} {t['calls']:6d} calls {t['wall']:10.4f} s wall "
+                          f"({100*t['wall']/wall:5.1f}%) {t['cpu']:10.4f} s cpu  {counters}")
+            case 'records':
+                for r in self.records:
+                    print(r)
+            case _:
+                print('Incorrect dictionary name: select "stage", "specimen", or "records"')
+
+
+class _specimen():
+    __slots__ = ('owner', 'name', 'previous')
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = str(name)
+
+    def __enter__(self):
+        self.previous = self.owner.current_specimen
+        self.owner.current_specimen = self.name
+        return self
+
+    def __exit__(self, *exc):
+        self.owner.current_specimen = self.previous
+        return False
+
+
+# the instrumentation of the krm classes
+instrument = krm_instrument(enabled=bool(os.environ.get('KRM_INSTRUMENT')))
+
+
+def timed(name):
+    '''
+    Decorator that times each call of a function as a stage
+    '''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if (not instrument.enabled):
+                return func(*args, **kwargs)
+            with _stage(instrument, name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize instrumentation JSON lines files')
+    parser.add_argument('jsonlfiles', nargs='+', help='JSON lines files of records')
+    parser.add_argument('--by', default='stage', choices=['stage', 'specimen'],
+                        help='summarize by stage or by specimen')
+    parser.add_argument('--prometheus', help='write the totals as a Prometheus text file')
+    args = parser.parse_args(argv)
+
+    totals = krm_instrument()
+    for jsonlfile in args.jsonlfiles:
+        totals.read_jsonl(jsonlfile)
+    totals.display_dict(args.by)
+    if (args.prometheus):
+        totals.write_prometheus(args.prometheus)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,7 +5,6 @@ TBD: get metadata another way (e.g., keyboard input)
 jech
 '''
 
-import sys
 from pathlib import Path
 import json
 import pprint
@@ -42,8 +41,8 @@ class krm_json():
                 with open(jsonfile, 'r') as f:
                     self.json_md = json.load(f)
             except FileNotFoundError:
-                print(f'Error: The file {jsonfile} was not found. Exiting the program')
-                sys.exit() 
+                print(f'Error: The file {jsonfile} was not found')
+                raise
         else:
             # methods to get metadata
             print('No JSON file provided. Metadata are generated via ...')
@@ -0,0 +1,280 @@
+'''
+Build manifest for incremental rebuilds
+
+The manifest is a JSON file with, for each toml file that krm_batch built, the content hashes
+(SHA-256) of the inputs:
+    the .dat file and the JSON metadata file
+    the schema file
+    the code (the krm_*.py modules that krm_batch imports)
+    the batch options that change the output (e.g., --all-features, --sidecar)
+and of the output files. A re-run only rebuilds the toml files whose inputs changed or whose
+outputs are missing or changed, and a dry run lists the files that would be rebuilt and why:
+    python krm_batch.py --schema ../Schema/echoSMs_datastore_schema.json \
+                        --build-manifest build.json --dry-run ../Example_Data
+
+The hash of a file is reused while its size and modification time are the same as when it was
+hashed, so unchanged files are not read again.
+
+jech
+'''
+
+import os
+import ast
+import json
+import time
+import hashlib
+from pathlib import Path
+
+# the module that runs the pipeline. The modules whose code changes the output are the krm
+# modules it imports, directly or through other krm modules
+pipeline_module = 'krm_batch'
+# the size of the blocks that are hashed
+block_size = 1 << 20
+
+
+def file_hash(path):
+    '''
+    SHA-256 of the content of a file
+    '''
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while (block := f.read(block_size)):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def code_modules(module=pipeline_module):
+    '''
+    The krm modules that a module imports, directly or through other krm modules, including
+    the imports inside functions
+
+    Parameters:
+    -----------
+    module- module name in this directory
+
+    Returns:
+    --------
+    sorted list of the module names, including module
+    '''
+
+    srcdir = Path(__file__).resolve().parent
+    found = set()
+    todo = [module]
+    while (todo):
+        name = todo.pop()
+        if (name in found or not (srcdir / (name+'.py')).is_file()):
+            continue
+        found.add(name)
+        tree = ast.parse((srcdir / (name+'.py')).read_bytes())
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Import)):
+                todo.extend(a.name for a in node.names if a.name.startswith('krm_'))
+            elif (isinstance(node, ast.ImportFrom) and node.level == 0 and node.module and
+                  node.module.startswith('krm_')):
+                todo.append(node.module)
+
+    return sorted(found)
+
+
+def code_version(modules=None):
+    '''
+    Hash of the source of the modules of the pipeline
+
+    Parameters:
+    -----------
+    modules- module names in this directory. Default is code_modules()
+
+    Returns:
+    --------
+    SHA-256 of the sources
+    '''
+
+    if (modules is None):
+        modules = code_modules()
+    srcdir = Path(__file__).resolve().parent
+    h = hashlib.sha256()
+    for module in sorted(modules):
+        h.update(module.encode('utf-8'))
+        h.update((srcdir / (module+'.py')).read_bytes())
+
+    return h.hexdigest()
+
+
+def options_hash(options):
+    '''
+    Hash of a dictionary of options
+    '''
+
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class krm_manifest():
+    def __init__(self, manifestfile):
+        '''
+        Read the manifest, or start a new one if the file does not exist
+
+        Parameters:
+        -----------
+        manifestfile- the manifest JSON file
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.manifestfile = Path(manifestfile)
+        self.entries = {}
+        # (size, mtime) and hash of the files, so unchanged files are hashed once
+        self.stats = {}
+        if (self.manifestfile.exists()):
+            with open(self.manifestfile, 'r') as f:
+                manifest = json.load(f)
+            self.entries = manifest.get('entries', {})
+            self.stats = manifest.get('stats', {})
+        self.hashed = 0
+
+
+    def hash(self, path):
+        '''
+        The hash of a file, reused if the size and modification time are unchanged
+
+        Parameters:
+        -----------
+        path- the file
+
+        Returns:
+        --------
+        SHA-256 of the file, or None if the file does not exist
+        '''
+
+        key = str(Path(path).resolve())
+        try:
+            st = os.stat(key)
+        except FileNotFoundError:
+            return None
+        stat = [st.st_size, st.st_mtime_ns]
+        cached = self.stats.get(key)
+        if (cached and cached['stat'] == stat):
+            return cached['sha256']
+        digest = file_hash(key)
+        self.hashed += 1
+        self.stats[key] = {'stat': stat, 'sha256': digest}
+
+        return digest
+
+
+    def inputs(self, task, schema_file, code, options):
+        '''
+        The hashes of the inputs of a task
+
+        Parameters:
+        -----------
+        task- krm_task
+        schema_file- the schema file
+        code- the code version (code_version())
+        options- the hash of the batch options (options_hash())
+
+        Returns:
+        --------
+        dictionary of the input hashes
+        '''
+
+        return {'dat_file': self.hash(task.dat_file),
+                'json_file': self.hash(task.json_file),
+                'schema': self.hash(schema_file),
+                'code': code,
+                'options': options}
+
+
+    def reasons(self, task, inputs):
+        '''
+        Why a task needs to be built
+
+        Parameters:
+        -----------
+        task- krm_task
+        inputs- the input hashes from inputs()
+
+        Returns:
+        --------
+        list of reasons. An empty list means that the outputs are up to date
+        '''
+
+        entry = self.entries.get(str(task.toml_file))
+        if (entry is None):
+            return ['not built before']
+        reasons = [f'{k} changed' for k, v in inputs.items() if entry['inputs'].get(k) != v]
+        for output, digest in entry['outputs'].items():
+            current = self.hash(output)
+            if (current is None):
+                reasons.append(f'{output} is missing')
+            elif (current != digest):
+                reasons.append(f'{output} changed')
+
+        return reasons
+
+
+    def record(self, task, inputs, status, outputs):
+        '''
+        Save the inputs and outputs of a task that was built
+
+        Parameters:
+        -----------
+        task- krm_task
+        inputs- the input hashes from inputs()
+        status- status of the result ("ok" or "invalid")
+        outputs- list of the output files
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.entries[str(task.toml_file)] = {'dat_file': str(task.dat_file),
+                                             'json_file': str(task.json_file),
+                                             'status': status,
+                                             'built': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                             'inputs': inputs,
+                                             'outputs': {str(o): self.hash(o) for o in outputs}}
+
+
+    def forget(self, task):
+        '''
+        Remove a task, e.g., after an error, so it is built again
+        '''
+
+        self.entries.pop(str(task.toml_file), None)
+
+
+    def save(self):
+        '''
+        Write the manifest. It is written to a temporary file that replaces the manifest
+        '''
+
+        self.manifestfile.parent.mkdir(parents=True, exist_ok=True)
+        tmpfile = self.manifestfile.with_suffix('.tmp')
+        with open(tmpfile, 'w') as f:
+            json.dump({'entries': self.entries, 'stats': self.stats}, f, indent=1)
+        os.replace(tmpfile, self.manifestfile)
+
+
+    def display_dict(self, dictname):
+        '''
+        print the manifest entries to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'entries':
+                print(json.dumps(self.entries, indent=4))
+            case _:
+                print('Incorrect dictionary name: select "entries"')
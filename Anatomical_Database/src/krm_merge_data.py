@@ -1,24 +1,43 @@
 '''
 Merge the KRM dictionaries
 
+merge_dicts merges the body part requested by "anatomical_feature" in the JSON metadata.
+merge_all merges every body part in the data file (e.g., the fish body and each swimbladder
+chamber) in one pass and returns one document per body part. The metadata shared by the
+documents is merged once and the coordinates of all body parts are converted together.
+
+matplotlib is only imported when a plot is requested. In headless mode (headless=True) the
+plots are skipped and matplotlib is never imported.
+
 jech
 '''
 
 import sys
 import pprint
 import re
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import figure, show, subplots_adjust, get_cmap, cm
 import numpy as np
+from krm_convert import krm_convert
+from krm_instrument import instrument, timed
 
 class krm_merge_data():
-    def __init__(self, data=None, worms=None, json=None):
+    # anatomical feature of a body part label in the data file. The labels are searched in
+    # this order, e.g., "fish body", "fishbody", "swimbladder chamber 1", "swimbladder 0"
+    feature_patterns = [('swimbladder', 'swimbladder|bladder'),
+                        ('backbone', 'backbone|spine'),
+                        ('body', 'body')]
+
+    def __init__(self, data=None, worms=None, json=None, decimals=5, dtype=np.float64,
+                 headless=False):
         '''
         references to other dictionaries are passed as arguments
 
         Parameters:
         -----------
         dictionaries to merge
+        Optional: decimals- number of decimals to round the echoSMs coordinates to. None does
+                            not round
+                  dtype- floating point precision of the coordinate conversion
+                  headless- do not plot (and do not import matplotlib)
 
         Returns:
         --------
@@ -30,6 +49,13 @@ class krm_merge_data():
         self.add_json = False
         self.add_worms = False
         self.add_data = False
+        self.headless = headless
+        # converts the KRM coordinates to echoSMs coordinates
+        self.converter = krm_convert(decimals=decimals, dtype=dtype)
+        # the echoSMs coordinates at full precision (before rounding), e.g., for a binary
+        # sidecar file. shape_arrays for merge_dicts and shape_arrays_all for merge_all
+        self.shape_arrays = {}
+        self.shape_arrays_all = {}
 
         if (json):
             self.json_ref = json
@@ -42,6 +68,7 @@ class krm_merge_data():
             self.add_data = True
 
 
+    @timed('merge')
     def merge_dicts(self, returndict=False):
         '''
         # merge the dictionaries one at a time
@@ -70,6 +97,9 @@ class krm_merge_data():
             # the KRM data files usually have data for more than one body part. Use the 
             # data metadata to get the body part and merge those
             bp = self.__get_anatomical_feature()
+            # the shape_data of the body part. It stays empty if no body part can be merged
+            dict_out = {}
+            matches = []
             if (bp):
                 header = ''
                 tmp_dict = {}
@@ -78,135 +108,166 @@ class krm_merge_data():
                     if re.search('header', k):
                         header = self.data_ref.data_bp[k]
                     if re.search(bp, k):
-                        tmp_dict = { 'data': self.data_ref.data_bp[k]['nodes'] }
-                # tmp_dict should be a list of strings. each string is a coordinate.
+                        matches.append(k)
+                        tmp_dict = { 'data': self.data_ref.data_bp[k]['nodes'],
+                                     'columns': self.data_ref.data_bp[k].get('columns') }
+            if (not bp):
+                print(f'The requested anatomical feature was not found. No data will be added')
+            elif (not matches):
+                print(f'No body part in the data file matches {bp}. No data will be added')
+            else:
+                if (len(matches) > 1):
+                    print(f'Warning: {len(matches)} body parts match {bp}: {matches}. '
+                          f'Only {matches[-1]} is merged. Use merge_all for every body part')
+                # tmp_dict is a 2-D array with one row per node.
                 # convert these to the toml coordinates of x, y, z, height, and width
-                npts = len(tmp_dict['data'])
+                npts = tmp_dict['data'].shape[0]
                 # get the specimen length unit and scaler to convert to meters
                 self.__get_specimen_length_unit()
                 # the KRM data can be symmetric about the x-axis, i.e., the body part only has
                 # width with the center at y=0, or it can "wiggle". For the former, there are
-                # no stbd and port coordinates and there are only four values in each string.
+                # no stbd and port coordinates and there are only four columns.
                 # for the "wiggley" data, there are stbd and port coordinates and there are
-                # six coordinates per string.
-                tmp = tmp_dict['data'][0].split()
-                if (len(tmp) == 4):
-                    # symmetric data
-                    dict_out = self.__symmetric_data(tmp_dict)
-                elif (len(tmp) == 6):
-                    # nonsymmetric data
-                    dict_out = self.__nonsymmetric_data(tmp_dict)
+                # six columns.
+                ncol = tmp_dict['data'].shape[1]
+                if (ncol == 4 or ncol == 6):
+                    dict_out = self.__convert_data(tmp_dict)
+                    instrument.count('merge', body_parts=1, nodes=npts)
                 else:
-                    print(f'number of coordintes is {len(tmp)}. Unable to load data')
-            else:
-                print(f'The requested anatomical feature was not found. No data will be added')
+                    print(f'number of coordintes is {ncol}. Unable to load data')
             self.krm_data_merged = dict_out | self.krm_data_merged
             #print('MERGED')
             #pprint.pprint(self.krm_data_merged)
 
 
-    def __symmetric_data(self, dict_in):
+    @timed('merge')
+    def merge_all(self, features=None, returndict=False):
         '''
-        read the KRM coordinates for symmetrical dorsal-view (about the x axis) data
-        convert the KRM coordinates to echoSMs coordinates (x, y, z, height, width)
-        put the new coordinates into a dictionary to return
+        Merge every body part in the data file. The JSON, WoRMS, and data metadata are merged
+        once and shared by the documents. Each document has the shape_data of one body part and
+        its anatomical feature (see feature_patterns), and the body part label is added to the
+        description
 
         Parameters:
         -----------
-        data dictionary with KRM coordintes 
+        Optional - features: list of anatomical features to merge, e.g., ['swimbladder'].
+                             Default is all of them
+                   returndict will return the dictionary
 
         Returns:
         --------
-        dictionary with the coordinates in echoSMs format
+        sets self.krm_data_merged_all, a dictionary of the merged documents keyed by the body
+        part label. The documents share the nested metadata objects, so copy a document
+        before changing them. The dictionary is returned if requested
         '''
 
-        # I leave the original KRM coordinates as they are in the data file and will use 
-        # echoSMs tools to do the coordinate conversion.
-        # in echoSMs, x, y, and z are the center line and height and width are the
-        # 1/2 total height and width. This makes the outlines symmetric with respect
-        # to the center line
-        x = []
-        y = []
-        z = []
-        height = []
-        width = []
-        for l in dict_in['data']:
-            crds = [float(x) for x in l.split()]
-            x.append(round(crds[0], 5))
-            y.append(0.0)
-            z_center = (crds[1]+crds[2])/2
-            z.append(round(z_center, 5))
-            half_height = (crds[1]-crds[2])/2
-            height.append(round(half_height, 5))
-            half_width = crds[3]/2
-            width.append(round(half_width, 5))
+        self.krm_data_merged_all = {}
+        if (not self.add_data):
+            print('There are no data to merge')
+            return self.krm_data_merged_all if returndict else None
 
+        # the shared metadata in the same order of precedence as merge_dicts
+        base = {}
+        if (self.add_json):
+            base = base | self.json_ref.json_md
+        if (self.add_worms):
+            base = self.worms_ref.worms_md | base
+        base = base | self.data_ref.data_md
+        self.__get_specimen_length_unit()
         shape_type = self.__get_shape_type()
-        if (shape_type):
-            dict_out = {'shape_data': {
-                            'shape_type': shape_type,
-                            'x': x,
-                            'y': y,
-                            'z': z,
-                            'height': height,
-                            'width': width
-                           }
-                        }
-        else:
-            dict_out = {}
+        if (not shape_type):
             print('Shape type not valid. Can not merge the data!')
+            return self.krm_data_merged_all if returndict else None
+
+        labels = []
+        for k in self.data_ref.data_bp.keys():
+            if (k == 'header'):
+                continue
+            feature = self.feature_of(k)
+            if (features and feature not in features):
+                continue
+            # the body part is only read here (e.g., from a krm_record) if it is merged
+            ncol = self.data_ref.data_bp[k]['nodes'].shape[1]
+            if (ncol != 4 and ncol != 6):
+                print(f'{k}: number of coordintes is {ncol}. Unable to load data')
+                continue
+            labels.append((k, feature))
+
+        # body parts with the same columns are converted together
+        groups = {}
+        for k, feature in labels:
+            groups.setdefault(tuple(self.data_ref.data_bp[k]['columns']), []).append(k)
+        self.shape_arrays_all = {}
+        for columns, keys in groups.items():
+            converted = self.converter.convert_many([self.data_ref.data_bp[k]['nodes']
+                                                     for k in keys], list(columns), rounded=False)
+            self.shape_arrays_all |= dict(zip(keys, converted))
+        crds = {k: self.converter.round_coordinates(v) for k, v in self.shape_arrays_all.items()}
+
+        description = base.get('description', [])
+        if (not isinstance(description, list)):
+            description = [description]
+        for k, feature in labels:
+            shape_data = {'shape_type': shape_type} | {c: v.tolist() for c, v in crds[k].items()}
+            self.krm_data_merged_all[k] = {'shape_data': shape_data} | base | \
+                                          {'anatomical_feature': feature,
+                                           'description': description + [f'body part: {k}']}
+        if (instrument.enabled):
+            instrument.count('merge', body_parts=len(labels),
+                             nodes=sum(len(v['x']) for v in self.shape_arrays_all.values()))
+
+        return self.krm_data_merged_all if returndict else None
+
+
+    @classmethod
+    def feature_of(cls, label):
+        '''
+        The anatomical feature of a body part label
 
-        return dict_out
+        Parameters:
+        -----------
+        label- the body part label in the data file, e.g., "swimbladder chamber 1"
+
+        Returns:
+        --------
+        the anatomical feature, or "other" if the label is not recognized
+        '''
+
+        for feature, pattern in cls.feature_patterns:
+            if (re.search(pattern, label, re.IGNORECASE)):
+                return feature
 
+        return 'other'
 
-    def __nonsymmetric_data(self, dict_in):
+
+    def __convert_data(self, dict_in):
         '''
-        read the KRM coordinates for nonsymmetrical dorsal-view (about the x axis) data
-        these data have stbd and port coordinates
-        convert the KRM coordinates to echoSMs coordinates (x, y, z, height, width)
+        convert the KRM coordinates to echoSMs coordinates (x, y, z, height, width) for 
+        symmetrical (about the x axis) and nonsymmetrical (stbd and port) data
         put the new coordinates into a dictionary to return
 
         Parameters:
         -----------
-        data dictionary with KRM coordintes 
+        data dictionary with the KRM coordinates array and the column names
 
         Returns:
         --------
         dictionary with the coordinates in echoSMs format
         '''
 
-        x = []
-        y = []
-        z = []
-        height = []
-        width = []
-        for l in dict_in['data']:
-            crds = [float(x) for x in l.split()]
-            # I leave the original KRM coordinates as they are in the data file and will use 
-            # echoSMs tools to do the coordinate conversion.
-            # in echoSMs, x, y, and z are the center line and height and width are the
-            # 1/2 total height and width. This makes the outlines symmetric with respect
-            # to the center line
-            x.append(round(crds[0], 5))
-            y_center = (crds[4]+crds[5])/2
-            y.append(round(y_center, 5))
-            z_center = (crds[1]+crds[2])/2
-            z.append(round(z_center, 5))
-            half_height = (crds[1]-crds[2])/2
-            height.append(round(half_height, 5))
-            half_width = (crds[4]-crds[5])/2
-            width.append(round(half_width, 5))
+        # I leave the original KRM coordinates as they are in the data file and will use 
+        # echoSMs tools to do the coordinate conversion.
+        # in echoSMs, x, y, and z are the center line and height and width are the
+        # 1/2 total height and width. This makes the outlines symmetric with respect
+        # to the center line
+        self.shape_arrays = self.converter.convert(dict_in['data'], dict_in.get('columns'),
+                                                   rounded=False)
+        crds = self.converter.round_coordinates(self.shape_arrays)
 
         shape_type = self.__get_shape_type()
         if (shape_type):
-            dict_out = {'shape_data': {
-                            'shape_type': shape_type,
-                            'x': x,
-                            'y': y,
-                            'z': z,
-                            'height': height,
-                            'width': width
-                           }
+            dict_out = {'shape_data': {'shape_type': shape_type} |
+                                      {k: v.tolist() for k, v in crds.items()}
                         }
         else:
             dict_out = {}
@@ -314,19 +375,34 @@ class krm_merge_data():
                 print('Incorrect dictionary name: select "data"')
 
 
-    def plot_silhouette(self, dictname):
+    def plot_silhouette(self, dictname, outfile=None):
         '''
         plot the outlines
 
         Parameters:
         -----------
         'data' to plot the data 
+        Optional- outfile- write the plot to a PNG or SVG file without a display, also in
+                  headless mode (see krm_render)
 
         Returns:
         --------
            none
         '''
 
+        if (outfile is not None and dictname == 'data'):
+            from krm_render import krm_render
+            fmt = 'svg' if str(outfile).lower().endswith('.svg') else 'png'
+            krm_render(fmt=fmt).render(self.krm_data_merged, outfile)
+            return
+
+        if (self.headless):
+            print('Headless mode. The silhouette is not plotted')
+            return
+
+        # matplotlib is slow to import, so it is only imported when it is used
+        import matplotlib.pyplot as plt
+
         match dictname:
             case 'data':
                 #pprint.pprint(self.krm_data_merged, sort_dicts=True)
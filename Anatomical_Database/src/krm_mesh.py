@@ -0,0 +1,260 @@
+'''
+Convert outline shape_data to a triangulated surface (shape_type "surface")
+
+The outline gives, at each node along x, the center line (x, y, z) and the 1/2 width and 1/2
+height of the body part. The surface has an elliptical cross-section at each node with nseg
+vertices around it:
+    y = y_c + width*cos(theta)
+    z = z_c + height*sin(theta)
+Neighbouring cross-sections are joined with two triangles per segment and the ends are closed
+with a fan of triangles (the caps). Nodes with zero width and height (e.g., the tip of the
+snout and tail) are one vertex, and nodes with only a zero width (or height) are a line of
+vertices (the mirrored vertices are one vertex), so the surface closes there without a cap. A
+zero width with a non-zero height needs an even nseg. The facets are ordered so the normals
+point outwards.
+
+The vertices, facets, and normals are computed with array operations for all the nodes and
+segments at once, e.g., 2000 nodes and 256 segments (10^6 facets) take about a second.
+
+    mesh = krm_mesh(nseg=64).mesh(doc['shape_data'])
+    doc_surface = krm_mesh(nseg=64).surface_document(doc)
+
+Example:
+    python krm_mesh.py aherr001_body.toml aherr001_body_surface.toml --nseg 64
+
+jech
+'''
+
+import sys
+import argparse
+import numpy as np
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+
+class krm_mesh():
+    def __init__(self, nseg=32, caps=True, decimals=None):
+        '''
+        Parameters:
+        -----------
+        nseg- number of vertices (segments) around each cross-section
+        caps- close the ends that have a non-zero cross-section
+        decimals- number of decimals to round the vertices and normals to in the document.
+                  None does not round
+
+        Returns:
+        --------
+        none
+        '''
+
+        if (nseg < 3):
+            raise ValueError('nseg needs to be at least 3')
+        self.nseg = nseg
+        self.caps = caps
+        self.decimals = decimals
+
+
+    def mesh(self, shape_data):
+        '''
+        Triangulate an outline
+
+        Parameters:
+        -----------
+        shape_data- dictionary with the x, y, z, height, and width arrays of an outline
+
+        Returns:
+        --------
+        dictionary of arrays: vertices (nvert, 3), facets (nfacet, 3) of zero-based vertex
+        indices, and normals (nfacet, 3) of unit length
+        '''
+
+        x, y, z, h, w = (np.asarray(shape_data[k], dtype=np.float64)
+                         for k in ('x', 'y', 'z', 'height', 'width'))
+        n = len(x)
+        nseg = self.nseg
+        if (n < 2):
+            raise ValueError('The outline needs at least 2 nodes')
+
+        theta = 2*np.pi*np.arange(nseg)/nseg
+        ring = np.empty((n, nseg, 3))
+        ring[:, :, 0] = x[:, None]
+        ring[:, :, 1] = y[:, None] + w[:, None]*np.cos(theta)
+        ring[:, :, 2] = z[:, None] + h[:, None]*np.sin(theta)
+        vertices = ring.reshape(-1, 3)
+
+        # the vertex index of each ring vertex. The vertices of a ring with zero width and
+        # height are all the first vertex of the ring
+        index = np.arange(n*nseg).reshape(n, nseg)
+        point = (w == 0) & (h == 0)
+        index[point] = index[point, :1]
+        # a ring with zero width (or height) alone is a line. Its vertices mirrored about the
+        # line (theta -> pi - theta, or theta -> -theta) are at the same position and are one
+        # vertex, so the surface closes there without a cap
+        j = np.arange(nseg)
+        zflat = (h == 0) & ~point
+        yflat = (w == 0) & ~point
+        if (yflat.any() and nseg % 2):
+            raise ValueError('An outline with a zero width and a non-zero height needs an '
+                             'even nseg')
+        for flat, mirror in ((zflat, (-j) % nseg), (yflat, (nseg//2 - j) % nseg)):
+            index[flat] = np.minimum(index[flat], index[flat][:, mirror])
+        flat = zflat | yflat
+
+        # two triangles between each pair of neighbouring rings
+        a = index[:-1]
+        b = np.roll(index[:-1], -1, axis=1)
+        c = index[1:]
+        d = np.roll(index[1:], -1, axis=1)
+        facets = [np.stack([a, b, c], axis=-1).reshape(-1, 3),
+                  np.stack([b, d, c], axis=-1).reshape(-1, 3)]
+
+        # the caps. The center of the cross-section is a new vertex
+        if (self.caps):
+            extra = []
+            for i, first in ((0, True), (n-1, False)):
+                if (point[i] or flat[i]):
+                    continue
+                center = len(vertices) + len(extra)
+                extra.append([x[i], y[i], z[i]])
+                j0 = index[i]
+                j1 = np.roll(index[i], -1)
+                cc = np.full(nseg, center)
+                # the first cap faces back along x and the last one forward
+                facets.append(np.stack([cc, j1, j0] if first else [cc, j0, j1], axis=-1))
+            if (extra):
+                vertices = np.vstack([vertices, extra])
+        facets = np.concatenate(facets)
+
+        # drop the degenerate triangles (at the point nodes) and the unused vertices
+        keep = ((facets[:, 0] != facets[:, 1]) & (facets[:, 1] != facets[:, 2]) &
+                (facets[:, 0] != facets[:, 2]))
+        facets = facets[keep]
+        used, facets = np.unique(facets, return_inverse=True)
+        facets = facets.reshape(-1, 3)
+        vertices = vertices[used]
+
+        normals = np.cross(vertices[facets[:, 1]] - vertices[facets[:, 0]],
+                           vertices[facets[:, 2]] - vertices[facets[:, 0]])
+        area = np.linalg.norm(normals, axis=1)
+        # triangles with no area, e.g., where the width or the height alone is zero
+        keep = area > 0
+        facets = facets[keep]
+        normals = normals[keep]/area[keep, None]
+
+        # the facets are ordered for x increasing along the outline. Flip them otherwise
+        if (x[-1] < x[0]):
+            facets = facets[:, ::-1]
+            normals = -normals
+
+        return {'vertices': vertices, 'facets': facets, 'normals': normals}
+
+
+    @staticmethod
+    def check(mesh):
+        '''
+        Check that a mesh is closed and the normals point outwards
+
+        Parameters:
+        -----------
+        mesh- the dictionary from mesh()
+
+        Returns:
+        --------
+        dictionary with whether each edge is shared by exactly two facets (closed), the
+        enclosed volume (positive if the normals point outwards), and the surface area
+        '''
+
+        v = mesh['vertices']
+        f = mesh['facets']
+        edges = np.sort(np.concatenate([f[:, [0, 1]], f[:, [1, 2]], f[:, [2, 0]]]), axis=1)
+        counts = np.unique(edges, axis=0, return_counts=True)[1]
+        p0, p1, p2 = v[f[:, 0]], v[f[:, 1]], v[f[:, 2]]
+        volume = np.einsum('ij,ij->i', p0, np.cross(p1, p2)).sum()/6
+        area = np.linalg.norm(np.cross(p1 - p0, p2 - p0), axis=1).sum()/2
+
+        return {'closed': bool(np.all(counts == 2)), 'volume': float(volume),
+                'area': float(area), 'vertices': len(v), 'facets': len(f)}
+
+
+    def shape_data(self, outline, mesh=None):
+        '''
+        The surface shape_data of an outline, in the schema format
+
+        Parameters:
+        -----------
+        outline- dictionary with the x, y, z, height, and width arrays
+        mesh- the mesh of the outline from mesh(), if it was already made
+
+        Returns:
+        --------
+        shape_data dictionary with shape_type "surface", the vertices x, y, z, the facets_0,
+        facets_1, facets_2, and normals_x, normals_y, normals_z as lists
+        '''
+
+        m = self.mesh(outline) if mesh is None else mesh
+        v = m['vertices']
+        normals = m['normals']
+        if (self.decimals is not None):
+            v = np.round(v, self.decimals)
+            normals = np.round(normals, self.decimals)
+
+        return {'shape_type': 'surface',
+                'x': v[:, 0].tolist(), 'y': v[:, 1].tolist(), 'z': v[:, 2].tolist(),
+                'facets_0': m['facets'][:, 0].tolist(),
+                'facets_1': m['facets'][:, 1].tolist(),
+                'facets_2': m['facets'][:, 2].tolist(),
+                'normals_x': normals[:, 0].tolist(),
+                'normals_y': normals[:, 1].tolist(),
+                'normals_z': normals[:, 2].tolist()}
+
+
+    def surface_document(self, doc, mesh=None):
+        '''
+        A copy of a merged document with the outline replaced by the surface
+
+        Parameters:
+        -----------
+        doc- merged dictionary with outline shape_data
+        mesh- the mesh of the outline from mesh(), if it was already made
+
+        Returns:
+        --------
+        the merged dictionary with the surface shape_data
+        '''
+
+        if (doc['shape_data'].get('shape_type', 'outline') != 'outline'):
+            raise ValueError(f"The shape_type is {doc['shape_data']['shape_type']}, not outline")
+        out = {'shape_data': self.shape_data(doc['shape_data'], mesh)} | \
+              {k: v for k, v in doc.items() if k != 'shape_data'}
+        if ('shape_type' in out):
+            out['shape_type'] = 'surface'
+
+        return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert an outline toml file to a surface')
+    parser.add_argument('infile', help='toml file with outline shape_data')
+    parser.add_argument('outfile', help='toml file for the surface')
+    parser.add_argument('--nseg', type=int, default=32, help='segments around each section')
+    parser.add_argument('--no-caps', action='store_true', help='leave the ends open')
+    parser.add_argument('--decimals', type=int, default=None, help='decimals of the vertices')
+    args = parser.parse_args(argv)
+
+    from krm_toml import write_toml
+    with open(args.infile, 'rb') as f:
+        doc = tomllib.load(f)
+    mesher = krm_mesh(args.nseg, not args.no_caps, args.decimals)
+    mesh = mesher.mesh(doc['shape_data'])
+    out = mesher.surface_document(doc, mesh)
+    print(krm_mesh.check(mesh))
+    with open(args.outfile, 'w') as f:
+        write_toml(out, f)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
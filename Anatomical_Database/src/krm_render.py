@@ -0,0 +1,439 @@
+'''
+Render the outlines of many specimens to image files for visual QA
+
+krm_merge_data.plot_silhouette opens a new window for each specimen. This renders the dorsal and
+lateral views of the outlines (the body and its inclusions, e.g., the swimbladder) without a
+display, with the Agg backend:
+    one image (PNG or SVG) per specimen
+    contact sheets, pages of rows x columns specimens
+The figure, its axes, and the lines are made once and reused for each specimen by updating the
+line data and the axis limits, which is much faster than making a new figure each time. The
+specimens are rendered across a pool of worker processes, each with its own figure.
+
+The toml files (e.g., from krm_batch --all-features) of the same specimen_id are drawn together.
+
+    rd = krm_render(fmt='png')
+    rd.render(krm_merge.merge_all(returndict=True).values(), 'aherr001.png')
+
+Example:
+    python krm_render.py --outdir qa --sheet --rows 5 --cols 4 --workers 8 /data/toml
+
+jech
+'''
+
+import os
+import re
+import sys
+import argparse
+from pathlib import Path
+import numpy as np
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+# the renderer of each worker process
+_worker = {}
+_re_specimen_id = re.compile(r'^specimen_id\s*=\s*"([^"]*)"')
+
+
+def outline(doc):
+    '''
+    The outline of a merged document
+
+    Parameters:
+    -----------
+    doc- merged dictionary with outline shape_data
+
+    Returns:
+    --------
+    dictionary of the x, y, z, height, and width arrays, or None if the shape_data are not an
+    outline
+    '''
+
+    sd = doc.get('shape_data', {})
+    if (sd.get('shape_type', 'outline') != 'outline' or 'x' not in sd):
+        return None
+
+    return {k: np.asarray(sd[k], dtype=np.float64) for k in ('x', 'y', 'z', 'height', 'width')}
+
+
+def outlines_of(docs):
+    '''
+    The outlines of the documents of a specimen, without duplicates (e.g., the same body part
+    from the body and the swimbladder JSON files)
+    '''
+
+    docs = [docs] if isinstance(docs, dict) else list(docs)
+    outlines = {}
+    for o in map(outline, docs):
+        if (o is not None):
+            outlines.setdefault(b''.join(v.tobytes() for v in o.values()), o)
+
+    return list(outlines.values())
+
+
+def specimen_of(tomlfile):
+    '''
+    The specimen_id of a toml file from krm_toml or krm_batch. The top-level keys are written
+    before the tables, so only the start of the file is read. Default is the file name
+    '''
+
+    with open(tomlfile, 'r') as f:
+        for line in f:
+            if (line.startswith('[')):
+                break
+            m = _re_specimen_id.match(line)
+            if (m):
+                return m.group(1)
+
+    return Path(tomlfile).stem
+
+
+def group_files(tomlfiles):
+    '''
+    Group toml files by specimen_id
+
+    Parameters:
+    -----------
+    tomlfiles- list of toml files
+
+    Returns:
+    --------
+    dictionary of {specimen_id: [toml files]} in the order of the files
+    '''
+
+    groups = {}
+    for tomlfile in tomlfiles:
+        groups.setdefault(specimen_of(tomlfile), []).append(str(tomlfile))
+
+    return groups
+
+
+def read_docs(tomlfiles):
+    '''
+    Read the documents of a specimen, the body first
+    '''
+
+    docs = []
+    for tomlfile in tomlfiles:
+        with open(tomlfile, 'rb') as f:
+            docs.append(tomllib.load(f))
+
+    return sorted(docs, key=lambda d: d.get('anatomical_feature') != 'body')
+
+
+class krm_render():
+    # colors of the upper and lower lines of the body and of the inclusions
+    body_colors = ('red', 'blue')
+    inclusion_colors = ('darkorange', 'green')
+
+    def __init__(self, fmt='png', dpi=100, figsize=(9, 9), nrows=5, ncols=4, lim_pct=0.1):
+        '''
+        Parameters:
+        -----------
+        fmt- image format, "png" or "svg"
+        dpi- resolution of the PNG images
+        figsize- size of the image of one specimen in inches
+        nrows, ncols- specimens per contact sheet
+        lim_pct- the margin around the outlines as a fraction of their size
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.fmt = fmt
+        self.dpi = dpi
+        self.figsize = figsize
+        self.nrows = nrows
+        self.ncols = ncols
+        self.lim_pct = lim_pct
+        # a fast zlib level for the PNG images. Rendering is about 20% faster than with the
+        # default level and the files are about 10% larger
+        self.save_kwargs = {'pil_kwargs': {'compress_level': 1}} if fmt == 'png' else {}
+        self.fig = None
+        self.sheet = None
+
+
+    def __new_figure(self, figsize):
+        # matplotlib is slow to import, so it is only imported when it is used. The Figure is
+        # drawn by the Agg canvas without pyplot, so there is no window or global state
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+
+        return fig
+
+
+    @staticmethod
+    def __lines(ax, pool, n):
+        '''
+        at least n sets of (center, upper, lower) lines on an axes
+        '''
+
+        while (len(pool) < n):
+            inclusion = len(pool) > 0
+            colors = krm_render.inclusion_colors if inclusion else krm_render.body_colors
+            pool.append((ax.plot([], [], linestyle='dotted' if inclusion else 'dashed',
+                                 color='gray' if inclusion else None)[0],
+                         ax.plot([], [], linewidth=2, color=colors[0])[0],
+                         ax.plot([], [], linewidth=2, color=colors[1])[0]))
+
+        return pool
+
+
+    def __draw(self, axes, pools, outlines):
+        '''
+        update the lines and limits of a dorsal and a lateral axes
+        '''
+
+        for ax, pool, (c, d) in zip(axes, pools, (('y', 'width'), ('z', 'height'))):
+            self.__lines(ax, pool, len(outlines))
+            for i, lines in enumerate(pool):
+                visible = i < len(outlines)
+                for line in lines:
+                    line.set_visible(visible)
+                if (visible):
+                    o = outlines[i]
+                    lines[0].set_data(o['x'], o[c])
+                    lines[1].set_data(o['x'], o[c] + o[d])
+                    lines[2].set_data(o['x'], o[c] - o[d])
+        if (outlines):
+            xmin = min(o['x'].min() for o in outlines)
+            xmax = max(o['x'].max() for o in outlines)
+            ordinate = max(max((np.abs(o['y']) + o['width']).max(),
+                               (np.abs(o['z']) + o['height']).max()) for o in outlines)
+            ordinate += ordinate*self.lim_pct
+            margin = (xmax - xmin)*self.lim_pct/2
+            for ax in axes:
+                # the head is at x = 0, on the right, as in plot_silhouette
+                ax.set_xlim(xmax + margin, xmin - margin)
+                ax.set_ylim(-ordinate, ordinate)
+
+
+    def render(self, docs, outfile, title=None):
+        '''
+        Render the outlines of one specimen
+
+        Parameters:
+        -----------
+        docs- the merged documents of the body parts of the specimen (or one document)
+        outfile- the image file. The format is fmt
+        title- title of the image. Default is the specimen_id
+
+        Returns:
+        --------
+        the image file, or None if there are no outlines
+        '''
+
+        docs = [docs] if isinstance(docs, dict) else list(docs)
+        outlines = outlines_of(docs)
+        if (not outlines):
+            print(f'No outlines to render for {outfile}')
+            return None
+
+        if (self.fig is None):
+            self.fig = self.__new_figure(self.figsize)
+            self.axes = self.fig.subplots(nrows=2, ncols=1)
+            self.fig.subplots_adjust(hspace=0.3)
+            self.pools = ([], [])
+            self.axes[0].set_title('Dorsal View')
+            self.axes[1].set_title('Lateral View')
+            self.suptitle = self.fig.suptitle('')
+        units = docs[0].get('shape_units', '')
+        for ax, c in zip(self.axes, ('y', 'z')):
+            ax.set_xlabel(f'x [{units}]')
+            ax.set_ylabel(f'{c} [{units}]')
+        self.suptitle.set_text(title if title is not None else
+                               str(docs[0].get('specimen_id', Path(outfile).stem)))
+        self.__draw(self.axes, self.pools, outlines)
+        self.fig.savefig(outfile, format=self.fmt, dpi=self.dpi, **self.save_kwargs)
+
+        return str(outfile)
+
+
+    def contact_sheet(self, specimens, outfile, title=''):
+        '''
+        Render a page of specimens, a dorsal and a lateral view for each
+
+        Parameters:
+        -----------
+        specimens- list of (name, docs) of at most nrows*ncols specimens
+        outfile- the image file. The format is fmt
+        title- title of the page
+
+        Returns:
+        --------
+        the image file
+        '''
+
+        if (len(specimens) > self.nrows*self.ncols):
+            raise ValueError(f'A page has at most {self.nrows*self.ncols} specimens')
+        if (self.sheet is None):
+            self.sheet = self.__new_figure((3*self.ncols, 2.2*self.nrows))
+            grid = self.sheet.add_gridspec(2*self.nrows, self.ncols, hspace=0.05, wspace=0.05)
+            self.cells = []
+            for i in range(self.nrows*self.ncols):
+                r, c = divmod(i, self.ncols)
+                axes = (self.sheet.add_subplot(grid[2*r, c]),
+                        self.sheet.add_subplot(grid[2*r+1, c]))
+                for ax in axes:
+                    ax.set_xticks([])
+                    ax.set_yticks([])
+                label = axes[0].text(0.02, 0.95, '', transform=axes[0].transAxes,
+                                     fontsize=7, va='top')
+                self.cells.append((axes, ([], []), label))
+            self.sheet_title = self.sheet.suptitle('')
+        self.sheet_title.set_text(title)
+
+        for i, (axes, pools, label) in enumerate(self.cells):
+            outlines = []
+            if (i < len(specimens)):
+                name, docs = specimens[i]
+                outlines = outlines_of(docs)
+                label.set_text(name)
+            else:
+                label.set_text('')
+            for ax in axes:
+                ax.set_visible(bool(outlines))
+            self.__draw(axes, pools, outlines)
+        self.sheet.savefig(outfile, format=self.fmt, dpi=self.dpi, **self.save_kwargs)
+
+        return str(outfile)
+
+
+def _init_worker(opts):
+    _worker['renderer'] = krm_render(**opts)
+
+
+def _render_task(task):
+    '''
+    Render one specimen ("specimen", name, files, outfile) or one page ("sheet",
+    [(name, files)], outfile, title) in a worker
+
+    Returns:
+    --------
+    the image file and an error message ('' if there is no error)
+    '''
+
+    renderer = _worker['renderer']
+    outfile = task[2] if task[0] == 'sheet' else task[3]
+    try:
+        if (task[0] == 'sheet'):
+            specimens = [(name, read_docs(files)) for name, files in task[1]]
+            return renderer.contact_sheet(specimens, task[2], title=task[3]), ''
+        return renderer.render(read_docs(task[2]), task[3], title=task[1]), ''
+    except Exception as e:
+        return outfile, f'{type(e).__name__}: {e}'
+
+
+def render_many(groups, outdir, fmt='png', workers=None, sheet=False, nrows=5, ncols=4,
+                dpi=100, progress=False):
+    '''
+    Render many specimens across a pool of worker processes
+
+    Parameters:
+    -----------
+    groups- dictionary of {specimen name: [toml files]} (see group_files)
+    outdir- directory for the images
+    fmt- image format, "png" or "svg"
+    workers- number of worker processes. Default is the number of CPUs. With one worker the
+             images are rendered in this process
+    sheet- render contact sheets (sheet_0001.png, ...) instead of one image per specimen
+    nrows, ncols- specimens per contact sheet
+    dpi- resolution of the PNG images
+    progress- print each image as it is written
+
+    Returns:
+    --------
+    list of the images and list of (image, error) for the images that failed
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    items = list(groups.items())
+    if (sheet):
+        per_page = nrows*ncols
+        npages = (len(items) + per_page - 1)//per_page
+        tasks = [('sheet', items[i:i+per_page], str(outdir / f'sheet_{p+1:04d}.{fmt}'),
+                  f'{items[i][0]} - {items[min(i+per_page, len(items))-1][0]}'
+                  f' ({p+1} of {npages})')
+                 for p, i in enumerate(range(0, len(items), per_page))]
+    else:
+        tasks = [('specimen', name, files, str(outdir / f'{_file_name(name)}.{fmt}'))
+                 for name, files in items]
+
+    opts = {'fmt': fmt, 'dpi': dpi, 'nrows': nrows, 'ncols': ncols}
+    workers = workers or os.cpu_count() or 1
+    if (workers == 1 or len(tasks) <= 1):
+        _init_worker(opts)
+        results = map(_render_task, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(opts,))
+        # the tasks are small, so they are sent to the workers in chunks
+        results = pool.map(_render_task, tasks, chunksize=max(1, len(tasks)//(4*workers)))
+
+    images = []
+    errors = []
+    try:
+        for image, error in results:
+            if (error):
+                errors.append((image, error))
+                print(f'error  {image}: {error}')
+            elif (image):
+                images.append(image)
+                if (progress):
+                    print(f'wrote  {image}')
+    finally:
+        if (pool):
+            pool.shutdown()
+
+    return images, errors
+
+
+def _file_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name)).strip('_') or 'specimen'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render outline toml files to images')
+    parser.add_argument('paths', nargs='+', help='toml files and directories')
+    parser.add_argument('--outdir', required=True, help='directory for the images')
+    parser.add_argument('--format', default='png', choices=['png', 'svg'], help='image format')
+    parser.add_argument('--sheet', action='store_true', help='render contact sheets')
+    parser.add_argument('--rows', type=int, default=5, help='rows of a contact sheet')
+    parser.add_argument('--cols', type=int, default=4, help='columns of a contact sheet')
+    parser.add_argument('--dpi', type=int, default=100, help='resolution of the PNG images')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    args = parser.parse_args(argv)
+
+    import time
+    files = []
+    for p in map(Path, args.paths):
+        if (p.is_dir()):
+            files += sorted(p.glob('**/*.toml' if args.recursive else '*.toml'))
+        else:
+            files.append(p)
+    t0 = time.perf_counter()
+    groups = group_files(files)
+    images, errors = render_many(groups, args.outdir, fmt=args.format, workers=args.workers,
+                                 sheet=args.sheet, nrows=args.rows, ncols=args.cols,
+                                 dpi=args.dpi, progress=not args.quiet)
+    print(f'{len(groups)} specimens, {len(images)} images, {len(errors)} errors in '
+          f'{time.perf_counter() - t0:.2f} s: {args.outdir}')
+
+    return 0 if not errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
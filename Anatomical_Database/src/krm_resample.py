@@ -0,0 +1,306 @@
+'''
+Resample and simplify outline shape_data
+
+The outlines have the node spacing of the digitizer (e.g., 233 nodes for the aherr001 body)
+and the run time of the scattering models goes with the number of nodes. This
+    resamples an outline to n nodes, or to a node spacing, uniform along x
+    simplifies an outline to the fewest nodes within a tolerance:
+        douglas-peucker- keep adding the node that is furthest from the simplified outline
+                         until all nodes are within the tolerance (a distance)
+        visvalingam- keep removing the nodes with the smallest triangle area with their
+                     neighbours while the area is less than the tolerance (an area)
+The upper (z + height), lower (z - height), starboard (y + width), and port (y - width)
+profiles are simplified together, so a node is kept if any profile needs it. The error of a
+node is the largest distance, at its x, between a profile of the original outline and the
+same profile of the new outline. The maximum error is reported for each outline.
+
+The outlines of a batch (e.g., all the specimens of a dataset) are put end to end in one set of
+arrays and each pass works on all of them at once, so there is no loop over the specimens.
+
+    rs = krm_resample()
+    new, errors = rs.resample([doc['shape_data'] for doc in docs], n=50)
+    new, errors = rs.simplify([doc['shape_data'] for doc in docs], tolerance=0.1)
+
+Example:
+    python krm_resample.py --tolerance 0.1 --outdir simplified ../Example_Data/*.toml
+
+jech
+'''
+
+import sys
+import argparse
+import numpy as np
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+# the outline coordinates
+coordinates = ['x', 'y', 'z', 'height', 'width']
+
+
+class krm_resample():
+    methods = ['douglas-peucker', 'visvalingam']
+
+    def __init__(self, decimals=None):
+        '''
+        Parameters:
+        -----------
+        decimals- number of decimals to round the new coordinates to. None does not round
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.decimals = decimals
+
+
+    @staticmethod
+    def __stack(shapes):
+        '''
+        The outlines end to end: the coordinates (nnodes, 5), the parameter t along the
+        outlines, and the first node of each outline. t is x (or -x if x decreases) plus an
+        offset for each outline, so it increases across the whole batch
+        '''
+
+        arrays = []
+        t = []
+        offset = 0.0
+        for sd in shapes:
+            a = np.column_stack([np.asarray(sd[k], dtype=np.float64) for k in coordinates])
+            if (len(a) < 2):
+                raise ValueError('An outline needs at least 2 nodes')
+            x = a[:, 0] if a[-1, 0] > a[0, 0] else -a[:, 0]
+            if (np.any(np.diff(x) <= 0)):
+                raise ValueError('The x of an outline needs to increase or decrease')
+            t.append(x - x[0] + offset)
+            offset += x[-1] - x[0] + 1.0
+            arrays.append(a)
+        starts = np.cumsum([0] + [len(a) for a in arrays])
+
+        return np.concatenate(arrays), np.concatenate(t), starts
+
+
+    @staticmethod
+    def profiles(a):
+        '''
+        The upper, lower, starboard, and port profiles of outline coordinates (nnodes, 5)
+        '''
+
+        x, y, z, h, w = a.T
+
+        return np.column_stack([z + h, z - h, y + w, y - w])
+
+
+    @staticmethod
+    def __deviation(t, p, tk, pk):
+        '''
+        The largest distance at t between the profiles p and the profiles pk at tk
+        '''
+
+        return np.max(np.abs(p - np.column_stack([np.interp(t, tk, pk[:, j])
+                                                  for j in range(p.shape[1])])), axis=1)
+
+
+    def __unstack(self, shapes, a, starts):
+        '''
+        The new shape_data of each outline, with the other keys of the original
+        '''
+
+        out = []
+        for i, sd in enumerate(shapes):
+            part = a[starts[i]:starts[i+1]]
+            if (self.decimals is not None):
+                part = np.round(part, self.decimals)
+            new = dict(sd)
+            for j, k in enumerate(coordinates):
+                new[k] = part[:, j] if isinstance(sd[k], np.ndarray) else part[:, j].tolist()
+            out.append(new)
+
+        return out
+
+
+    def __errors(self, a, t, starts, new_t, new_a):
+        '''
+        The maximum error of each outline
+        '''
+
+        dev = self.__deviation(t, self.profiles(a), new_t, self.profiles(new_a))
+
+        return [float(dev[starts[i]:starts[i+1]].max()) for i in range(len(starts)-1)]
+
+
+    def resample(self, shapes, n=None, spacing=None):
+        '''
+        Resample outlines to nodes uniform along x
+
+        Parameters:
+        -----------
+        shapes- a shape_data dictionary or a list of them
+        n- number of nodes of each outline
+        spacing- the node spacing in the units of the outline. The first and last nodes are
+                 kept, so the spacing is the nearest one that fits the length of the outline
+
+        Returns:
+        --------
+        the new shape_data (a dictionary or a list, as shapes) and the maximum error of each
+        outline
+        '''
+
+        single = isinstance(shapes, dict)
+        shapes = [shapes] if single else list(shapes)
+        if ((n is None) == (spacing is None)):
+            raise ValueError('Give either n or spacing')
+        a, t, starts = self.__stack(shapes)
+
+        lengths = t[starts[1:] - 1] - t[starts[:-1]]
+        if (n is not None):
+            counts = np.full(len(shapes), int(n))
+        else:
+            counts = np.rint(lengths/spacing).astype(int) + 1
+        if (np.any(counts < 2)):
+            raise ValueError('An outline needs at least 2 nodes')
+        new_starts = np.concatenate([[0], np.cumsum(counts)])
+        # uniform t in each outline, for all the outlines at once
+        outline = np.repeat(np.arange(len(shapes)), counts)
+        frac = (np.arange(new_starts[-1]) - new_starts[outline])/(counts[outline] - 1)
+        new_t = t[starts[:-1]][outline] + frac*lengths[outline]
+        new_a = np.column_stack([np.interp(new_t, t, a[:, j]) for j in range(a.shape[1])])
+
+        errors = self.__errors(a, t, starts, new_t, new_a)
+        out = self.__unstack(shapes, new_a, new_starts)
+
+        return (out[0], errors[0]) if single else (out, errors)
+
+
+    def simplify(self, shapes, tolerance, method='douglas-peucker'):
+        '''
+        Simplify outlines to fewer nodes
+
+        Parameters:
+        -----------
+        shapes- a shape_data dictionary or a list of them
+        tolerance- for douglas-peucker, the maximum error (a distance in the units of the
+                   outline). For visvalingam, the maximum triangle area of a removed node
+        method- "douglas-peucker" or "visvalingam"
+
+        Returns:
+        --------
+        the new shape_data (a dictionary or a list, as shapes) and the maximum error of each
+        outline. The nodes that are kept are nodes of the original outline
+        '''
+
+        single = isinstance(shapes, dict)
+        shapes = [shapes] if single else list(shapes)
+        a, t, starts = self.__stack(shapes)
+        p = self.profiles(a)
+
+        match method:
+            case 'douglas-peucker':
+                keep = self.__douglas_peucker(t, p, starts, tolerance)
+            case 'visvalingam':
+                keep = self.__visvalingam(t, p, starts, tolerance)
+            case _:
+                raise ValueError(f'Unknown method {method}: select one of {self.methods}')
+
+        kept = np.flatnonzero(keep)
+        errors = self.__errors(a, t, starts, t[kept], a[kept])
+        new_starts = np.searchsorted(kept, starts)
+        out = self.__unstack(shapes, a[kept], new_starts)
+
+        return (out[0], errors[0]) if single else (out, errors)
+
+
+    def __douglas_peucker(self, t, p, starts, tolerance):
+        '''
+        Each pass adds the furthest node of every segment (between two kept nodes) that has a
+        node further than the tolerance
+        '''
+
+        keep = np.zeros(len(t), dtype=bool)
+        keep[starts[:-1]] = True
+        keep[starts[1:] - 1] = True
+        while (True):
+            kept = np.flatnonzero(keep)
+            dev = self.__deviation(t, p, t[kept], p[kept])
+            dev[keep] = 0.0
+            # the segment of each node and the largest deviation in each segment
+            segment = np.cumsum(keep) - 1
+            largest = np.maximum.reduceat(dev, kept)
+            add = (dev > tolerance) & (dev == largest[segment])
+            if (not add.any()):
+                return keep
+            # one node per segment
+            segments, first = np.unique(segment[add], return_index=True)
+            keep[np.flatnonzero(add)[first]] = True
+
+
+    def __visvalingam(self, t, p, starts, tolerance):
+        '''
+        Each pass removes the nodes whose area is less than the tolerance and less than the
+        area of their kept neighbours, so two neighbours are not removed in the same pass
+        '''
+
+        keep = np.ones(len(t), dtype=bool)
+        ends = np.zeros(len(t), dtype=bool)
+        ends[starts[:-1]] = True
+        ends[starts[1:] - 1] = True
+        while (True):
+            kept = np.flatnonzero(keep)
+            inner = ~ends[kept]
+            area = np.full(len(kept), np.inf)
+            i = np.flatnonzero(inner)
+            prev, node, nxt = kept[i-1], kept[i], kept[i+1]
+            # the largest triangle area of the profiles in the (t, profile) plane
+            area[i] = 0.5*np.max(np.abs((t[node] - t[prev])[:, None]*(p[nxt] - p[prev]) -
+                                        (t[nxt] - t[prev])[:, None]*(p[node] - p[prev])),
+                                 axis=1)
+            left = np.concatenate([[np.inf], area[:-1]])
+            right = np.concatenate([area[1:], [np.inf]])
+            remove = (area < tolerance) & (area <= left) & (area < right)
+            if (not remove.any()):
+                return keep
+            keep[kept[remove]] = False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resample or simplify outline toml files')
+    parser.add_argument('tomlfiles', nargs='+', help='toml files with outline shape_data')
+    parser.add_argument('--outdir', required=True, help='directory for the new toml files')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--n', type=int, help='resample to n nodes')
+    group.add_argument('--spacing', type=float, help='resample to a node spacing')
+    group.add_argument('--tolerance', type=float, help='simplify to a tolerance')
+    parser.add_argument('--method', default='douglas-peucker', choices=krm_resample.methods,
+                        help='simplification method')
+    parser.add_argument('--decimals', type=int, default=5, help='decimals of the coordinates')
+    args = parser.parse_args(argv)
+
+    from pathlib import Path
+    from krm_toml import write_toml
+    docs = []
+    for tomlfile in args.tomlfiles:
+        with open(tomlfile, 'rb') as f:
+            docs.append(tomllib.load(f))
+
+    rs = krm_resample(args.decimals)
+    shapes = [doc['shape_data'] for doc in docs]
+    if (args.tolerance is not None):
+        new, errors = rs.simplify(shapes, args.tolerance, args.method)
+    else:
+        new, errors = rs.resample(shapes, n=args.n, spacing=args.spacing)
+
+    outdir = Path(args.outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    for tomlfile, doc, sd, error in zip(args.tomlfiles, docs, new, errors):
+        doc['shape_data'] = sd
+        with open(outdir / Path(tomlfile).name, 'w') as f:
+            write_toml(doc, f)
+        print(f"{tomlfile}: {len(doc['shape_data']['x'])} nodes, maximum error {error:.5g}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+'''
+Scan the metadata of many KRM .dat files without reading the coordinates
+
+To build a catalog or to pick files only the metadata is needed: the <meta> section, or the
+first four lines and the last (comment) line of a Clay-format file. krm_data.scan_metadata reads
+a file up to the header line and reads the last line of a Clay-format file from the end of the
+file, so the time per file is a few small reads rather than the size of the file. The files
+of a directory tree are scanned by a pool of threads, since the time is in waiting for the disk
+rather than in Python.
+
+    records = scan_files(find_dat_files('../Example_Data'))
+    records[0]['data_md']['description']
+
+Example:
+    python krm_scan.py --recursive --output metadata.jsonl /data/krm
+
+jech
+'''
+
+import sys
+import json
+import time
+import argparse
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from krm_data import scan_metadata
+
+# the .dat files can be compressed
+dat_suffixes = ('.dat', '.dat.gz', '.dat.bz2', '.dat.xz')
+
+
+def find_dat_files(paths, recursive=False):
+    '''
+    The .dat files of directories and file names
+
+    Parameters:
+    -----------
+    paths- a directory or file name, or a list of them
+    recursive- also search the subdirectories
+
+    Returns:
+    --------
+    sorted list of the .dat files (pathlib objects)
+    '''
+
+    if (isinstance(paths, (str, Path))):
+        paths = [paths]
+
+    files = []
+    for p in map(Path, paths):
+        if (p.is_dir()):
+            found = p.rglob('*') if recursive else p.iterdir()
+            files.extend(f for f in found if f.name.endswith(dat_suffixes) and f.is_file())
+        else:
+            files.append(p)
+
+    return sorted(files)
+
+
+def _scan(datfile):
+    '''
+    The metadata of one file, or the error
+    '''
+
+    try:
+        return scan_metadata(datfile, quiet=True)
+    except Exception as e:
+        return {'file': str(datfile), 'error': f'{type(e).__name__}: {e}'}
+
+
+def scan_files(datfiles, workers=16, progress=None):
+    '''
+    Scan the metadata of the .dat files with a pool of threads
+
+    Parameters:
+    -----------
+    datfiles- list of .dat files
+    workers- number of threads
+    progress- function called with (number done, number of files) every 1000 files
+
+    Returns:
+    --------
+    list of the scan_metadata dictionaries, in the order of datfiles. A file that can not be
+    read has the file and an "error" instead
+    '''
+
+    records = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in pool.map(_scan, datfiles):
+            records.append(record)
+            if (progress is not None and len(records) % 1000 == 0):
+                progress(len(records), len(datfiles))
+
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scan the metadata of KRM .dat files')
+    parser.add_argument('paths', nargs='+', help='directories or .dat files')
+    parser.add_argument('--recursive', action='store_true', help='search the subdirectories')
+    parser.add_argument('--workers', type=int, default=16, help='number of threads')
+    parser.add_argument('--output', help='JSON lines file of the metadata. Default prints it')
+    args = parser.parse_args(argv)
+
+    datfiles = find_dat_files(args.paths, args.recursive)
+    start = time.perf_counter()
+    records = scan_files(datfiles, args.workers,
+                         progress=lambda n, total: print(f'{n}/{total}', file=sys.stderr))
+    elapsed = time.perf_counter() - start
+
+    with (open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout)) as f:
+        for record in records:
+            f.write(json.dumps(record, default=str)+'\n')
+
+    errors = [r for r in records if 'error' in r]
+    for r in errors:
+        print(f"{r['file']}: {r['error']}", file=sys.stderr)
+    print(f'{len(records)} files, {len(errors)} errors, {elapsed:.2f} s '
+          f'({len(records)/max(elapsed, 1e-9):.0f} files/s)', file=sys.stderr)
+
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
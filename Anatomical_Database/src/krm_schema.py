@@ -4,7 +4,6 @@ Class to read the echoSMs schema file
 jech
 '''
 
-import sys
 from pathlib import Path
 import json
 import pprint
@@ -42,8 +41,8 @@ class krm_schema():
                 with open(schemafile, 'r') as f:
                     self.schema_md = json.load(f)
             except FileNotFoundError:
-                print(f'Error: The file {schemafile} was not found. Exiting the program')
-                sys.exit() 
+                print(f'Error: The file {schemafile} was not found')
+                raise
 
 
 
@@ -0,0 +1,207 @@
+'''
+Binary sidecar files of the shape_data arrays
+
+The toml files have the shape_data as text rounded to a few decimals. A model run that loads
+the same outlines many times can instead load a binary sidecar file written next to the toml
+file. The sidecar has the shape_data arrays (x, y, z, height, width, ...) as contiguous float64
+or float32 arrays at full precision and the rest of the document as JSON metadata.
+
+Formats:
+    npz    an uncompressed NumPy .npz file. The metadata are in the "__metadata__" member as
+           UTF-8 JSON bytes. Always available
+    arrow  an Arrow IPC file with the metadata in the schema metadata. Needs pyarrow
+
+load_sidecar memory-maps the arrays (no text parsing and no copy) for both formats:
+    metadata, arrays = load_sidecar('aherr001.npz')
+    x = arrays['x']
+
+jech
+'''
+
+import json
+import zipfile
+from pathlib import Path
+import numpy as np
+
+# the npz member with the metadata
+metadata_member = '__metadata__'
+# suffix of the sidecar file for each format
+suffixes = {'npz': '.npz', 'arrow': '.arrow'}
+
+
+def sidecar_name(toml_file, fmt='npz'):
+    '''
+    the sidecar file next to the toml file, e.g., aherr001.toml -> aherr001.npz
+    '''
+
+    return Path(toml_file).with_suffix(suffixes[fmt])
+
+
+def split_document(doc, arrays=None, dtype=np.float64):
+    '''
+    Split a merged document into the metadata and the shape_data arrays
+
+    Parameters:
+    -----------
+    doc- the merged dictionary (e.g., krm_merge_data.krm_data_merged)
+    arrays- dictionary of the full precision shape_data arrays (e.g.,
+            krm_merge_data.shape_arrays). Default is the arrays in doc['shape_data']
+    dtype- floating point type of the arrays
+
+    Returns:
+    --------
+    the metadata dictionary and a dictionary of contiguous arrays
+    '''
+
+    shape_data = doc.get('shape_data', {})
+    if (not arrays):
+        arrays = {k: v for k, v in shape_data.items() if isinstance(v, (list, np.ndarray))}
+    arrays = {k: np.ascontiguousarray(v, dtype=dtype) for k, v in arrays.items()}
+    metadata = {k: v for k, v in doc.items() if k != 'shape_data'}
+    metadata['shape_data'] = {k: v for k, v in shape_data.items() if k not in arrays}
+    metadata['sidecar'] = {'dtype': np.dtype(dtype).name, 'arrays': list(arrays)}
+
+    return metadata, arrays
+
+
+def write_sidecar(sidecar_file, doc, arrays=None, fmt='npz', dtype=np.float64):
+    '''
+    Write the sidecar file of a merged document
+
+    Parameters:
+    -----------
+    sidecar_file- the output file
+    doc- the merged dictionary
+    arrays- dictionary of the full precision shape_data arrays. Default is the arrays in
+            doc['shape_data']
+    fmt- "npz" or "arrow"
+    dtype- floating point type of the arrays, e.g., np.float64 or np.float32
+
+    Returns:
+    --------
+    the sidecar file as a pathlib object
+    '''
+
+    sidecar_file = Path(sidecar_file)
+    metadata, arrays = split_document(doc, arrays, dtype)
+    match fmt:
+        case 'npz':
+            members = arrays | {metadata_member: np.frombuffer(
+                json.dumps(metadata).encode('utf-8'), dtype=np.uint8)}
+            # savez adds .npz to names without it
+            with open(sidecar_file, 'wb') as f:
+                np.savez(f, **members)
+        case 'arrow':
+            _write_arrow(sidecar_file, metadata, arrays)
+        case _:
+            raise ValueError(f'Unknown sidecar format {fmt}: select "npz" or "arrow"')
+
+    return sidecar_file
+
+
+def _write_arrow(sidecar_file, metadata, arrays):
+    import pyarrow as pa
+
+    lengths = {len(v) for v in arrays.values()}
+    if (len(lengths) > 1 or any(v.ndim != 1 for v in arrays.values())):
+        raise ValueError('The arrow sidecar needs 1-D arrays of the same length. Use npz')
+    table = pa.table({k: pa.array(v) for k, v in arrays.items()})
+    table = table.replace_schema_metadata({'echosms': json.dumps(metadata)})
+    with pa.OSFile(str(sidecar_file), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_sidecar(sidecar_file, mmap=True):
+    '''
+    Load a sidecar file
+
+    Parameters:
+    -----------
+    sidecar_file- the .npz or .arrow file
+    mmap- memory-map the arrays (read-only). Arrays of compressed npz members are read
+
+    Returns:
+    --------
+    the metadata dictionary and a dictionary of the arrays
+    '''
+
+    sidecar_file = Path(sidecar_file)
+    if (sidecar_file.suffix == suffixes['arrow']):
+        return _load_arrow(sidecar_file, mmap)
+
+    metadata = {}
+    arrays = {}
+    with zipfile.ZipFile(sidecar_file) as zf, open(sidecar_file, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename.removesuffix('.npy')
+            if (mmap and info.compress_type == zipfile.ZIP_STORED):
+                array = _memmap_member(sidecar_file, f, info)
+            else:
+                with zf.open(info) as member:
+                    array = np.lib.format.read_array(member)
+            if (name == metadata_member):
+                metadata = json.loads(bytes(array).decode('utf-8'))
+            else:
+                arrays[name] = array
+
+    return metadata, arrays
+
+
+def _memmap_member(sidecar_file, f, info):
+    '''
+    memory-map the array of an uncompressed npz member. The data start after the zip local
+    file header of the member and the .npy header
+    '''
+
+    # the local file header is 30 bytes plus the file name and the extra field
+    f.seek(info.header_offset + 26)
+    name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+    f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+    version = np.lib.format.read_magic(f)
+    if (version == (1, 0)):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if (dtype.hasobject):
+        raise ValueError(f'{info.filename} has Python objects and can not be memory-mapped')
+    if (np.prod(shape) == 0):
+        return np.empty(shape, dtype=dtype)
+
+    return np.memmap(sidecar_file, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def _load_arrow(sidecar_file, mmap):
+    import pyarrow as pa
+
+    if (mmap):
+        source = pa.memory_map(str(sidecar_file), 'r')
+    else:
+        source = pa.OSFile(str(sidecar_file), 'rb')
+    table = pa.ipc.open_file(source).read_all()
+    metadata = json.loads(table.schema.metadata[b'echosms'])
+    arrays = {name: table.column(name).to_numpy() for name in table.column_names}
+
+    return metadata, arrays
+
+
+def to_document(metadata, arrays):
+    '''
+    Put the arrays back in the shape_data of the metadata, e.g., to compare to the toml file
+
+    Parameters:
+    -----------
+    metadata- the metadata dictionary from load_sidecar
+    arrays- the arrays from load_sidecar
+
+    Returns:
+    --------
+    the merged dictionary with the shape_data arrays as lists
+    '''
+
+    doc = {k: v for k, v in metadata.items() if k != 'sidecar'}
+    doc['shape_data'] = metadata.get('shape_data', {}) | \
+                        {k: v.tolist() for k, v in arrays.items()}
+
+    return doc
@@ -0,0 +1,283 @@
+'''
+Packed store of the shape_data arrays
+
+Thousands of small toml files are slow to list and open, in particular on network file systems.
+The store is one binary file with the shape_data arrays of all the specimens, one record after
+the other, and a JSON index (next to it, with the suffix ".index.json") with, for each record:
+    specimen_id, anatomical_feature, aphia_id, and part (the body part label, e.g., for the
+    swimbladder chambers)
+    offset (bytes) and length (number of nodes) of the record in the binary file
+    dtype and columns (e.g., x, y, z, height, width) of the record
+    metadata (the rest of the merged document)
+Each record is a (columns, length) array, so each column is contiguous. The binary file is
+memory-mapped once and a record is a view of it, so reading a specimen does not open a file.
+
+    store = krm_store('corpus.bin', mode='a')
+    store.add(krm_merge.krm_data_merged, krm_merge.shape_arrays)
+    store.close()
+
+    store = krm_store('corpus.bin')
+    metadata, arrays = store.get('aherr001', 'body', 126417)
+
+krm_batch --store corpus.bin writes the merged documents to a store.
+
+jech
+'''
+
+import sys
+import os
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+from krm_sidecar import split_document, to_document
+
+# records start at multiples of this many bytes
+alignment = 64
+
+
+class krm_store():
+    def __init__(self, storefile, mode='r'):
+        '''
+        Open a store
+
+        Parameters:
+        -----------
+        storefile- the binary file. The index is the same name with the suffix .index.json
+        mode- "r" read, "a" read and add records, "w" new (empty) store
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.storefile = Path(storefile)
+        self.indexfile = self.storefile.with_suffix('.index.json')
+        self.mode = mode
+        self.index = {}
+        self.records = []
+        self.changed = False
+        self.mm = None
+
+        if (mode == 'w' or (mode == 'a' and not self.storefile.exists())):
+            self.storefile.parent.mkdir(parents=True, exist_ok=True)
+            self.storefile.write_bytes(b'')
+            self.changed = True
+        elif (self.indexfile.exists()):
+            with open(self.indexfile, 'r') as f:
+                for record in json.load(f)['records']:
+                    self.__add_to_index(record)
+        # appended records are written after the last record of the index. Data after it are
+        # from an interrupted run that did not save the index
+        self.size = max((r['offset'] + r['nbytes'] for r in self.records), default=0)
+
+
+    @staticmethod
+    def key(specimen_id, anatomical_feature, aphia_id):
+        return (str(specimen_id), str(anatomical_feature), int(aphia_id))
+
+
+    def __add_to_index(self, record):
+        k = self.key(record['specimen_id'], record['anatomical_feature'], record['aphia_id'])
+        self.index.setdefault(k, {})[record['part']] = record
+        self.records.append(record)
+
+
+    def add(self, doc, arrays=None, part='', dtype=np.float64):
+        '''
+        Add the shape_data of a merged document to the store. A record with the same key and
+        part is replaced (the index points to the new record)
+
+        Parameters:
+        -----------
+        doc- the merged dictionary (e.g., krm_merge_data.krm_data_merged)
+        arrays- dictionary of the full precision shape_data arrays (e.g.,
+                krm_merge_data.shape_arrays). Default is the arrays in doc['shape_data']
+        part- label of the body part, to tell apart records with the same key, e.g., the
+              swimbladder chambers
+        dtype- floating point type of the arrays
+
+        Returns:
+        --------
+        the index record
+        '''
+
+        if (self.mode == 'r'):
+            raise PermissionError(f'{self.storefile} is open for reading')
+        metadata, arrays = split_document(doc, arrays, dtype)
+        del metadata['sidecar']
+        lengths = {v.shape for v in arrays.values()}
+        if (len(lengths) != 1 or len(next(iter(lengths))) != 1):
+            raise ValueError('The store needs 1-D shape_data arrays of the same length')
+
+        block = np.stack(list(arrays.values()))
+        offset = -(-self.size // alignment)*alignment
+        with open(self.storefile, 'r+b') as f:
+            f.seek(offset)
+            f.write(block.tobytes())
+        self.size = offset + block.nbytes
+
+        record = {'specimen_id': doc.get('specimen_id', ''),
+                  'anatomical_feature': doc.get('anatomical_feature', ''),
+                  'aphia_id': doc.get('aphia_id', 0),
+                  'part': part,
+                  'offset': offset,
+                  'nbytes': block.nbytes,
+                  'length': block.shape[1],
+                  'dtype': block.dtype.name,
+                  'columns': list(arrays),
+                  'metadata': metadata}
+        k = self.key(record['specimen_id'], record['anatomical_feature'], record['aphia_id'])
+        if (part in self.index.get(k, {})):
+            self.records.remove(self.index[k][part])
+        self.__add_to_index(record)
+        self.changed = True
+
+        return record
+
+
+    def find(self, specimen_id, anatomical_feature, aphia_id, part=None):
+        '''
+        Get the index record of a specimen
+
+        Parameters:
+        -----------
+        specimen_id, anatomical_feature, aphia_id- the key of the record
+        part- the body part label. Can be left out if the key has one record
+
+        Returns:
+        --------
+        the index record
+        '''
+
+        parts = self.index.get(self.key(specimen_id, anatomical_feature, aphia_id))
+        if (not parts):
+            raise KeyError(f'{specimen_id}, {anatomical_feature}, {aphia_id} is not in the store')
+        if (part is None):
+            if (len(parts) > 1):
+                raise KeyError(f'{specimen_id}, {anatomical_feature}, {aphia_id} has the parts '
+                               f'{list(parts)}. Select one')
+            return next(iter(parts.values()))
+
+        return parts[part]
+
+
+    def get(self, specimen_id, anatomical_feature, aphia_id, part=None):
+        '''
+        Read the arrays of a specimen
+
+        Parameters:
+        -----------
+        specimen_id, anatomical_feature, aphia_id- the key of the record
+        part- the body part label. Can be left out if the key has one record
+
+        Returns:
+        --------
+        the metadata dictionary and a dictionary of read-only arrays (views of the store)
+        '''
+
+        record = self.find(specimen_id, anatomical_feature, aphia_id, part)
+        if (self.mm is None or len(self.mm) < self.size):
+            self.mm = np.memmap(self.storefile, dtype=np.uint8, mode='r')
+        block = self.mm[record['offset']:record['offset']+record['nbytes']]
+        block = block.view(record['dtype']).reshape(len(record['columns']), record['length'])
+
+        return record['metadata'], dict(zip(record['columns'], block))
+
+
+    def document(self, specimen_id, anatomical_feature, aphia_id, part=None):
+        '''
+        The merged document of a specimen, e.g., to write a toml file
+
+        Returns:
+        --------
+        the merged dictionary with the shape_data arrays as lists
+        '''
+
+        return to_document(*self.get(specimen_id, anatomical_feature, aphia_id, part))
+
+
+    def keys(self):
+        '''
+        list of (specimen_id, anatomical_feature, aphia_id, part) in the store
+        '''
+
+        return [k + (part,) for k, parts in self.index.items() for part in parts]
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def save_index(self):
+        '''
+        Write the index. The index is written to a temporary file that replaces the index, so
+        the index always matches the binary file
+        '''
+
+        tmpfile = self.indexfile.with_suffix('.tmp')
+        with open(tmpfile, 'w') as f:
+            json.dump({'storefile': self.storefile.name, 'alignment': alignment,
+                       'records': self.records}, f)
+        os.replace(tmpfile, self.indexfile)
+        self.changed = False
+
+
+    def close(self):
+        '''
+        Save the index if records were added and release the memory map
+        '''
+
+        if (self.changed and self.mode != 'r'):
+            self.save_index()
+        self.mm = None
+
+
+    def display_dict(self, dictname):
+        '''
+        print the store index to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'index':
+                for r in self.records:
+                    print(f"{r['specimen_id']:20s} {r['anatomical_feature']:12s} "
+                          f"{r['aphia_id']:>8} {r['part']:24s} {r['length']:8d} {r['dtype']}")
+            case _:
+                print('Incorrect dictionary name: select "index"')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List or export the records of a store')
+    parser.add_argument('storefile', help='the binary store file')
+    parser.add_argument('--export', nargs='+', metavar='KEY',
+                        help='specimen_id anatomical_feature aphia_id [part] to export')
+    parser.add_argument('--toml', help='toml file for the exported record')
+    args = parser.parse_args(argv)
+
+    store = krm_store(args.storefile)
+    if (args.export):
+        doc = store.document(*args.export[:2], int(args.export[2]), *args.export[3:4])
+        if (args.toml):
+            from krm_toml import write_toml
+            with open(args.toml, 'w') as f:
+                write_toml(doc, f)
+        else:
+            print(json.dumps({k: v for k, v in doc.items() if k != 'shape_data'}, indent=4))
+    else:
+        store.display_dict('index')
+    store.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+'''
+Generate synthetic KRM .dat files
+
+There are only three example .dat files, so this generates files of any size for benchmarks and
+for testing the ingestion pipeline. The files have:
+    a fish body outline and nsb swimbladder chambers inside the body
+    npts+1 nodes per body part (the node count line in the file is npts, as in the real files)
+    symmetric (x z-upper z-lower width) or nonsymmetric (x z-upper z-lower width stbd port)
+    coordinates
+    the Clay format or the new format with the <meta> section
+
+Example:
+    python krm_synthetic.py /tmp/synthetic --npts 100 1000 10000 --nsb 2 --six-columns
+
+jech
+'''
+
+import sys
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+
+
+class krm_synthetic():
+    def __init__(self, seed=None):
+        '''
+        Parameters:
+        -----------
+        seed- seed for the random shape variations so the files can be reproduced
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.rng = np.random.default_rng(seed)
+
+
+    def outline(self, npts, x0, x1, height, width, z0=0.0, six_columns=False):
+        '''
+        Nodes of a smooth, closed outline along x
+
+        Parameters:
+        -----------
+        npts- the number of points. There are npts+1 nodes
+        x0, x1- start and end of the outline along x
+        height, width- maximum height and width
+        z0- z of the center line
+        six_columns- add the stbd and port columns with a center line that wiggles in y
+
+        Returns:
+        --------
+        2-D array with one row per node
+        '''
+
+        x = np.linspace(x0, x1, npts+1)
+        s = (x - x0)/(x1 - x0)
+        # a fish-like profile, thickest at about 1/3 of the length
+        profile = np.sin(np.pi*s**0.75)
+        profile *= 1 + 0.02*self.rng.standard_normal(npts+1)
+        profile[[0, -1]] = 0.0
+        zc = z0 + 0.05*height*np.sin(2*np.pi*s)
+        z_upper = zc + height/2*profile
+        z_lower = zc - height/2*profile
+        w = width*profile
+        if (not six_columns):
+            return np.column_stack([x, z_upper, z_lower, w])
+        yc = 0.03*width*np.sin(3*np.pi*s)
+
+        return np.column_stack([x, z_upper, z_lower, w, yc + w/2, yc - w/2])
+
+
+    def body_parts(self, npts, nsb=1, length=200.0, six_columns=False):
+        '''
+        The fish body and the swimbladder chambers
+
+        Parameters:
+        -----------
+        npts- number of points of each body part
+        nsb- number of swimbladder chambers
+        length- fish length
+        six_columns- nonsymmetric coordinates
+
+        Returns:
+        --------
+        list of (label, nodes)
+        '''
+
+        parts = [('fish body', self.outline(npts, 0.0, length, 0.2*length, 0.12*length,
+                                             six_columns=six_columns))]
+        # the chambers are consecutive along the middle of the body
+        edges = np.linspace(0.25*length, 0.65*length, nsb+1)
+        for i in range(nsb):
+            parts.append((f'swimbladder chamber {i+1}',
+                          self.outline(npts, edges[i], edges[i+1], 0.05*length, 0.04*length,
+                                       z0=-0.01*length, six_columns=six_columns)))
+
+        return parts
+
+
+    def write(self, datfile, npts=1000, nsb=1, length=200.0, mass=100.0, six_columns=False,
+              newformat=True, title='Synthetic fish'):
+        '''
+        Write a synthetic .dat file
+
+        Parameters:
+        -----------
+        datfile- the output file name
+        npts- number of points of each body part
+        nsb- number of swimbladder chambers
+        length- fish length in mm
+        mass- fish mass in g
+        six_columns- write the stbd and port columns
+        newformat- write the <meta> section, otherwise the Clay format
+        title- the title line
+
+        Returns:
+        --------
+        the total number of nodes in the file
+        '''
+
+        parts = self.body_parts(npts, nsb, length, six_columns)
+        columns = ['x', 'z-upper', 'z-lower', 'width'] + (['stbd', 'port'] if six_columns else [])
+        with open(datfile, 'w') as f:
+            if (newformat):
+                f.write('<meta>\n\n')
+                f.write(f'    Title = {title}\n')
+                f.write(f'    Fish_Length = {length:7.2f}\n')
+                f.write(f'    Fish_Mass = {mass:7.2f}\n')
+                f.write(f'    nsb = {nsb:2d}\n')
+                f.write('    Bladder_Type =  0\n')
+                f.write('    Preparer = krm_synthetic\n\n')
+                f.write('    File created: Wed Jul 31 12:47:01 2002\n\n')
+                f.write('</meta>\n')
+                f.write(''.join(f'{c:>10s}' for c in columns)+'\n')
+            else:
+                f.write(f'"{title}"\n')
+                f.write(f'"total fish length mm =" {length:g}\n')
+                f.write(f'"fish mass g =" {mass:g}\n')
+                f.write(f'"number of swimbladder chambers=" {nsb}\n')
+                f.write('"'+',   '.join(columns)+'"\n')
+            for i, (label, nodes) in enumerate(parts):
+                if (newformat):
+                    # the labels of the new format files, e.g., aherr001.dat
+                    f.write('fishbody\n' if i == 0 else f'swimbladder {i-1}\n')
+                else:
+                    f.write(f'"{label}"\n')
+                f.write(f'{npts:12d}\n')
+                np.savetxt(f, nodes, fmt='%12.5f')
+            if (not newformat):
+                f.write('"krm_synthetic"\n')
+
+        return sum(len(nodes) for label, nodes in parts)
+
+
+    def write_corpus(self, outdir, npts_list=(100, 1000, 10000), nsb=1, six_columns=False,
+                     formats=('new', 'clay'), json_template=None):
+        '''
+        Write a set of files with different node counts and formats. With a JSON template (e.g.,
+        Example_Data/Clupea_harengus_bd.json) a metadata JSON file is written for each .dat
+        file with its specimen_id, so the corpus can be run through krm_batch
+
+        Parameters:
+        -----------
+        outdir- output directory
+        npts_list- the numbers of points per body part
+        nsb- number of swimbladder chambers
+        six_columns- nonsymmetric coordinates
+        formats- "new" and/or "clay"
+        json_template- metadata JSON file to copy for each .dat file
+
+        Returns:
+        --------
+        list of (dat file, total number of nodes)
+        '''
+
+        outdir = Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        template = None
+        if (json_template):
+            with open(json_template, 'r') as f:
+                template = json.load(f)
+
+        files = []
+        for npts in npts_list:
+            for fmt in formats:
+                specimen_id = f'synth_{fmt}_{npts}_sb{nsb}' + ('_6col' if six_columns else '')
+                datfile = outdir / (specimen_id+'.dat')
+                nodes = self.write(datfile, npts=npts, nsb=nsb, six_columns=six_columns,
+                                   newformat=(fmt == 'new'), title=f'Synthetic {specimen_id}')
+                files.append((datfile, nodes))
+                if (template is not None):
+                    with open(outdir / (specimen_id+'.json'), 'w') as f:
+                        json.dump(template | {'specimen_id': specimen_id}, f, indent=4)
+
+        return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic KRM .dat files')
+    parser.add_argument('outdir', help='output directory')
+    parser.add_argument('--npts', nargs='+', type=int, default=[100, 1000, 10000],
+                        help='number of points per body part')
+    parser.add_argument('--nsb', type=int, default=1, help='number of swimbladder chambers')
+    parser.add_argument('--six-columns', action='store_true', help='write stbd and port columns')
+    parser.add_argument('--formats', nargs='+', default=['new', 'clay'], choices=['new', 'clay'])
+    parser.add_argument('--json-template', help='metadata JSON file to copy for each .dat file')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args(argv)
+
+    synthetic = krm_synthetic(seed=args.seed)
+    for datfile, nodes in synthetic.write_corpus(args.outdir, args.npts, args.nsb,
+                                                 args.six_columns, args.formats,
+                                                 args.json_template):
+        print(f'{nodes:10d} nodes  {datfile}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
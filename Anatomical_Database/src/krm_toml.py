@@ -1,23 +1,197 @@
 '''
 Class to convert dictionary to toml
 
+The toml package is imported when it is first used.
+
+toml.dump is slow for the shape_data arrays, which can have tens of thousands of values. The fast
+writer (fast=True) writes the metadata with toml as before and streams the shape_data arrays to
+the file in chunks, formatting the numbers with repr(). The output reads back (e.g., with 
+tomllib) to the same dictionary as the toml.dump output. Tables inside shape_data are written
+after its arrays as dotted tables, e.g., [shape_data.sub], so the arrays stay in [shape_data].
+
+The round trip of toml files through the fast writer can be checked with:
+    python krm_toml.py ../Example_Data/*.toml
+
 jech
 '''
 
 import sys
+import re
+import io
+import math
+import argparse
 from pathlib import Path
 import json
-from jsonschema import validate, ValidationError
-from jsonschema.exceptions import SchemaError
-from jsonschema.validators import validator_for
 import pprint
-import toml
+import numpy as np
+from krm_instrument import instrument, timed
 if sys.version_info >= (3, 11):
     import tomllib
 else:
     import tomli as tomllib
 
 
+# tables whose arrays are streamed by the fast writer
+array_tables = ('shape_data',)
+# number of values formatted and written at a time
+chunk_size = 4096
+_re_bare_key = re.compile(r'[A-Za-z0-9_-]+')
+
+
+@timed('toml')
+def write_toml(data, f):
+    '''
+    Write a dictionary as toml to a file handle. The arrays of numbers in the array_tables are
+    streamed to the file; everything else is written with toml
+
+    Parameters:
+    -----------
+    data- the dictionary
+    f- file handle open for writing text
+
+    Returns:
+    --------
+    none
+    '''
+
+    import toml
+
+    start = _tell(f) if instrument.enabled else None
+    scalars = {k: v for k, v in data.items() if not isinstance(v, dict)}
+    tables = {k: v for k, v in data.items() if isinstance(v, dict) and k not in array_tables}
+    f.write(toml.dumps(scalars))
+    for name in array_tables:
+        if (name not in data):
+            continue
+        f.write(f'\n[{_toml_key(name)}]\n')
+        table = data[name]
+        other = {k: v for k, v in table.items()
+                 if not _is_number_array(v) and not _is_table(v)}
+        f.write(toml.dumps(other))
+        for k, v in table.items():
+            if (_is_number_array(v)):
+                f.write(_toml_key(k)+' = ')
+                _write_array(v, f)
+                f.write('\n')
+        # a table header ends [shape_data], so the tables inside it go after the arrays
+        subtables = {k: v for k, v in table.items() if _is_table(v)}
+        if (subtables):
+            # toml repeats the [shape_data] header before an array of tables
+            text = toml.dumps({name: subtables}).removeprefix(f'[{_toml_key(name)}]\n')
+            f.write('\n'+text)
+    if (tables):
+        f.write('\n'+toml.dumps(tables))
+    if (start is not None):
+        end = _tell(f)
+        if (end is not None):
+            instrument.count('toml', bytes_written=end - start)
+
+
+def _tell(f):
+    '''
+    the position in a file, or None if the file can not tell (e.g., a pipe)
+    '''
+
+    try:
+        return f.tell()
+    except (OSError, AttributeError):
+        return None
+
+
+def _toml_key(key):
+    return key if _re_bare_key.fullmatch(key) else json.dumps(key)
+
+
+def _is_table(v):
+    '''
+    a dictionary or a list of dictionaries, which toml writes as a table or an array of tables
+    '''
+
+    return isinstance(v, dict) or (isinstance(v, list) and len(v) > 0 and
+                                   all(isinstance(x, dict) for x in v))
+
+
+def _is_number_array(v):
+    '''
+    a list or array of numbers (or of lists of numbers), but not booleans
+    '''
+
+    if (isinstance(v, np.ndarray)):
+        return v.dtype.kind in 'iuf' and v.size > 0
+    if (not isinstance(v, (list, tuple)) or len(v) == 0):
+        return False
+    if (isinstance(v[0], (list, tuple, np.ndarray))):
+        return all(_is_number_array(x) for x in v)
+
+    return all(type(x) is float or type(x) is int for x in v)
+
+
+def _write_array(a, f):
+    '''
+    write a 1-D or nested array of numbers in chunks. repr() of a Python float is the shortest
+    string that reads back to the same float
+    '''
+
+    if (isinstance(a, np.ndarray) and a.ndim > 1 or
+            not isinstance(a, np.ndarray) and isinstance(a[0], (list, tuple, np.ndarray))):
+        f.write('[ ')
+        for i in range(len(a)):
+            if (i):
+                f.write(', ')
+            _write_array(a[i], f)
+        f.write(']')
+        return
+
+    f.write('[ ')
+    for i in range(0, len(a), chunk_size):
+        chunk = a[i:i+chunk_size]
+        if (isinstance(chunk, np.ndarray)):
+            chunk = chunk.tolist()
+        f.write(', '.join(map(repr, chunk)))
+        f.write(',')
+        if (i+chunk_size < len(a)):
+            f.write(' ')
+    f.write(']')
+
+
+def _same(a, b):
+    '''
+    the dictionaries, lists, and values are equal, with nan equal to nan
+    '''
+
+    if (isinstance(a, np.ndarray)):
+        a = a.tolist()
+    if (isinstance(a, dict)):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a)
+    if (isinstance(a, (list, tuple))):
+        return (isinstance(b, list) and len(a) == len(b) and
+                all(_same(x, y) for x, y in zip(a, b)))
+    if (isinstance(a, float) and isinstance(b, float) and math.isnan(a)):
+        return math.isnan(b)
+
+    return a == b and type(a) is type(b)
+
+
+def check_round_trip(data):
+    '''
+    Check that the fast writer output reads back with tomllib to the same dictionary
+
+    Parameters:
+    -----------
+    data- the dictionary
+
+    Returns:
+    --------
+    boolean that the dictionary read back is the same
+    '''
+
+    with io.StringIO() as f:
+        write_toml(data, f)
+        text = f.getvalue()
+
+    return _same(data, tomllib.loads(text))
+
+
 class krm_toml():
     def __init__(self, data_ref=None, data_obj=None):
         '''
@@ -42,7 +216,7 @@ class krm_toml():
             return False
 
 
-    def data_to_toml_string(self, return_toml=False):
+    def data_to_toml_string(self, return_toml=False, fast=False):
         '''
         transform the dictionary to a toml string
         
@@ -50,26 +224,35 @@ class krm_toml():
         -----------
         none- use the dictionaries defined in self
         Optional- return_toml- return the toml string
+                  fast- use the fast writer for the shape_data arrays
 
         Returns:
         --------
         toml string if requested
         '''
         
-        self.toml_string = toml.dumps(self.data_to_toml)
+        import toml
+
+        if (fast):
+            with io.StringIO() as f:
+                write_toml(self.data_to_toml, f)
+                self.toml_string = f.getvalue()
+        else:
+            self.toml_string = toml.dumps(self.data_to_toml)
         self.tomled = True
 
         if (return_toml):
             return self.toml_string
 
 
-    def data_to_toml_file(self, toml_file=None):
+    def data_to_toml_file(self, toml_file=None, fast=False):
         '''
         outputs the dictionary to a toml file
         
         Parameters:
         -----------
         toml_file- output file as a pathlib object. if not pathlib, will convert
+        fast- stream the shape_data arrays to the file with the fast writer
 
         Returns:
         --------
@@ -80,8 +263,40 @@ class krm_toml():
             if (not isinstance(toml_file, Path)):
                 toml_file = Path(toml_file)
 
+        import toml
+
         with open(toml_file, 'w') as f:
-            toml.dump(self.data_to_toml, f)
+            if (fast):
+                write_toml(self.data_to_toml, f)
+            else:
+                with instrument.stage('toml') as s:
+                    toml.dump(self.data_to_toml, f)
+                    s.add(bytes_written=f.tell())
+
+        return True
+
+
+    def data_to_sidecar(self, sidecar_file=None, arrays=None, fmt='npz', dtype=np.float64):
+        '''
+        outputs the shape_data arrays to a binary sidecar file (see krm_sidecar) with the rest
+        of the dictionary as metadata
+
+        Parameters:
+        -----------
+        sidecar_file- output file, e.g., the toml file name with the .npz suffix
+        arrays- dictionary of the full precision shape_data arrays (e.g., 
+                krm_merge_data.shape_arrays). Default is the shape_data in the dictionary
+        fmt- "npz" or "arrow" (needs pyarrow)
+        dtype- floating point type of the arrays
+
+        Returns:
+        --------
+        boolean that the file was created
+        '''
+
+        from krm_sidecar import write_sidecar
+
+        write_sidecar(sidecar_file, self.data_to_toml, arrays=arrays, fmt=fmt, dtype=dtype)
 
         return True
 
@@ -105,3 +320,22 @@ class krm_toml():
             print('No toml string created. Can not display the toml string')
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the round trip of toml files through '
+                                                 'the fast writer')
+    parser.add_argument('tomlfiles', nargs='+', help='toml files')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for tomlfile in args.tomlfiles:
+        with open(tomlfile, 'rb') as f:
+            data = tomllib.load(f)
+        ok = check_round_trip(data)
+        failed += not ok
+        print(f"{tomlfile}: {'ok' if ok else 'differs'}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
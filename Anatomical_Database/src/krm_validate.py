@@ -1,22 +1,90 @@
 '''
 Class to validate data and/or dictionary to the echoSMs schema
 
+The validator for a schema can be compiled once (compiled=True) and reused for any number of
+documents. The compiled validators are cached by schema, so all krm_validate instances for
+the same schema share one validator. A schema dictionary is hashed only the first time it is
+seen, and a schema file is read again only when it changes. Both the compiled and the
+uncompiled validation check the "format" keywords (e.g., dates), so a document is valid or
+not in both.
+
+jsonschema is imported when a validator is first needed.
+
 jech
 '''
 
-import sys
 from pathlib import Path
 import json
-from jsonschema import validate, ValidationError
-from jsonschema.exceptions import SchemaError
-from jsonschema.validators import validator_for
 import pprint
+import hashlib
+from krm_instrument import instrument, timed
+
+# compiled validators, keyed by a hash of the schema
+_validators = {}
+# the schema dictionaries that were seen and their validators, keyed by id(). The dictionary
+# is kept so its id is not reused
+_by_id = {}
+# the schema files that were read, keyed by (path, modification time)
+_schema_files = {}
+
+
+def read_schema(schema_file):
+    '''
+    Read a schema file, or return the dictionary read before if the file has not changed since
+
+    Parameters:
+    -----------
+    schema_file- the schema JSON file (pathlib object or string)
+
+    Returns:
+    --------
+    the schema dictionary
+    '''
+
+    path = Path(schema_file).resolve()
+    key = (path, path.stat().st_mtime_ns)
+    if (key not in _schema_files):
+        with open(path, 'r') as f:
+            _schema_files[key] = json.load(f)
+
+    return _schema_files[key]
+
+
+def compiled_validator(schema_dict):
+    '''
+    Build the validator for a schema once and return the same validator for later calls with
+    the same schema. The schema is checked when the validator is built. The schema dictionary
+    should not be changed after it is compiled.
+
+    Parameters:
+    -----------
+    schema_dict- the schema dictionary
+
+    Returns:
+    --------
+    jsonschema validator with format checking enabled
+    '''
+
+    seen = _by_id.get(id(schema_dict))
+    if (seen is not None and seen[0] is schema_dict):
+        return seen[1]
+
+    # equal schemas that are different dictionaries share the validator
+    key = hashlib.sha1(json.dumps(schema_dict, sort_keys=True).encode()).hexdigest()
+    if (key not in _validators):
+        from jsonschema.validators import validator_for
+        cls = validator_for(schema_dict)
+        cls.check_schema(schema_dict)
+        _validators[key] = cls(schema_dict, format_checker=cls.FORMAT_CHECKER)
+    _by_id[id(schema_dict)] = (schema_dict, _validators[key])
+
+    return _validators[key]
 
 
 class krm_validate():
     def __init__(self, schema_ref=None, schema_obj=None, schema_file=None, 
                        json_ref=None, json_obj=None, json_file=None, 
-                       data_ref=None, data_obj=None, validate_schema=False):
+                       data_ref=None, data_obj=None, validate_schema=False, compiled=False):
         '''
         Validate the data and/or dictionary to the echoSMs schema
 
@@ -37,6 +105,8 @@ class krm_validate():
                  instance to another class, then use this as a reference to that instance
         data_obj- the name of the object in the data reference
         validate_schema- validate the schema
+        compiled- build the validator for the schema once (with format checking) and use it 
+                  for validate() and validate_many()
 
         Returns:
         --------
@@ -50,11 +120,10 @@ class krm_validate():
                 else:
                     self.schema_file = schema_file
                 try:
-                    with open(self.schema_file, 'r') as f:
-                        self.schema_dict = json.load(f)
+                    self.schema_dict = read_schema(self.schema_file)
                 except FileNotFoundError:
-                    print(f'Error: The file {self.schema_file} was not found. Exiting the program')
-                    sys.exit() 
+                    print(f'Error: The file {self.schema_file} was not found')
+                    raise
             elif (schema_ref and schema_obj):
                 self.schema_dict = getattr(schema_ref, schema_obj)
             else:
@@ -63,6 +132,8 @@ class krm_validate():
 
         # validate the schema
         if (validate_schema):
+            from jsonschema.exceptions import SchemaError
+            from jsonschema.validators import validator_for
             try:
                 validator = validator_for(self.schema_dict)
                 validator.check_schema(self.schema_dict)
@@ -70,6 +141,10 @@ class krm_validate():
             except SchemaError as e:
                 print(f'Schema failed: {e}')
 
+        self.validator = None
+        if (compiled):
+            self.validator = compiled_validator(self.schema_dict)
+
         if (json_file or json_ref or json_obj):
             if (json_file):
                 if (not isinstance(json_file, Path)):
@@ -80,8 +155,8 @@ class krm_validate():
                     with open(self.json_file, 'r') as f:
                         self.data_dict= json.load(f)
                 except FileNotFoundError:
-                    print(f'Error: The file {self.json_file} was not found. Exiting the program')
-                    sys.exit() 
+                    print(f'Error: The file {self.json_file} was not found')
+                    raise
             elif (json_ref and json_obj):
                 self.data_dict = getattr(json_ref, json_obj)
                 #self.data_dict = json_ref.json_obj
@@ -96,33 +171,77 @@ class krm_validate():
                 print('No data reference or object provided. Can not validate the data')
                 return False
 
-    def validate(self):
+    @timed('validate')
+    def validate(self, data_dict=None):
         '''
         use jsonschema to validate the json to the schema
         
         Parameters:
         -----------
         none- use the dictionaries defined in self
+        Optional- data_dict- validate this dictionary instead of the one defined in self. This
+                  is used to validate many documents with one (compiled) instance
 
         Returns:
         --------
         boolean whether the file was validated
         '''
         
+        from jsonschema import validate, ValidationError
+        from jsonschema.exceptions import best_match
+        from jsonschema.validators import validator_for
+
         valid = False
+        if (data_dict is None):
+            data_dict = self.data_dict
 
         try:
-            validate(instance=self.data_dict, schema=self.schema_dict)
+            if (self.validator):
+                error = best_match(self.validator.iter_errors(data_dict))
+                if (error):
+                    raise error
+            else:
+                # the same format checking as the compiled validator
+                cls = validator_for(self.schema_dict)
+                validate(instance=data_dict, schema=self.schema_dict, cls=cls,
+                         format_checker=cls.FORMAT_CHECKER)
             print("Data adhere to the schema.")
             valid = True
         except ValidationError as e:
             print(f"Data do NOT adhere to the schema. Error: {e.message}")
         except Exception as e:
             print(f"An unexpected error occurred during validation: {e}")
+        instrument.count('validate', documents=1, invalid=int(not valid))
 
         return valid
 
 
+    @timed('validate')
+    def validate_many(self, data_dicts):
+        '''
+        validate many documents with the compiled validator and collect all the errors for 
+        each document, not just the first one
+
+        Parameters:
+        -----------
+        data_dicts- iterable of dictionaries to validate
+
+        Returns:
+        --------
+        list with a list of jsonschema ValidationError for each document. An empty list means
+        the document is valid
+        '''
+
+        if (not self.validator):
+            self.validator = compiled_validator(self.schema_dict)
+
+        errors = [sorted(self.validator.iter_errors(d), key=lambda e: list(e.absolute_path))
+                  for d in data_dicts]
+        instrument.count('validate', documents=len(errors), invalid=sum(map(bool, errors)))
+
+        return errors
+
+
     def display_dict(self, dictname):
         '''
         print the schema or JSON dictionary to the display
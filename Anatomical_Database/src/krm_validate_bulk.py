@@ -0,0 +1,263 @@
+'''
+Validate many toml and JSON files to the echoSMs schema
+
+krm_validate validates one document at a time. This program validates all the toml and JSON
+files in directories (e.g., a whole datastore after a schema change) across a pool of worker
+processes. The schema is read and compiled once per worker. For each file it collects every
+error (not only the first one) with the JSON path of the error in the document, e.g.,
+$.shape_data.x[3]. A file that can not be read is reported and does not stop the run.
+
+The summary has the counts of the valid, invalid, and unreadable files, the number of errors
+by validator type (e.g., "required", "type", "additionalProperties"), the most common error
+messages, and the slowest files. It can be written as a JSON report with the errors of each
+file. With --fail-fast the run stops at the first invalid file and exits with 1, e.g., for CI:
+    python krm_validate_bulk.py --schema ../Schema/echoSMs_datastore_schema.json \
+                                --workers 8 --report report.json /data/toml
+    python krm_validate_bulk.py --schema ../Schema/echoSMs_datastore_schema.json --fail-fast \
+                                ../Example_Data/*.toml
+
+jech
+'''
+
+import sys
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+from collections import Counter
+from dataclasses import dataclass, field, asdict
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+from krm_validate import compiled_validator
+
+# the compiled validator of each worker process
+_worker = {}
+# the files that are validated
+suffixes = ('.toml', '.json')
+
+
+@dataclass
+class krm_validation():
+    '''
+    The validation of one file
+    status is one of "valid", "invalid", or "unreadable"
+    '''
+    file: str
+    status: str = 'unreadable'
+    seconds: float = 0.0
+    message: str = ''
+    errors: list = field(default_factory=list)
+
+
+def find_files(paths, recursive=False):
+    '''
+    The toml and JSON files in a list of files and directories
+
+    Parameters:
+    -----------
+    paths- files and directories
+    recursive- also search the subdirectories
+
+    Returns:
+    --------
+    sorted list of the files
+    '''
+
+    files = set()
+    for p in paths:
+        p = Path(p)
+        if (p.is_dir()):
+            for suffix in suffixes:
+                files.update(p.glob(('**/*' if recursive else '*') + suffix))
+        else:
+            files.add(p)
+
+    return sorted(str(f) for f in files)
+
+
+def _init_worker(schema_file, max_errors):
+    with open(schema_file, 'r') as f:
+        _worker['validator'] = compiled_validator(json.load(f))
+    _worker['max_errors'] = max_errors
+
+
+def validate_file(filename):
+    '''
+    Read and validate one file with the validator of the worker
+
+    Parameters:
+    -----------
+    filename- the toml or JSON file
+
+    Returns:
+    --------
+    krm_validation
+    '''
+
+    result = krm_validation(filename)
+    t0 = time.perf_counter()
+    try:
+        if (filename.endswith('.toml')):
+            with open(filename, 'rb') as f:
+                doc = tomllib.load(f)
+        else:
+            with open(filename, 'r') as f:
+                doc = json.load(f)
+    except (OSError, ValueError) as e:
+        # ValueError includes the toml and JSON decode errors
+        result.message = f'{type(e).__name__}: {e}'
+    else:
+        max_errors = _worker['max_errors']
+        for error in _worker['validator'].iter_errors(doc):
+            result.errors.append({'json_path': error.json_path,
+                                  'validator': error.validator,
+                                  'schema_path': '/'.join(str(p) for p in error.schema_path),
+                                  'message': error.message[:500]})
+            if (max_errors and len(result.errors) >= max_errors):
+                break
+        result.status = 'invalid' if result.errors else 'valid'
+        result.errors.sort(key=lambda e: e['json_path'])
+    result.seconds = time.perf_counter() - t0
+
+    return result
+
+
+def validate_files(files, schema_file, workers=None, fail_fast=False, max_errors=0,
+                   progress=False):
+    '''
+    Validate the files across a pool of worker processes
+
+    Parameters:
+    -----------
+    files- list of toml and JSON files
+    schema_file- the schema file
+    workers- number of worker processes. Default is the number of CPUs. With one worker the
+             files are validated in this process
+    fail_fast- stop at the first file that is invalid or can not be read
+    max_errors- maximum number of errors kept per file. 0 keeps all of them
+    progress- print a line for each file that is not valid
+
+    Returns:
+    --------
+    list of krm_validation and the wall time in seconds
+    '''
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    workers = workers or os.cpu_count() or 1
+    results = []
+    t0 = time.perf_counter()
+    if (workers == 1 or len(files) <= 1):
+        _init_worker(schema_file, max_errors)
+        for filename in files:
+            results.append(validate_file(filename))
+            if (progress):
+                _print_result(results[-1])
+            if (fail_fast and results[-1].status != 'valid'):
+                break
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(schema_file, max_errors))
+        try:
+            futures = [pool.submit(validate_file, f) for f in files]
+            for future in as_completed(futures):
+                if (future.cancelled()):
+                    continue
+                results.append(future.result())
+                if (progress):
+                    _print_result(results[-1])
+                if (fail_fast and results[-1].status != 'valid'):
+                    break
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    return results, time.perf_counter() - t0
+
+
+def summarize(results, elapsed, nfiles, slowest=10, common=10):
+    '''
+    Summarize the validation of the files
+
+    Parameters:
+    -----------
+    results- list of krm_validation
+    elapsed- wall time in seconds
+    nfiles- number of files to validate (more than the results after a fail-fast stop)
+    slowest- number of slowest files to list
+    common- number of most common error messages to list
+
+    Returns:
+    --------
+    dictionary with the summary
+    '''
+
+    status = Counter(r.status for r in results)
+    by_validator = Counter(e['validator'] for r in results for e in r.errors)
+    # the messages without the values, e.g., "'x' is a required property"
+    messages = Counter(f"{e['validator']} at {e['schema_path']}"
+                       for r in results for e in r.errors)
+
+    return {'files': nfiles,
+            'checked': len(results),
+            'valid': status['valid'],
+            'invalid': status['invalid'],
+            'unreadable': status['unreadable'],
+            'errors': sum(by_validator.values()),
+            'errors_by_validator': dict(by_validator.most_common()),
+            'common_errors': dict(messages.most_common(common)),
+            'slowest': [{'file': r.file, 'seconds': round(r.seconds, 4)}
+                        for r in sorted(results, key=lambda r: r.seconds,
+                                        reverse=True)[:slowest]],
+            'seconds': round(elapsed, 3),
+            'files_per_second': round(len(results)/elapsed, 2) if elapsed > 0 else 0.0}
+
+
+def _print_result(r):
+    if (r.status != 'valid'):
+        first = r.errors[0] if r.errors else None
+        print(f'{r.status:10s} {r.file}: ' + (f"{len(r.errors)} errors, {first['json_path']}: "
+                                               f"{first['message'][:100]}" if first else
+                                               r.message))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate toml and JSON files to the schema')
+    parser.add_argument('paths', nargs='+', help='files and directories to validate')
+    parser.add_argument('--schema', required=True, help='echoSMs datastore schema JSON file')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--recursive', action='store_true', help='search subdirectories')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='stop at the first file that is not valid')
+    parser.add_argument('--max-errors', type=int, default=0,
+                        help='maximum number of errors kept per file (default: all)')
+    parser.add_argument('--report', help='write the summary and the errors as JSON')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    args = parser.parse_args(argv)
+
+    files = find_files(args.paths, args.recursive)
+    results, elapsed = validate_files(files, args.schema, workers=args.workers,
+                                      fail_fast=args.fail_fast, max_errors=args.max_errors,
+                                      progress=not args.quiet)
+    summary = summarize(results, elapsed, len(files))
+
+    if (args.report):
+        with open(args.report, 'w') as f:
+            json.dump({'schema': str(args.schema), 'summary': summary,
+                       'files': [asdict(r) for r in sorted(results, key=lambda r: r.file)
+                                 if r.status != 'valid']}, f, indent=4)
+
+    print(f"{summary['checked']} of {summary['files']} files: {summary['valid']} valid, "
+          f"{summary['invalid']} invalid, {summary['unreadable']} unreadable, "
+          f"{summary['errors']} errors in {summary['seconds']} s")
+    for validator, n in summary['errors_by_validator'].items():
+        print(f'{n:8d} {validator}')
+
+    return 0 if summary['valid'] == summary['files'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+'''
+Rasterize outlines to voxels (shape_type "voxels" or "categorised voxels")
+
+The outlines of the body parts of a specimen (e.g., the fish body and the swimbladder from
+krm_merge_data.merge_all) are filled on a regular grid. A voxel is in a body part if its center
+is inside the elliptical cross-section of the outline at its x:
+    ((y - y_c)/width)^2 + ((z - z_c)/height)^2 <= 1
+where y_c, z_c, width, and height are interpolated from the outline nodes. Each voxel gets
+the category of the last body part it is in, in the order of the tissues (so the swimbladder
+is an inclusion in the body), and the mass density and sound speed of that tissue. Category 0
+is the surrounding water.
+
+The grid is filled in chunks of x slices, so only a chunk of the dense grid is in memory at a
+time (chunk_bytes, which includes the working arrays of the ellipse test). The result can be:
+    dense       a uint8 array of the categories, in memory or in a .npy file (memory-mapped)
+    sparse      the flat indices and categories of the voxels that are not water, for mostly
+                empty grids
+The densities and sound speeds are a lookup of the categories, so they are not stored.
+
+    voxels = krm_voxel(voxel_size=(0.5, 0.5, 0.5))
+    grid = voxels.rasterize(krm_merge.merge_all(returndict=True), sparse=True)
+    doc = voxels.voxel_document(krm_merge.merge_all(returndict=True), grid)
+
+The coordinates and the voxel size are in the units of the outlines (shape_units).
+
+jech
+'''
+
+import sys
+import argparse
+import numpy as np
+
+
+class krm_voxel():
+    # (mass density kg/m^3, compressional sound speed m/s) of each tissue, in the order they
+    # are filled. Category 0 is the surrounding water
+    default_tissues = {'surrounding': (1026.0, 1480.0),
+                       'body': (1070.0, 1570.0),
+                       'muscle': (1070.0, 1570.0),
+                       'backbone': (1900.0, 2800.0),
+                       'swimbladder': (1.24, 345.0),
+                       'other': (1050.0, 1550.0)}
+    # memory of a voxel in a chunk: the uint8 category, the float64 ellipse test, and the mask
+    bytes_per_voxel = 10
+
+    def __init__(self, voxel_size=(1.0, 1.0, 1.0), tissues=None, chunk_bytes=64*2**20,
+                 margin=1):
+        '''
+        Parameters:
+        -----------
+        voxel_size- voxel size (dx, dy, dz) in the units of the outlines, or one number
+        tissues- dictionary of {tissue: (mass density, sound speed)} in the order they are
+                 filled. The first one is the surrounding water. Default is default_tissues
+        chunk_bytes- maximum memory in bytes of a chunk of x slices: the categories and the
+                     working arrays of the ellipse test (bytes_per_voxel per voxel)
+        margin- number of water voxels around the body parts
+
+        Returns:
+        --------
+        none
+        '''
+
+        self.voxel_size = np.broadcast_to(np.asarray(voxel_size, dtype=np.float64), (3,))
+        if (np.any(self.voxel_size <= 0)):
+            raise ValueError('The voxel size needs to be positive')
+        self.tissues = dict(tissues or self.default_tissues)
+        if (len(self.tissues) > 255):
+            raise ValueError('There can be at most 255 tissues')
+        self.names = list(self.tissues)
+        self.chunk_bytes = chunk_bytes
+        self.margin = margin
+
+
+    def __outlines(self, outlines):
+        '''
+        list of (category, outline arrays sorted by x) in the fill order of the tissues
+        '''
+
+        if (isinstance(outlines, dict)):
+            # e.g., merge_all: {label: merged document}
+            outlines = [(d.get('anatomical_feature', 'other'), d['shape_data'])
+                        for d in outlines.values()]
+        parts = []
+        for name, sd in outlines:
+            if (name not in self.tissues):
+                print(f'Warning: {name} is not a tissue. It is filled as "other"')
+                name = 'other'
+            arrays = {k: np.asarray(sd[k], dtype=np.float64)
+                      for k in ('x', 'y', 'z', 'height', 'width')}
+            order = np.argsort(arrays['x'], kind='stable')
+            parts.append((self.names.index(name), {k: v[order] for k, v in arrays.items()}))
+
+        return sorted(parts, key=lambda p: p[0])
+
+
+    def grid(self, outlines):
+        '''
+        The grid that holds all the outlines
+
+        Parameters:
+        -----------
+        outlines- list of (tissue, shape_data) or the dictionary from merge_all
+
+        Returns:
+        --------
+        the origin (x, y, z of the center of the first voxel) and the shape (nx, ny, nz)
+        '''
+
+        parts = self.__outlines(outlines)
+        lo = np.min([[p['x'].min(), (p['y'] - p['width']).min(), (p['z'] - p['height']).min()]
+                     for c, p in parts], axis=0)
+        hi = np.max([[p['x'].max(), (p['y'] + p['width']).max(), (p['z'] + p['height']).max()]
+                     for c, p in parts], axis=0)
+        shape = np.ceil((hi - lo)/self.voxel_size).astype(int) + 1 + 2*self.margin
+        origin = lo - self.margin*self.voxel_size
+
+        return origin, tuple(int(n) for n in shape)
+
+
+    def iter_chunks(self, outlines, origin=None, shape=None):
+        '''
+        Fill the grid in chunks of x slices
+
+        Parameters:
+        -----------
+        outlines- list of (tissue, shape_data) or the dictionary from merge_all
+        origin, shape- the grid. Default is the grid from grid()
+
+        Returns:
+        --------
+        generator of (first x slice, uint8 categories of the chunk (nxchunk, ny, nz))
+        '''
+
+        parts = self.__outlines(outlines)
+        if (origin is None or shape is None):
+            origin, shape = self.grid(outlines)
+        nx, ny, nz = shape
+        dx, dy, dz = self.voxel_size
+        yc = (origin[1] + dy*np.arange(ny))[None, :, None]
+        zc = (origin[2] + dz*np.arange(nz))[None, None, :]
+        # the categories (uint8), the ellipse test (float64), and its mask (bool) of a chunk
+        step = max(1, self.chunk_bytes//max(1, ny*nz*self.bytes_per_voxel))
+        for i0 in range(0, nx, step):
+            xc = origin[0] + dx*np.arange(i0, min(i0 + step, nx))
+            categories = np.zeros((len(xc), ny, nz), dtype=np.uint8)
+            test = np.empty((len(xc), ny, nz))
+            mask = np.empty((len(xc), ny, nz), dtype=bool)
+            for category, p in parts:
+                inx = np.flatnonzero((xc >= p['x'][0]) & (xc <= p['x'][-1]))
+                if (len(inx) == 0):
+                    continue
+                # the x slices of the chunk in the outline are contiguous
+                rows = slice(inx[0], inx[-1] + 1)
+                n = len(inx)
+                # the cross-section of the outline at each x slice of the chunk
+                sec = {k: np.interp(xc[rows], p['x'], p[k])[:, None, None]
+                       for k in ('y', 'z', 'height', 'width')}
+                # inside the ellipse, without dividing by a zero width or height:
+                # ((y - y_c)*height)^2 + ((z - z_c)*width)^2 <= (width*height)^2
+                limit = np.where((sec['width'] > 0) & (sec['height'] > 0),
+                                 (sec['width']*sec['height'])**2, -1.0)
+                np.add(((yc - sec['y'])*sec['height'])**2, ((zc - sec['z'])*sec['width'])**2,
+                       out=test[:n])
+                np.less_equal(test[:n], limit, out=mask[:n])
+                np.copyto(categories[rows], np.uint8(category), where=mask[:n])
+            yield i0, categories
+            # free the chunk before the next one is allocated
+            del categories, test, mask
+
+
+    def rasterize(self, outlines, sparse=False, out=None):
+        '''
+        Fill the grid
+
+        Parameters:
+        -----------
+        outlines- list of (tissue, shape_data) or the dictionary from merge_all
+        sparse- return the indices of the voxels that are not water instead of the dense grid
+        out- .npy file for the dense categories. The file is filled chunk by chunk and returned
+             memory-mapped, so the grid does not need to fit in memory
+
+        Returns:
+        --------
+        dictionary with the origin, shape, voxel_size, tissues, and either "categories" (the
+        dense grid) or "indices" (flat indices into the grid) and "values" (their categories)
+        '''
+
+        origin, shape = self.grid(outlines)
+        result = {'origin': origin, 'shape': shape, 'voxel_size': self.voxel_size.copy(),
+                  'tissues': dict(self.tissues)}
+        if (sparse):
+            indices = []
+            values = []
+            ny, nz = shape[1], shape[2]
+            for i0, cat in self.iter_chunks(outlines, origin, shape):
+                flat = np.flatnonzero(cat)
+                indices.append(flat + i0*ny*nz)
+                values.append(cat.ravel()[flat])
+            result['indices'] = np.concatenate(indices).astype(np.int64, copy=False)
+            result['values'] = np.concatenate(values)
+            return result
+
+        if (out is not None):
+            categories = np.lib.format.open_memmap(out, mode='w+', dtype=np.uint8, shape=shape)
+        else:
+            categories = np.zeros(shape, dtype=np.uint8)
+        for i0, cat in self.iter_chunks(outlines, origin, shape):
+            categories[i0:i0+len(cat)] = cat
+        if (out is not None):
+            categories.flush()
+        result['categories'] = categories
+
+        return result
+
+
+    @staticmethod
+    def dense(result):
+        '''
+        The dense categories of a sparse or dense result
+        '''
+
+        if ('categories' in result):
+            return result['categories']
+        categories = np.zeros(result['shape'], dtype=np.uint8)
+        categories.ravel()[result['indices']] = result['values']
+
+        return categories
+
+
+    @staticmethod
+    def properties(result):
+        '''
+        The mass density and sound speed of each voxel
+
+        Parameters:
+        -----------
+        result- the dictionary from rasterize()
+
+        Returns:
+        --------
+        dense arrays of the mass density and the sound speed
+        '''
+
+        table = np.array(list(result['tissues'].values()), dtype=np.float64)
+        categories = krm_voxel.dense(result)
+
+        return table[categories, 0], table[categories, 1]
+
+
+    @staticmethod
+    def volumes(result):
+        '''
+        The volume of each tissue, e.g., to compare to the volume of the surface mesh
+
+        Returns:
+        --------
+        dictionary of {tissue: volume} in the units of the voxel size cubed
+        '''
+
+        if ('categories' in result):
+            counts = np.zeros(len(result['tissues']), dtype=np.int64)
+            for i in range(0, result['shape'][0], 64):
+                counts += np.bincount(np.asarray(result['categories'][i:i+64]).ravel(),
+                                      minlength=len(counts))
+        else:
+            counts = np.bincount(result['values'], minlength=len(result['tissues']))
+            counts[0] = np.prod(result['shape']) - len(result['values'])
+        dv = float(np.prod(result['voxel_size']))
+
+        return {name: float(n*dv) for name, n in zip(result['tissues'], counts)}
+
+
+    @staticmethod
+    def save(result, npzfile):
+        '''
+        Save a result to a compressed .npz file
+        '''
+
+        arrays = {k: np.asarray(v) for k, v in result.items()
+                  if k in ('origin', 'shape', 'voxel_size', 'categories', 'indices', 'values')}
+        arrays['tissue_names'] = np.array(list(result['tissues']))
+        arrays['tissue_properties'] = np.array(list(result['tissues'].values()))
+        np.savez_compressed(npzfile, **arrays)
+
+
+    @staticmethod
+    def load(npzfile):
+        '''
+        Load a result saved with save()
+        '''
+
+        with np.load(npzfile) as z:
+            result = {k: z[k] for k in z.files if not k.startswith('tissue_')}
+            result['tissues'] = {str(n): tuple(p) for n, p in
+                                 zip(z['tissue_names'], z['tissue_properties'])}
+        result['shape'] = tuple(int(n) for n in result['shape'])
+
+        return result
+
+
+    def voxel_document(self, docs, result=None, categorised=False):
+        '''
+        A merged document with the voxels of the body parts of a specimen, in the schema format.
+        The schema has dense nested lists, so this is for grids that fit in memory
+
+        Parameters:
+        -----------
+        docs- the dictionary of merged documents from merge_all
+        result- the dictionary from rasterize(). Default is to rasterize the documents
+        categorised- shape_type "categorised voxels" with the categories
+
+        Returns:
+        --------
+        the merged dictionary with the voxel shape_data
+        '''
+
+        if (result is None):
+            result = self.rasterize(docs)
+        density, sound_speed = self.properties(result)
+        shape_type = 'categorised voxels' if categorised else 'voxels'
+        shape_data = {'shape_type': shape_type}
+        if (categorised):
+            shape_data['categories'] = self.dense(result).astype(int).tolist()
+        shape_data |= {'voxel_mass_density': density.tolist(),
+                       'voxel_sound_speed_compressional': sound_speed.tolist(),
+                       'voxel_size': result['voxel_size'].tolist()}
+        first = next(iter(docs.values()))
+        doc = {'shape_data': shape_data} | {k: v for k, v in first.items() if k != 'shape_data'}
+        if ('shape_type' in doc):
+            doc['shape_type'] = shape_type
+
+        return doc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rasterize the outlines of a .dat file')
+    parser.add_argument('datfile', help='KRM .dat file')
+    parser.add_argument('jsonfile', help='JSON metadata file')
+    parser.add_argument('outfile', help='.npz file for the voxels')
+    parser.add_argument('--voxel-size', type=float, nargs='+', default=[1.0],
+                        help='voxel size (one value or dx dy dz) in the units of the outline')
+    parser.add_argument('--dense', action='store_true', help='save the dense grid')
+    parser.add_argument('--chunk-mb', type=float, default=64, help='memory per chunk in MiB')
+    args = parser.parse_args(argv)
+
+    import io
+    import contextlib
+    from krm_json import krm_json as kj
+    from krm_data import krm_data as kd
+    from krm_merge_data import krm_merge_data as km
+    with contextlib.redirect_stdout(io.StringIO()):
+        krm_data = kd(args.datfile, stream=True)
+        krm_data.parse()
+        docs = km(data=krm_data, json=kj(args.jsonfile), headless=True).merge_all(
+            returndict=True)
+
+    voxels = krm_voxel(args.voxel_size if len(args.voxel_size) == 3 else args.voxel_size[0],
+                       chunk_bytes=int(args.chunk_mb*2**20))
+    result = voxels.rasterize(docs, sparse=not args.dense)
+    voxels.save(result, args.outfile)
+    print(f"grid {result['shape']}, volumes {voxels.volumes(result)}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
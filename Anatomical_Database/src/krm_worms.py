@@ -1,20 +1,42 @@
 '''
 Class to get taxonomic information from WORMS
 
+The lookups can be saved in a local cache (krm_worms_cache) so the same Aphia ID is only looked
+up once. With offline=True the lookups are served only from the cache.
+
+The classification and vernaculars are read from the WoRMS REST service with a pooled HTTP client
+(krm_http). fetch_many() looks up many Aphia IDs at once with a bounded number of threads.
+pyworms (and requests) are only imported to look up an Aphia ID by name.
+
 jech
 '''
 
-import sys
 from pathlib import Path
-import pyworms
 import json
 import pprint
-import subprocess
-import ast
+from concurrent.futures import ThreadPoolExecutor
+from krm_worms_cache import krm_worms_cache
+from krm_http import krm_http
+from krm_instrument import instrument
+
+# the HTTP client that is shared by the krm_worms instances that are not given one
+_http = None
+
+
+def default_http():
+    '''
+    the shared HTTP client for the WoRMS REST service
+    '''
+
+    global _http
+    if (_http is None):
+        _http = krm_http()
+
+    return _http
 
 
 class krm_worms():
-    def __init__(self, jsonfile=None):
+    def __init__(self, jsonfile=None, aphia_id=None, cache=None, offline=False, http=None):
         '''
         Initialize taxonomic paramters from the WORMS database 
 
@@ -27,6 +49,11 @@ class krm_worms():
                   file name need to be given. Preference for a pathlib object, but if not, it 
                   is converted to one. 
                   WoRMS only needs the Aphia ID from the json file.
+                  aphia_id- the Aphia ID, if a JSON file is not given
+                  cache- krm_worms_cache instance or the cache file name. The lookups are 
+                         read from the cache first and saved to the cache
+                  offline- only use the cache, do not call WoRMS
+                  http- krm_http client. Default is a client shared by all instances
 
         Returns:
         --------
@@ -41,6 +68,14 @@ class krm_worms():
         krmpars = {}
         # the echoSMs schema has "specimen_" as a prefix to the ranks.
         self.sp_str = 'specimen_'
+        # the local cache of lookups
+        if (isinstance(cache, (str, Path))):
+            cache = krm_worms_cache(cache)
+        self.cache = cache
+        self.offline = offline
+        self.http = http
+        if (offline and cache is None):
+            print('Warning: offline mode without a cache. WoRMS lookups will not be found')
 
         # check whether the filename is a pathlib object. If not set it to one.
         if (jsonfile):
@@ -53,35 +88,71 @@ class krm_worms():
                 with open(jsonfile, 'r') as f:
                     krmpars = json.load(f)
             except FileNotFoundError:
-                print(f'Error: The file {jsonfile} was not found. Exiting the program')
-                sys.exit() 
+                print(f'Error: The file {jsonfile} was not found')
+                raise
+
+        if (aphia_id):
+            krmpars['aphia_id'] = aphia_id
 
-        if (krmpars['aphia_id']):
+        if (krmpars.get('aphia_id')):
             self.worms_md['aphia_id'] = krmpars['aphia_id']
         else:
-            print(f'Error: Aphia ID was not found in the file {jsonfile}. Exiting the program')
-            sys.exit() 
+            message = f'Aphia ID was not found in the file {jsonfile}'
+            print(f'Error: {message}')
+            raise ValueError(message)
 
 
-    def _docurl(self, cline):
+    def _get_json(self, path):
         '''
-        execute the curl command to get the vernaculars from WoRMS
-        pyworms does not have a function to do that
+        get a response from the WoRMS REST service
         
         Parameters:
         -----------
-        cline: the command line string that will be executed. Needs to built outside of this
-               function
+        path: the path of the request, e.g., "AphiaVernacularsByAphiaID/126417"
+
+        Returns:
+        --------
+        the parsed JSON response or None if WoRMS has no data
+        '''
+
+        if (self.http is None):
+            self.http = default_http()
+
+        return self.http.get_json(path)
+
+
+    def _lookup(self, endpoint, aphiaid, fetch):
+        '''
+        Get a WoRMS response from the cache or, if it is not in the cache, from WoRMS and save 
+        it in the cache
+
+        Parameters:
+        -----------
+        endpoint: name of the lookup, e.g., "classification" or "vernaculars"
+        aphiaid: the Aphia ID
+        fetch: function without arguments that gets the response from WoRMS
 
         Returns:
         --------
-        the WoRMS vernacular standard output
+        the response or None if it was not found
         '''
 
-        command = ['curl', cline]
-        vernacular = subprocess.run(command, capture_output=True, text=True, check=True)
+        if (self.cache is not None):
+            response = self.cache.get(endpoint, aphiaid, allow_expired=self.offline)
+            if (response is not None):
+                instrument.count('worms', cache_hits=1)
+                return response
+            instrument.count('worms', cache_misses=1)
+        if (self.offline):
+            print(f'{endpoint} for Aphia ID {aphiaid} is not in the cache (offline)')
+            return None
 
-        return vernacular
+        with instrument.stage('worms', requests=1):
+            response = fetch()
+        if (self.cache is not None and response is not None):
+            self.cache.put(endpoint, aphiaid, response)
+
+        return response
 
 
     def get_aphia_id_by_taxon(self, taxon=None, returnid=False):
@@ -101,6 +172,8 @@ class krm_worms():
         the Aphia ID from the WORMS database
         '''
 
+        import pyworms
+
         if (taxon):
             result = pyworms.aphiaRecordsByName(taxon)
         elif ('taxon' in self.worms_md):
@@ -112,13 +185,30 @@ class krm_worms():
         if result:
             self.worms_md['aphia_id'] = result[0]['AphiaID']
         else:
-            print(f'Could not find {taxon} in WORMS. Maybe check the spelling? Exit the program')
-            sys.exit()
+            message = f'Could not find {taxon} in WORMS. Maybe check the spelling?'
+            print(message)
+            raise LookupError(message)
 
         if (returnid):
             return self.worms_md['aphia_id']
 
 
+    def __classification(self, aphiaid):
+        '''
+        get the classification from WoRMS and flatten the nested ranks to a dictionary of 
+        {rank: scientific name}, as pyworms.aphiaClassificationByAphiaID does
+        '''
+
+        classification = {}
+        node = self._get_json(f'AphiaClassificationByAphiaID/{aphiaid}')
+        while node:
+            classification[node['rank'].lower()] = node['scientificname']
+            classification[node['rank'].lower()+'id'] = node['AphiaID']
+            node = node.get('child')
+
+        return classification if classification else None
+
+
     def get_taxon_ranks_by_aphia_id(self, aphiaid=None, returnranks=False):
         '''
         Get the taxonomic ranks for the specified Aphia ID. This will get the taxonomic ranks
@@ -138,19 +228,19 @@ class krm_worms():
           loaded into the dictionary
         '''
 
-        if aphiaid:
-            classification = pyworms.aphiaClassificationByAphiaID(aphiaid)
-        else:
-            classification = pyworms.aphiaClassificationByAphiaID(self.worms_md['aphia_id'])
+        if (not aphiaid):
+            aphiaid = self.worms_md['aphia_id']
+        classification = self._lookup('classification', aphiaid,
+                                      lambda: self.__classification(aphiaid))
 
         if classification:
             for tr in self.taxon_ranks:
                 if (tr in classification):
                     self.worms_md[self.sp_str+str(tr)] = classification[tr]
         else:
-            print(f'Could not find AphiaID {aphia_id} in WoRMS. Maybe check the code? \
-                  Exit the program')
-            sys.exit()
+            message = f'Could not find AphiaID {aphiaid} in WoRMS. Maybe check the code?'
+            print(message)
+            raise LookupError(message)
 
         if (returnranks):
             return self.worms_md
@@ -174,24 +264,22 @@ class krm_worms():
         '''
 
         if aphiaid:
-            cline = 'https://www.marinespecies.org/rest/AphiaVernacularsByAphiaID/'+str(aphiaid)
+            path = 'AphiaVernacularsByAphiaID/'+str(aphiaid)
         elif (self.worms_md['aphia_id']):
             aphiaid = self.worms_md['aphia_id']
-            cline = 'https://www.marinespecies.org/rest/AphiaVernacularsByAphiaID/'+\
-                    str(aphiaid)
+            path = 'AphiaVernacularsByAphiaID/'+str(aphiaid)
         else:
-            print(f'AphiaID not provided. Check the json file. Exit the program')
-            sys.exit()
+            message = 'AphiaID not provided. Check the json file'
+            print(message)
+            raise ValueError(message)
 
-        vernaculars = self._docurl(cline)
-        if (not vernaculars):
+        # the vernaculars are a list of dictionaries
+        vlist = self._lookup('vernaculars', aphiaid, lambda: self._get_json(path))
+        if (vlist is None):
             print(f'Vernaculars for Aphia ID {aphiaid} were not found in WoRMS.')
             if (returnvernaculars):
                 return self.worms_md
-
-        # the curl command returns text with a list of dictionaries as well as other characters
-        # use ast to convert to a list of dictionaries
-        vlist = ast.literal_eval(vernaculars.stdout)
+            return
         # reconfigure the list of dictionaries to a dictionary with the language as the key
         # and the language code and vernacular as a list
         # I drop the language code from the final dictionary. Make a list of lists if 
@@ -235,3 +323,71 @@ class krm_worms():
                 print('Incorrect dictionary name: select "worms"')
 
 
+def fetch_many(aphia_ids, language='English', cache=None, offline=False, http=None,
+               max_workers=8):
+    '''
+    Look up the taxonomic ranks and vernaculars for many Aphia IDs at once. The lookups run in
+    a pool of at most max_workers threads that share one HTTP client (and its connections) 
+    and one cache
+
+    Parameters:
+    -----------
+    aphia_ids- list of Aphia IDs
+    language- language of the vernaculars
+    cache- krm_worms_cache instance or the cache file name
+    offline- only use the cache
+    http- krm_http client. Default is the shared client
+    max_workers- maximum number of concurrent lookups
+
+    Returns:
+    --------
+    dictionary of {aphia_id: worms_md}. worms_md is None if the lookup failed
+    '''
+
+    if (isinstance(cache, (str, Path))):
+        cache = krm_worms_cache(cache)
+    if (http is None):
+        http = default_http()
+
+    # the specimen of the instrumentation records is set per thread
+    specimen = instrument.current_specimen
+
+    def fetch(aphiaid):
+        try:
+            with instrument.specimen(specimen):
+                worms_md = krm_worms(aphia_id=aphiaid, cache=cache, offline=offline, http=http)
+                worms_md.get_taxon_ranks_by_aphia_id()
+                return worms_md.get_vernaculars_by_aphia_id(language=language,
+                                                            returnvernaculars=True)
+        except (Exception, SystemExit) as e:
+            # krm_worms exits when an Aphia ID is not found. Keep going with the others
+            print(f'Lookup of Aphia ID {aphiaid} failed: {e}')
+            return None
+
+    unique_ids = list(dict.fromkeys(aphia_ids))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(fetch, unique_ids)
+
+    return dict(zip(unique_ids, results))
+
+
+def prewarm_cache(aphia_ids, cache, language='English'):
+    '''
+    Look up the taxonomic ranks and vernaculars for a list of Aphia IDs and save them in the cache
+
+    Parameters:
+    -----------
+    aphia_ids- list of Aphia IDs
+    cache- krm_worms_cache instance or the cache file name
+    language- language of the vernaculars
+
+    Returns:
+    --------
+    the cache statistics
+    '''
+
+    if (isinstance(cache, (str, Path))):
+        cache = krm_worms_cache(cache)
+    fetch_many(aphia_ids, language=language, cache=cache)
+
+    return cache.statistics()
@@ -0,0 +1,255 @@
+'''
+Local cache of the WoRMS lookups
+
+Every krm_worms lookup is a call to the WoRMS web service. The responses are saved in a SQLite
+file, keyed by the endpoint (e.g., "classification", "vernaculars") and the Aphia ID, so a batch
+of files for the same species makes one call per species rather than one per file. Entries
+older than the time-to-live (ttl) are fetched again, and the least recently used entries are
+evicted when there are more than max_entries.
+
+With krm_worms(..., offline=True) the lookups are served only from the cache, which can be
+filled beforehand (pre-warmed) from a list of Aphia IDs:
+    python krm_worms_cache.py worms_cache.sqlite --prewarm 126417 126421
+    python krm_worms_cache.py worms_cache.sqlite --prewarm-file aphia_ids.txt --stats
+
+jech
+'''
+
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+
+class krm_worms_cache():
+    def __init__(self, cachefile, ttl=30*24*3600, max_entries=None):
+        '''
+        Open (or create) the cache file
+
+        Parameters:
+        -----------
+        cachefile- SQLite file for the cache. Preference for a pathlib object, but if not, it
+                   is converted to one.
+        ttl- time-to-live of an entry in seconds. None keeps entries forever
+        max_entries- maximum number of entries. The least recently used entries are evicted
+
+        Returns:
+        --------
+        none
+        '''
+
+        if (not isinstance(cachefile, Path)):
+            cachefile = Path(cachefile)
+        cachefile.parent.mkdir(parents=True, exist_ok=True)
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stores': 0, 'evictions': 0}
+
+        # the connection can be shared by the threads of a concurrent lookup
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(cachefile), timeout=60, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS worms (
+                               endpoint TEXT NOT NULL,
+                               aphia_id INTEGER NOT NULL,
+                               response TEXT NOT NULL,
+                               fetched REAL NOT NULL,
+                               accessed REAL NOT NULL,
+                               PRIMARY KEY (endpoint, aphia_id))''')
+        self.db.commit()
+
+
+    def get(self, endpoint, aphia_id, allow_expired=False):
+        '''
+        Get a response from the cache
+
+        Parameters:
+        -----------
+        endpoint- name of the WoRMS lookup, e.g., "classification"
+        aphia_id- the Aphia ID
+        allow_expired- return entries that are older than the ttl (used when offline)
+
+        Returns:
+        --------
+        the cached response or None if it is not in the cache (or expired)
+        '''
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT response, fetched FROM worms '
+                                  'WHERE endpoint = ? AND aphia_id = ?',
+                                  (endpoint, int(aphia_id))).fetchone()
+            if (row is None):
+                self.stats['misses'] += 1
+                return None
+            if (self.ttl is not None and now - row[1] > self.ttl and not allow_expired):
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self.db.execute('UPDATE worms SET accessed = ? WHERE endpoint = ? AND aphia_id = ?',
+                            (now, endpoint, int(aphia_id)))
+            self.db.commit()
+            self.stats['hits'] += 1
+
+        return json.loads(row[0])
+
+
+    def put(self, endpoint, aphia_id, response):
+        '''
+        Put a response in the cache
+
+        Parameters:
+        -----------
+        endpoint- name of the WoRMS lookup, e.g., "classification"
+        aphia_id- the Aphia ID
+        response- the response. It needs to be JSON serializable
+
+        Returns:
+        --------
+        none
+        '''
+
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO worms VALUES (?, ?, ?, ?, ?)',
+                            (endpoint, int(aphia_id), json.dumps(response), now, now))
+            self.db.commit()
+            self.stats['stores'] += 1
+        if (self.max_entries is not None):
+            self.evict()
+
+
+    def evict(self):
+        '''
+        Remove the expired entries and the least recently used entries over max_entries
+
+        Parameters:
+        -----------
+        none
+
+        Returns:
+        --------
+        number of entries removed
+        '''
+
+        removed = 0
+        with self.lock:
+            if (self.ttl is not None):
+                cur = self.db.execute('DELETE FROM worms WHERE fetched < ?',
+                                      (time.time() - self.ttl,))
+                removed += cur.rowcount
+            if (self.max_entries is not None):
+                cur = self.db.execute('DELETE FROM worms WHERE rowid IN '
+                                      '(SELECT rowid FROM worms ORDER BY accessed DESC '
+                                      'LIMIT -1 OFFSET ?)', (self.max_entries,))
+                removed += cur.rowcount
+            self.db.commit()
+            self.stats['evictions'] += removed
+
+        return removed
+
+
+    def statistics(self):
+        '''
+        The cache statistics of this session and the number of entries in the cache
+
+        Parameters:
+        -----------
+        none
+
+        Returns:
+        --------
+        dictionary with the hits, misses, expired, stores, evictions, hit rate, and entries
+        '''
+
+        with self.lock:
+            entries = self.db.execute('SELECT endpoint, COUNT(*) FROM worms '
+                                      'GROUP BY endpoint').fetchall()
+        lookups = self.stats['hits'] + self.stats['misses']
+        stats = dict(self.stats)
+        stats['hit_rate'] = round(self.stats['hits']/lookups, 4) if lookups else 0.0
+        stats['entries'] = dict(entries)
+
+        return stats
+
+
+    def clear(self):
+        '''
+        Remove all entries from the cache
+        '''
+
+        with self.lock:
+            self.db.execute('DELETE FROM worms')
+            self.db.commit()
+
+
+    def close(self):
+        '''
+        Close the cache file
+        '''
+
+        with self.lock:
+            self.db.close()
+
+
+    def display_dict(self, dictname):
+        '''
+        print the cache statistics to the display
+
+        Parameters:
+        -----------
+            the name of the dictionary
+
+        Returns:
+        --------
+           none
+        '''
+
+        match dictname:
+            case 'stats':
+                print(json.dumps(self.statistics(), indent=4))
+            case _:
+                print('Incorrect dictionary name: select "stats"')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the local cache of WoRMS lookups')
+    parser.add_argument('cachefile', help='SQLite cache file')
+    parser.add_argument('--prewarm', nargs='*', type=int, default=[],
+                        help='Aphia IDs to look up and save in the cache')
+    parser.add_argument('--prewarm-file', help='text file with one Aphia ID per line')
+    parser.add_argument('--language', default='English', help='language of the vernaculars')
+    parser.add_argument('--ttl', type=float, default=30*24*3600, help='time-to-live in seconds')
+    parser.add_argument('--max-entries', type=int, default=None, help='maximum number of entries')
+    parser.add_argument('--evict', action='store_true', help='remove expired and excess entries')
+    parser.add_argument('--clear', action='store_true', help='remove all entries')
+    parser.add_argument('--stats', action='store_true', help='print the cache statistics')
+    args = parser.parse_args(argv)
+
+    cache = krm_worms_cache(args.cachefile, ttl=args.ttl, max_entries=args.max_entries)
+    if (args.clear):
+        cache.clear()
+    if (args.evict):
+        print(f'evicted {cache.evict()} entries')
+
+    aphia_ids = list(args.prewarm)
+    if (args.prewarm_file):
+        with open(args.prewarm_file, 'r') as f:
+            aphia_ids += [int(l.split()[0]) for l in f if l.strip()]
+    if (aphia_ids):
+        # krm_worms is only needed to fill the cache
+        from krm_worms import prewarm_cache
+        prewarm_cache(aphia_ids, cache, language=args.language)
+
+    if (args.stats):
+        cache.display_dict('stats')
+    cache.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -43,8 +43,8 @@ printschema= 'n'
 if (printschema == 'y'):
     print('SCHEMA METADATA')
     schema_md.display_dict('schema')
-# validate the schema
-validate_schema = kv(schema_ref=schema_md, schema_obj='schema_md', validate_schema=True) 
+# validate the schema and build the validator once. It is used for the json and merged data
+validator = kv(schema_ref=schema_md, schema_obj='schema_md', validate_schema=True, compiled=True)
 
 # read the specimen metadata
 # read from a json file
@@ -59,10 +59,7 @@ if (printjson == 'y'):
     print('METADATA')
     json_md.display_dict('json_md')
 # validate the json with the schema
-validate_json = kv(schema_ref=schema_md, schema_obj='schema_md', 
-                   json_ref=json_md, json_obj='json_md', validate_schema=False)
-if (validate_json):
-    validjson = validate_json.validate()
+validjson = validator.validate(json_md.json_md)
 
 # get taxonomic information from WORMS
 print('Get WoRMS Data')
@@ -127,10 +124,7 @@ if (plotdata == 'y'):
     krm_merge.plot_silhouette('data')
 
 # validate the merged data with the schema
-validate_data = kv(schema_ref=schema_md, schema_obj='schema_md', 
-                   data_ref=krm_merge, data_obj='krm_data_merged')
-if (validate_data):
-    validmerge = validate_data.validate()
+validmerge = validator.validate(krm_merge.krm_data_merged)
 
 
 # generate a toml format from the merged data